@@ -10,7 +10,12 @@ import numpy as np
 from torch.nn import functional as F
 
 from show import *
-from per_segment_anything import sam_model_registry, SamPredictor
+from per_segment_anything import load_sam, SamPredictor, PerSAMEngine, Concept, ConceptLibrary
+from per_segment_anything.utils.embedding_cache import sam_model_id
+
+
+# Named concepts are saved here and can be reused without their in context image
+concept_dir = './concepts'
 
 
 class ImageMask(gr.components.Image):
@@ -100,97 +105,60 @@ def calculate_sigmoid_focal_loss(inputs, targets, num_masks = 1, alpha: float =
     return loss.mean(1).sum() / num_masks
 
 
-def inference(ic_image, ic_mask, image1, image2):
+def inference(ic_image, ic_mask, image1, image2, concept_name=''):
     # in context image and mask
     ic_image = np.array(ic_image.convert("RGB"))
     ic_mask = np.array(ic_mask.convert("RGB"))
     
     sam_type, sam_ckpt = 'vit_h', 'sam_vit_h_4b8939.pth'
-    sam = sam_model_registry[sam_type](checkpoint=sam_ckpt).cuda()
-    # sam = sam_model_registry[sam_type](checkpoint=sam_ckpt)
+    sam = load_sam(sam_type, sam_ckpt, device='cuda')
+    # sam = load_sam(sam_type, sam_ckpt)
     predictor = SamPredictor(sam)
     
-    # Image features encoding
-    ref_mask = predictor.set_image(ic_image, ic_mask)
-    ref_feat = predictor.features.squeeze().permute(1, 2, 0)
-
-    ref_mask = F.interpolate(ref_mask, size=ref_feat.shape[0: 2], mode="bilinear")
-    ref_mask = ref_mask.squeeze()[0]
-    
-    # Target feature extraction
+    # Image features encoding and target feature extraction
     print("======> Obtain Location Prior" )
-    target_feat = ref_feat[ref_mask > 0]
-    target_embedding = target_feat.mean(0).unsqueeze(0)
-    target_feat = target_embedding / target_embedding.norm(dim=-1, keepdim=True)
-    target_embedding = target_embedding.unsqueeze(0)
+    concept = Concept.from_reference(predictor, ic_image, ic_mask, concept_name)
+    save_concept(concept, sam, sam_type, sam_ckpt)
+    engine = PerSAMEngine.from_concept(predictor, concept)
     
-    output_image = []
-    
-    for test_image in [image1, image2]:
-        print("======> Testing Image" )
-        test_image = np.array(test_image.convert("RGB"))
-        
-        # Image feature encoding
-        predictor.set_image(test_image)
-        test_feat = predictor.features.squeeze()
+    return segment_images(engine, predictor, image1, image2)
 
-        # Cosine similarity
-        C, h, w = test_feat.shape
-        test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
-        test_feat = test_feat.reshape(C, h * w)
-        sim = target_feat @ test_feat
 
-        sim = sim.reshape(1, 1, h, w)
-        sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
-        sim = predictor.model.postprocess_masks(
-            sim,
-            input_size=predictor.input_size,
-            original_size=predictor.original_size).squeeze()
-        
-        # Positive-negative location prior
-        topk_xy_i, topk_label_i, last_xy_i, last_label_i = point_selection(sim, topk=1)
-        topk_xy = np.concatenate([topk_xy_i, last_xy_i], axis=0)
-        topk_label = np.concatenate([topk_label_i, last_label_i], axis=0)
+def inference_concept(concept_name, image1, image2):
+    sam_type, sam_ckpt = 'vit_h', 'sam_vit_h_4b8939.pth'
+    sam = load_sam(sam_type, sam_ckpt, device='cuda')
+    # sam = load_sam(sam_type, sam_ckpt)
+    predictor = SamPredictor(sam)
 
-        # Obtain the target guidance for cross-attention layers
-        sim = (sim - sim.mean()) / torch.std(sim)
-        sim = F.interpolate(sim.unsqueeze(0).unsqueeze(0), size=(64, 64), mode="bilinear")
-        attn_sim = sim.sigmoid_().unsqueeze(0).flatten(3)
+    print("======> Load Concept" )
+    model_id = sam_model_id(sam, sam_type, sam_ckpt)
+    concept = ConceptLibrary(concept_dir).load(concept_name, device=predictor.device, model_id=model_id)
+    if concept.mask_weights is not None:
+        return segment_images_finetuned(predictor, concept.target_feat, concept.mask_weights, image1, image2)
 
-        # First-step prediction
-        masks, scores, logits, _ = predictor.predict(
-            point_coords=topk_xy, 
-            point_labels=topk_label, 
-            multimask_output=False,
-            attn_sim=attn_sim,  # Target-guided Attention
-            target_embedding=target_embedding  # Target-semantic Prompting
-        )
-        best_idx = 0
+    engine = PerSAMEngine.from_concept(predictor, concept)
+    return segment_images(engine, predictor, image1, image2)
 
-        # Cascaded Post-refinement-1
-        masks, scores, logits, _ = predictor.predict(
-                    point_coords=topk_xy,
-                    point_labels=topk_label,
-                    mask_input=logits[best_idx: best_idx + 1, :, :], 
-                    multimask_output=True)
-        best_idx = np.argmax(scores)
 
-        # Cascaded Post-refinement-2
-        y, x = np.nonzero(masks[best_idx])
-        x_min = x.min()
-        x_max = x.max()
-        y_min = y.min()
-        y_max = y.max()
-        input_box = np.array([x_min, y_min, x_max, y_max])
-        masks, scores, logits, _ = predictor.predict(
-            point_coords=topk_xy,
-            point_labels=topk_label,
-            box=input_box[None, :],
-            mask_input=logits[best_idx: best_idx + 1, :, :], 
-            multimask_output=True)
-        best_idx = np.argmax(scores)
+def save_concept(concept, sam, sam_type, sam_ckpt):
+    # Named concepts are added to the library, unnamed ones are not kept
+    if concept.name:
+        concept.model_id = sam_model_id(sam, sam_type, sam_ckpt)
+        ConceptLibrary(concept_dir).add(concept)
 
-        final_mask = masks[best_idx]
+
+def segment_images(engine, predictor, image1, image2):
+    output_image = []
+    
+    test_images = [np.array(test_image.convert("RGB")) for test_image in [image1, image2]]
+    test_states = predictor.set_images(test_images, batch_size=2)
+
+    # Location prior, target-guided prediction and cascaded post-refinement
+    results = engine.segment_batch(test_states)
+
+    for test_image, result in zip(test_images, results):
+        print("======> Testing Image" )
+        final_mask = result['mask']
         mask_colors = np.zeros((final_mask.shape[0], final_mask.shape[1], 3), dtype=np.uint8)
         mask_colors[final_mask, :] = np.array([[128, 0, 0]])
         output_image.append(Image.fromarray((mask_colors * 0.6 + test_image * 0.4).astype('uint8'), 'RGB'))
@@ -206,99 +174,18 @@ def inference_scribble(image, image1, image2):
     ic_mask = np.array(ic_mask.convert("RGB"))
     
     sam_type, sam_ckpt = 'vit_h', 'sam_vit_h_4b8939.pth'
-    sam = sam_model_registry[sam_type](checkpoint=sam_ckpt).cuda()
-    # sam = sam_model_registry[sam_type](checkpoint=sam_ckpt)
+    sam = load_sam(sam_type, sam_ckpt, device='cuda')
+    # sam = load_sam(sam_type, sam_ckpt)
     predictor = SamPredictor(sam)
     
-    # Image features encoding
-    ref_mask = predictor.set_image(ic_image, ic_mask)
-    ref_feat = predictor.features.squeeze().permute(1, 2, 0)
-
-    ref_mask = F.interpolate(ref_mask, size=ref_feat.shape[0: 2], mode="bilinear")
-    ref_mask = ref_mask.squeeze()[0]
-    
-    # Target feature extraction
+    # Image features encoding and target feature extraction
     print("======> Obtain Location Prior" )
-    target_feat = ref_feat[ref_mask > 0]
-    target_embedding = target_feat.mean(0).unsqueeze(0)
-    target_feat = target_embedding / target_embedding.norm(dim=-1, keepdim=True)
-    target_embedding = target_embedding.unsqueeze(0)
+    engine = PerSAMEngine.from_reference(predictor, ic_image, ic_mask)
     
-    output_image = []
-    
-    for test_image in [image1, image2]:
-        print("======> Testing Image" )
-        test_image = np.array(test_image.convert("RGB"))
-        
-        # Image feature encoding
-        predictor.set_image(test_image)
-        test_feat = predictor.features.squeeze()
+    return segment_images(engine, predictor, image1, image2)
 
-        # Cosine similarity
-        C, h, w = test_feat.shape
-        test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
-        test_feat = test_feat.reshape(C, h * w)
-        sim = target_feat @ test_feat
 
-        sim = sim.reshape(1, 1, h, w)
-        sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
-        sim = predictor.model.postprocess_masks(
-            sim,
-            input_size=predictor.input_size,
-            original_size=predictor.original_size).squeeze()
-        
-        # Positive-negative location prior
-        topk_xy_i, topk_label_i, last_xy_i, last_label_i = point_selection(sim, topk=1)
-        topk_xy = np.concatenate([topk_xy_i, last_xy_i], axis=0)
-        topk_label = np.concatenate([topk_label_i, last_label_i], axis=0)
-
-        # Obtain the target guidance for cross-attention layers
-        sim = (sim - sim.mean()) / torch.std(sim)
-        sim = F.interpolate(sim.unsqueeze(0).unsqueeze(0), size=(64, 64), mode="bilinear")
-        attn_sim = sim.sigmoid_().unsqueeze(0).flatten(3)
-
-        # First-step prediction
-        masks, scores, logits, _ = predictor.predict(
-            point_coords=topk_xy, 
-            point_labels=topk_label, 
-            multimask_output=False,
-            attn_sim=attn_sim,  # Target-guided Attention
-            target_embedding=target_embedding  # Target-semantic Prompting
-        )
-        best_idx = 0
-
-        # Cascaded Post-refinement-1
-        masks, scores, logits, _ = predictor.predict(
-                    point_coords=topk_xy,
-                    point_labels=topk_label,
-                    mask_input=logits[best_idx: best_idx + 1, :, :], 
-                    multimask_output=True)
-        best_idx = np.argmax(scores)
-
-        # Cascaded Post-refinement-2
-        y, x = np.nonzero(masks[best_idx])
-        x_min = x.min()
-        x_max = x.max()
-        y_min = y.min()
-        y_max = y.max()
-        input_box = np.array([x_min, y_min, x_max, y_max])
-        masks, scores, logits, _ = predictor.predict(
-            point_coords=topk_xy,
-            point_labels=topk_label,
-            box=input_box[None, :],
-            mask_input=logits[best_idx: best_idx + 1, :, :], 
-            multimask_output=True)
-        best_idx = np.argmax(scores)
-
-        final_mask = masks[best_idx]
-        mask_colors = np.zeros((final_mask.shape[0], final_mask.shape[1], 3), dtype=np.uint8)
-        mask_colors[final_mask, :] = np.array([[128, 0, 0]])
-        output_image.append(Image.fromarray((mask_colors * 0.6 + test_image * 0.4).astype('uint8'), 'RGB'))
-    
-    return output_image[0].resize((224, 224)), output_image[1].resize((224, 224))
-
-
-def inference_finetune(ic_image, ic_mask, image1, image2):
+def inference_finetune(ic_image, ic_mask, image1, image2, concept_name=''):
     # in context image and mask
     ic_image = np.array(ic_image.convert("RGB"))
     ic_mask = np.array(ic_mask.convert("RGB"))
@@ -308,31 +195,20 @@ def inference_finetune(ic_image, ic_mask, image1, image2):
     # gt_mask = gt_mask.float().unsqueeze(0).flatten(1)
     
     sam_type, sam_ckpt = 'vit_h', 'sam_vit_h_4b8939.pth'
-    sam = sam_model_registry[sam_type](checkpoint=sam_ckpt).cuda()
-    # sam = sam_model_registry[sam_type](checkpoint=sam_ckpt)
-    for name, param in sam.named_parameters():
-        param.requires_grad = False
+    sam = load_sam(sam_type, sam_ckpt, device='cuda')
+    # sam = load_sam(sam_type, sam_ckpt)
     predictor = SamPredictor(sam)
     
     print("======> Obtain Self Location Prior" )
-    # Image features encoding
-    ref_mask = predictor.set_image(ic_image, ic_mask)
-    ref_feat = predictor.features.squeeze().permute(1, 2, 0)
-
-    ref_mask = F.interpolate(ref_mask, size=ref_feat.shape[0: 2], mode="bilinear")
-    ref_mask = ref_mask.squeeze()[0]
-
-    # Target feature extraction
-    target_feat = ref_feat[ref_mask > 0]
-    target_feat_mean = target_feat.mean(0)
-    target_feat_max = torch.max(target_feat, dim=0)[0]
-    target_feat = (target_feat_max / 2 + target_feat_mean / 2).unsqueeze(0)
+    # Image features encoding and target feature extraction, mixing max and mean
+    concept = Concept.from_reference(predictor, ic_image, ic_mask, concept_name, max_weight=0.5)
+    target_feat = concept.target_feat
+    ref_feat = predictor.features.squeeze()
 
     # Cosine similarity
-    h, w, C = ref_feat.shape
-    target_feat = target_feat / target_feat.norm(dim=-1, keepdim=True)
-    ref_feat = ref_feat / ref_feat.norm(dim=-1, keepdim=True)
-    ref_feat = ref_feat.permute(2, 0, 1).reshape(C, h * w)
+    C, h, w = ref_feat.shape
+    ref_feat = ref_feat / ref_feat.norm(dim=0, keepdim=True)
+    ref_feat = ref_feat.reshape(C, h * w)
     sim = target_feat @ ref_feat
 
     sim = sim.reshape(1, 1, h, w)
@@ -387,17 +263,25 @@ def inference_finetune(ic_image, ic_mask, image1, image2):
     weights_np = weights.detach().cpu().numpy()
     print('======> Mask weights:\n', weights_np)
 
+    concept.mask_weights = weights.detach()
+    save_concept(concept, sam, sam_type, sam_ckpt)
+
+    return segment_images_finetuned(predictor, target_feat, weights.detach(), image1, image2)
+
+
+def segment_images_finetuned(predictor, target_feat, weights, image1, image2):
+    weights_np = weights.cpu().numpy()
+
     print('======> Start Testing')
     output_image = []
     
-    for test_image in [image1, image2]:
-        test_image = np.array(test_image.convert("RGB"))
-        
+    test_images = [np.array(test_image.convert("RGB")) for test_image in [image1, image2]]
+    test_states = predictor.set_images(test_images, batch_size=2)
+
+    for test_image, test_state in zip(test_images, test_states):
+
         # Image feature encoding
-        predictor.set_image(test_image)
-        test_feat = predictor.features.squeeze()
-         # Image feature encoding
-        predictor.set_image(test_image)
+        predictor.set_state(test_state)
         test_feat = predictor.features.squeeze()
 
         # Cosine similarity
@@ -484,6 +368,7 @@ main = gr.Interface(
         gr.Image(type="pil", label="in context mask"),
         gr.Image(type="pil", label="test image1"),
         gr.Image(type="pil", label="test image2"),  
+        gr.Textbox(label="concept name (optional, saves the concept)"),
     ],
     outputs=[
         gr.outputs.Image(type="pil", label="output image1"),
@@ -493,9 +378,9 @@ main = gr.Interface(
     title="Personalize Segment Anything Model with 1 Shot",
     description=description,
     examples=[
-        ["./examples/cat_00.jpg", "./examples/cat_00.png", "./examples/cat_01.jpg", "./examples/cat_02.jpg"],
-        ["./examples/colorful_sneaker_00.jpg", "./examples/colorful_sneaker_00.png", "./examples/colorful_sneaker_01.jpg", "./examples/colorful_sneaker_02.jpg"],
-        ["./examples/duck_toy_00.jpg", "./examples/duck_toy_00.png", "./examples/duck_toy_01.jpg", "./examples/duck_toy_02.jpg"],
+        ["./examples/cat_00.jpg", "./examples/cat_00.png", "./examples/cat_01.jpg", "./examples/cat_02.jpg", ""],
+        ["./examples/colorful_sneaker_00.jpg", "./examples/colorful_sneaker_00.png", "./examples/colorful_sneaker_01.jpg", "./examples/colorful_sneaker_02.jpg", ""],
+        ["./examples/duck_toy_00.jpg", "./examples/duck_toy_00.png", "./examples/duck_toy_01.jpg", "./examples/duck_toy_02.jpg", ""],
     ]
 )
 
@@ -527,6 +412,7 @@ main_finetune = gr.Interface(
         gr.Image(type="pil", label="in context mask"),
         gr.Image(type="pil", label="test image1"),
         gr.Image(type="pil", label="test image2"),  
+        gr.Textbox(label="concept name (optional, saves the concept)"),
     ],
     outputs=[
         gr.components.Image(type="pil", label="output image1"),
@@ -536,18 +422,34 @@ main_finetune = gr.Interface(
     title="Personalize Segment Anything Model with 1 Shot",
     description=description,
     examples=[
-        ["./examples/cat_00.jpg", "./examples/cat_00.png", "./examples/cat_01.jpg", "./examples/cat_02.jpg"],
-        ["./examples/colorful_sneaker_00.jpg", "./examples/colorful_sneaker_00.png", "./examples/colorful_sneaker_01.jpg", "./examples/colorful_sneaker_02.jpg"],
-        ["./examples/duck_toy_00.jpg", "./examples/duck_toy_00.png", "./examples/duck_toy_01.jpg", "./examples/duck_toy_02.jpg"],
+        ["./examples/cat_00.jpg", "./examples/cat_00.png", "./examples/cat_01.jpg", "./examples/cat_02.jpg", ""],
+        ["./examples/colorful_sneaker_00.jpg", "./examples/colorful_sneaker_00.png", "./examples/colorful_sneaker_01.jpg", "./examples/colorful_sneaker_02.jpg", ""],
+        ["./examples/duck_toy_00.jpg", "./examples/duck_toy_00.png", "./examples/duck_toy_01.jpg", "./examples/duck_toy_02.jpg", ""],
     ]
 )
 
+main_concept = gr.Interface(
+    fn=inference_concept,
+    inputs=[
+        gr.Textbox(label="concept name"),
+        gr.Image(type="pil", label="test image1"),
+        gr.Image(type="pil", label="test image2"),  
+    ],
+    outputs=[
+        gr.components.Image(type="pil", label="output image1"),
+        gr.components.Image(type="pil", label="output image2"),
+    ],
+    allow_flagging="never",
+    title="Personalize Segment Anything Model with 1 Shot",
+    description=description,
+)
+
 
 demo = gr.Blocks()
 with demo:
     gr.TabbedInterface(
-        [main, main_scribble, main_finetune], 
-        ["Personalize-SAM", "Personalize-SAM-Scribble", "Personalize-SAM-F"],
+        [main, main_scribble, main_finetune, main_concept], 
+        ["Personalize-SAM", "Personalize-SAM-Scribble", "Personalize-SAM-F", "Personalize-SAM-Concept"],
     )
 
 demo.launch(share=True)
\ No newline at end of file
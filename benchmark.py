@@ -0,0 +1,132 @@
+import time
+import resource
+import argparse
+import warnings
+import multiprocessing as mp
+import torch
+import numpy as np
+from per_segment_anything import sam_model_registry
+from per_segment_anything.build_sam import precision_dtypes
+from per_segment_anything.modeling.image_encoder import Attention
+
+warnings.filterwarnings('ignore')
+
+# (embed_dim, num_heads) of the image encoders
+encoder_dims = {
+    'vit_b': (768, 12),
+    'vit_l': (1024, 16),
+    'vit_h': (1280, 16),
+}
+
+
+def get_arguments():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--sam_type', type=str, default='vit_h', choices=list(encoder_dims) + ['vit_t'])
+    parser.add_argument('--module', type=str, default='attention', choices=['attention', 'encoder'],
+                        help='a single global attention layer or the whole image encoder')
+    parser.add_argument('--backends', type=str, nargs='+', default=None,
+                        help="attention backends, or 'default' and 'optimized' builds for vit_t")
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--precision', type=str, default='fp32', choices=list(precision_dtypes))
+    parser.add_argument('--attn_chunk_size', type=int, default=1024, help='query rows per step of the chunked backend')
+    parser.add_argument('--repeats', type=int, default=3)
+
+    args = parser.parse_args()
+    if args.sam_type == 'vit_t':
+        # TinyViT only has windowed attention, compare optimize_for_inference instead
+        args.module = 'encoder'
+        args.backends = args.backends or ['default', 'optimized']
+    else:
+        args.backends = args.backends or ['math', 'sdpa', 'chunked']
+    return args
+
+
+def main():
+
+    args = get_arguments()
+    print("Args:", args)
+
+    # Each backend runs in a fresh process, so that peak memory is not shared
+    ctx = mp.get_context('spawn')
+    results = {}
+    for backend in args.backends:
+        queue = ctx.Queue()
+        process = ctx.Process(target=run, args=(args, backend, queue))
+        process.start()
+        results[backend] = queue.get()
+        process.join()
+
+    reference = results[args.backends[0]]['output']
+    print(f"\n{'backend':<10}{'latency (ms)':>15}{'peak memory (MB)':>20}{'max abs diff':>15}")
+    for backend, result in results.items():
+        diff = np.abs(result['output'] - reference).max()
+        print(f"{backend:<10}{result['latency'] * 1000:>15.1f}{result['peak_memory'] / 2**20:>20.1f}{diff:>15.2e}")
+
+
+@torch.no_grad()
+def run(args, backend, queue):
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    dtype = precision_dtypes[args.precision]
+
+    # Inputs are drawn first, building a model may consume random numbers
+    if args.module == 'attention':
+        dim, num_heads = encoder_dims[args.sam_type]
+        x = torch.randn(1, 64, 64, dim, device=device, dtype=dtype)
+        module = Attention(dim, num_heads=num_heads, use_rel_pos=True, input_size=(64, 64), attn_backend=backend,
+                           attn_chunk_size=args.attn_chunk_size)
+        torch.nn.init.normal_(module.rel_pos_h, std=0.02)
+        torch.nn.init.normal_(module.rel_pos_w, std=0.02)
+        module = module.to(device=device, dtype=dtype)
+    elif args.sam_type == 'vit_t':
+        x = torch.randn(1, 3, 1024, 1024, device=device)
+        module = sam_model_registry[args.sam_type](
+            precision=args.precision, optimize_for_inference=backend == 'optimized')
+        module = module.image_encoder.to(device)
+    else:
+        x = torch.randn(1, 3, 1024, 1024, device=device)
+        module = sam_model_registry[args.sam_type](
+            precision=args.precision, attn_backend=backend, attn_chunk_size=args.attn_chunk_size)
+        module = module.image_encoder.to(device)
+
+    # The first run sets the peak memory
+    baseline = memory_usage(device, reset=True)
+    with torch.autocast(device.type, dtype=dtype, enabled=dtype != torch.float32):
+        output = module(x)
+        peak_memory = memory_usage(device) - baseline
+
+        latencies = []
+        for _ in range(args.repeats):
+            synchronize(device)
+            start = time.perf_counter()
+            module(x)
+            synchronize(device)
+            latencies.append(time.perf_counter() - start)
+
+    queue.put({
+        'latency': float(np.median(latencies)),
+        'peak_memory': peak_memory,
+        'output': output.float().cpu().numpy(),
+    })
+
+
+def memory_usage(device, reset=False):
+    # Peak allocated bytes on GPU, peak resident set size on CPU
+    if device.type == 'cuda':
+        if reset:
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            return torch.cuda.memory_allocated(device)
+        return torch.cuda.max_memory_allocated(device)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-def eval_davis_result(results_path, davis_path):
+def eval_davis_result(results_path, davis_path, fps=None):
     import os
     import sys
     from time import time
@@ -40,6 +40,10 @@ def eval_davis_result(results_path, davis_path):
     final_mean = (np.mean(J["M"]) + np.mean(F["M"])) / 2.
     g_res = np.array([final_mean, np.mean(J["M"]), np.mean(J["R"]), np.mean(J["D"]), np.mean(F["M"]), np.mean(F["R"]),
                     np.mean(F["D"])])
+    if fps is not None:
+        # Frames per second of the run that produced the results
+        g_measures.append('FPS')
+        g_res = np.append(g_res, fps)
     g_res = np.reshape(g_res, [1, len(g_res)])
     table_g = pd.DataFrame(data=g_res, columns=g_measures)
     with open(csv_name_global_path, 'w') as f:
@@ -9,7 +9,10 @@ from .build_sam import (
     build_sam_vit_h,
     build_sam_vit_l,
     build_sam_vit_b,
+    load_sam,
     sam_model_registry,
 )
-from .predictor import SamPredictor
+from .predictor import ImageState, ImageStatePool, SamPredictor
 from .automatic_mask_generator import SamAutomaticMaskGenerator
+from .concept import Concept, ConceptLibrary
+from .persam_engine import PerSAMEngine
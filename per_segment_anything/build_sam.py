@@ -5,51 +5,95 @@
 # LICENSE file in the root directory of this source tree.
 
 import torch
+from torch.nn import functional as F
 
+import contextlib
+import os
 from functools import partial
+from typing import Any, Dict, Optional, Tuple
 
 from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer, TinyViT
+from .modeling.common import LayerNorm2d
+from .modeling.tiny_vit_sam import LayerNorm2d as TinyLayerNorm2d
+from .utils.quantization import is_quantized_checkpoint, quantize_sam
 
 
-def build_sam_vit_h(checkpoint=None):
+def build_sam_vit_h(
+    checkpoint=None,
+    precision="fp32",
+    attn_backend="math",
+    attn_chunk_size=1024,
+    image_size=1024,
+    device=None,
+):
     return _build_sam(
         encoder_embed_dim=1280,
         encoder_depth=32,
         encoder_num_heads=16,
         encoder_global_attn_indexes=[7, 15, 23, 31],
         checkpoint=checkpoint,
+        precision=precision,
+        attn_backend=attn_backend,
+        attn_chunk_size=attn_chunk_size,
+        image_size=image_size,
+        device=device,
     )
 
 
 build_sam = build_sam_vit_h
 
 
-def build_sam_vit_l(checkpoint=None):
+def build_sam_vit_l(
+    checkpoint=None,
+    precision="fp32",
+    attn_backend="math",
+    attn_chunk_size=1024,
+    image_size=1024,
+    device=None,
+):
     return _build_sam(
         encoder_embed_dim=1024,
         encoder_depth=24,
         encoder_num_heads=16,
         encoder_global_attn_indexes=[5, 11, 17, 23],
         checkpoint=checkpoint,
+        precision=precision,
+        attn_backend=attn_backend,
+        attn_chunk_size=attn_chunk_size,
+        image_size=image_size,
+        device=device,
     )
 
 
-def build_sam_vit_b(checkpoint=None):
+def build_sam_vit_b(
+    checkpoint=None,
+    precision="fp32",
+    attn_backend="math",
+    attn_chunk_size=1024,
+    image_size=1024,
+    device=None,
+):
     return _build_sam(
         encoder_embed_dim=768,
         encoder_depth=12,
         encoder_num_heads=12,
         encoder_global_attn_indexes=[2, 5, 8, 11],
         checkpoint=checkpoint,
+        precision=precision,
+        attn_backend=attn_backend,
+        attn_chunk_size=attn_chunk_size,
+        image_size=image_size,
+        device=device,
     )
 
-def build_sam_vit_t(checkpoint=None):
+def build_sam_vit_t(
+    checkpoint=None, precision="fp32", optimize_for_inference=False, image_size=1024, device=None
+):
     prompt_embed_dim = 256
-    image_size = 1024
     vit_patch_size = 16
     image_embedding_size = image_size // vit_patch_size
     mobile_sam = Sam(
-            image_encoder=TinyViT(img_size=1024, in_chans=3, num_classes=1000,
+            image_encoder=TinyViT(img_size=image_size, in_chans=3, num_classes=1000,
                 embed_dims=[64, 128, 160, 320],
                 depths=[2, 2, 6, 2],
                 num_heads=[2, 4, 5, 10],
@@ -85,11 +129,19 @@ def build_sam_vit_t(checkpoint=None):
         )
 
     mobile_sam.eval()
-    if checkpoint is not None:
-        with open(checkpoint, "rb") as f:
-            state_dict = torch.load(f)
-        mobile_sam.load_state_dict(state_dict)
-    return mobile_sam
+    _load_checkpoint(mobile_sam, checkpoint, precision, device)
+    if optimize_for_inference:
+        # Fuse Conv-BN pairs and freeze attention biases, see TinyViT.optimize_for_inference
+        mobile_sam.image_encoder.optimize_for_inference()
+    return _set_precision(mobile_sam, precision, device)
+
+
+precision_dtypes = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
 
 sam_model_registry = {
     "default": build_sam_vit_h,
@@ -100,19 +152,78 @@ sam_model_registry = {
 }
 
 
+# Models loaded by load_sam, keyed by their type, checkpoint, device,
+# precision and builder arguments
+_loaded_models: Dict[Tuple[Any, ...], Sam] = {}
+
+
+def load_sam(
+    sam_type: str,
+    checkpoint: Optional[str] = None,
+    device: Any = "cpu",
+    precision: str = "fp32",
+    **kwargs: Any,
+) -> Sam:
+    """
+    Returns the model of the given type, checkpoint, device and precision,
+    building it the first time it is requested in the process. The weights
+    are memory-mapped from the checkpoint and loaded straight to 'device'.
+
+    The returned model is shared by every caller, in eval mode and without
+    gradients, and must be treated as read-only. Models loaded on CPU before
+    forking worker processes (e.g. a multiprocessing pool with the 'fork'
+    start method) are inherited by them: load_sam returns them without
+    loading, and their weights stay shared copy-on-write across processes.
+
+    Arguments:
+      sam_type (str): The key of the model in sam_model_registry.
+      checkpoint (str or None): The path of the checkpoint.
+      device (str or torch.device): The device to load the weights to.
+      precision (str): 'fp32', 'bf16' or 'fp16'.
+      **kwargs: Other arguments of the builder, e.g. attn_backend or
+        image_size.
+
+    Returns:
+      (Sam): The shared model.
+    """
+    device = torch.device(device)
+    key = (
+        sam_type,
+        os.path.realpath(checkpoint) if checkpoint is not None else None,
+        str(device),
+        precision,
+        tuple(sorted(kwargs.items())),
+    )
+    if key not in _loaded_models:
+        sam = sam_model_registry[sam_type](
+            checkpoint=checkpoint, precision=precision, device=device, **kwargs
+        )
+        sam.eval()
+        sam.requires_grad_(False)
+        _loaded_models[key] = sam
+    return _loaded_models[key]
+
+
 def _build_sam(
     encoder_embed_dim,
     encoder_depth,
     encoder_num_heads,
     encoder_global_attn_indexes,
     checkpoint=None,
+    precision="fp32",
+    attn_backend="math",
+    attn_chunk_size=1024,
+    image_size=1024,
+    device=None,
 ):
     prompt_embed_dim = 256
-    image_size = 1024
     vit_patch_size = 16
     image_embedding_size = image_size // vit_patch_size
-    sam = Sam(
-        image_encoder=ImageEncoderViT(
+    # The image encoder holds nearly all the weights. When they come from a
+    # checkpoint, it is built on the meta device and the loaded tensors are
+    # assigned to it, instead of allocating and initializing it first.
+    with torch.device("meta") if checkpoint is not None else contextlib.nullcontext():
+        image_encoder = ImageEncoderViT(
             depth=encoder_depth,
             embed_dim=encoder_embed_dim,
             img_size=image_size,
@@ -125,7 +236,11 @@ def _build_sam(
             global_attn_indexes=encoder_global_attn_indexes,
             window_size=14,
             out_chans=prompt_embed_dim,
-        ),
+            attn_backend=attn_backend,
+            attn_chunk_size=attn_chunk_size,
+        )
+    sam = Sam(
+        image_encoder=image_encoder,
         prompt_encoder=PromptEncoder(
             embed_dim=prompt_embed_dim,
             image_embedding_size=(image_embedding_size, image_embedding_size),
@@ -148,8 +263,69 @@ def _build_sam(
         pixel_std=[58.395, 57.12, 57.375],
     )
     sam.eval()
-    if checkpoint is not None:
+    _load_checkpoint(sam, checkpoint, precision, device)
+    return _set_precision(sam, precision, device)
+
+
+def _load_checkpoint(sam, checkpoint, precision, device=None):
+    if checkpoint is None:
+        return
+    try:
+        # Memory-mapped, the weights are read from disk straight to 'device'
+        # and, on CPU, share the page cache instead of being copied
+        state_dict = torch.load(checkpoint, map_location=device, mmap=True)
+    except RuntimeError:
+        # Checkpoints in the legacy (non-zip) format cannot be memory-mapped
         with open(checkpoint, "rb") as f:
-            state_dict = torch.load(f)
-        sam.load_state_dict(state_dict)
+            state_dict = torch.load(f, map_location=device)
+    if is_quantized_checkpoint(state_dict):
+        # Checkpoints written by save_quantized hold int8 linear layers
+        assert precision == "fp32", "Quantized checkpoints can only be loaded in fp32."
+        if any(p.is_meta for p in sam.image_encoder.parameters()):
+            sam.image_encoder.to_empty(device="cpu")
+        quantize_sam(sam, state_dict["quantization"]["modules"])
+        sam.load_state_dict(_resize_pos_embeddings(sam, state_dict["model"]))
+    else:
+        sam.load_state_dict(_resize_pos_embeddings(sam, state_dict), assign=True)
+
+
+def _resize_pos_embeddings(sam, state_dict):
+    """
+    Interpolates the absolute and global relative position embeddings of the
+    image encoder to the image size of the model, so that checkpoints trained
+    at 1024 px load at other input sizes. TinyViT only has attention biases
+    over fixed-size windows, which do not depend on the image size.
+    """
+    model_state = sam.state_dict()
+    for name, value in state_dict.items():
+        if not name.endswith(("pos_embed", "rel_pos_h", "rel_pos_w")) or name not in model_state:
+            continue
+        target = model_state[name]
+        if value.shape == target.shape:
+            continue
+        if name.endswith("pos_embed"):
+            # 1 x H x W x C
+            value = F.interpolate(
+                value.permute(0, 3, 1, 2).float(), size=target.shape[1:3], mode="bicubic", align_corners=False
+            ).permute(0, 2, 3, 1)
+        else:
+            # L x C, as in get_rel_pos
+            value = F.interpolate(value.t().unsqueeze(0).float(), size=target.shape[0], mode="linear")
+            value = value.squeeze(0).t()
+        state_dict[name] = value.to(target.dtype)
+    return state_dict
+
+
+def _set_precision(sam, precision, device=None):
+    """
+    Casts the model weights to 'fp32', 'bf16' or 'fp16', and moves them to
+    'device' if given. Reduced precision models run under Sam.autocast(),
+    with the normalization layers, the relative position terms and the
+    attention softmax kept in fp32.
+    """
+    assert precision in precision_dtypes, f"precision must be in {list(precision_dtypes)}, is {precision}."
+    sam.to(device=device, dtype=precision_dtypes[precision])
+    for module in sam.modules():
+        if isinstance(module, (torch.nn.LayerNorm, torch.nn.BatchNorm2d, LayerNorm2d, TinyLayerNorm2d)):
+            module.float()
     return sam
@@ -0,0 +1,264 @@
+# --------------------------------------------------------
+# PersonalizeSAM -- Personalize Segment Anything Model with One Shot
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+from .predictor import SamPredictor
+from .utils.transforms import ResizeLongestSide
+
+CONCEPT_FORMAT_VERSION = 1
+
+
+class Concept:
+    """
+    A personalized target: everything PerSAM and PerSAM-F derive from the
+    reference image and mask, so that new images can be segmented without
+    the reference. Concepts are stored as compressed .npz files, which are
+    a few KB and load without pickle.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        target_feat: torch.Tensor,
+        target_embedding: torch.Tensor,
+        max_weight: float = 0.0,
+        mask_weights: Optional[torch.Tensor] = None,
+        model_id: Optional[str] = None,
+        thumbnail: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        Arguments:
+          name (str): The name of the concept.
+          target_feat (torch.Tensor): The L2-normalized target feature used
+            for the location prior, with shape 1xC.
+          target_embedding (torch.Tensor): The mean target embedding used for
+            target-semantic prompting, with shape 1x1xC.
+          max_weight (float): The weight of the max-pooled reference feature
+            in target_feat, the rest being the mean. 0 for PerSAM, 0.5 for
+            PerSAM-F.
+          mask_weights (torch.Tensor or None): The learned PerSAM-F weights
+            of the three-scale masks, with shape 3x1.
+          model_id (str or None): Identifies the model the features were
+            computed with, see sam_model_id. Features of different models
+            are not comparable.
+          thumbnail (np.ndarray or None): A small thumbnail of the reference
+            in HWC uint8 RGBA format, whose alpha channel is the mask.
+        """
+        self.name = name
+        self.target_feat = target_feat
+        self.target_embedding = target_embedding
+        self.max_weight = max_weight
+        self.mask_weights = mask_weights
+        self.model_id = model_id
+        self.thumbnail = thumbnail
+
+    @classmethod
+    @torch.no_grad()
+    def from_reference(
+        cls,
+        predictor: SamPredictor,
+        ref_image: np.ndarray,
+        ref_mask: np.ndarray,
+        name: str = "",
+        max_weight: float = 0.0,
+        model_id: Optional[str] = None,
+        thumbnail_size: int = 128,
+        cal_image: bool = True,
+    ) -> "Concept":
+        """
+        Builds a concept from a reference image and its mask, both in HWC
+        uint8 format. This encodes the reference image with the predictor,
+        which keeps it set afterwards.
+
+        Arguments:
+          predictor (SamPredictor): The predictor to encode the reference with.
+          ref_image (np.ndarray): The reference image.
+          ref_mask (np.ndarray): The reference mask, foreground where its
+            first channel is positive.
+          name (str): The name of the concept.
+          max_weight (float): The weight of the max-pooled feature in the
+            target feature.
+          model_id (str or None): The identity of the predictor's model.
+          thumbnail_size (int): The long side of the stored thumbnail.
+          cal_image (bool): If false, the reference image is assumed to be
+            already set in the predictor and is not encoded again.
+
+        Returns:
+          (Concept): The concept, on the predictor's device.
+        """
+        ref_mask_torch = predictor.set_image(ref_image, ref_mask, cal_image=cal_image)
+        ref_feat = predictor.features.squeeze().permute(1, 2, 0)
+
+        ref_mask_torch = F.interpolate(ref_mask_torch, size=ref_feat.shape[0:2], mode="bilinear")
+        ref_mask_torch = ref_mask_torch.squeeze()[0]
+
+        # Target feature extraction
+        target_feat = ref_feat[ref_mask_torch > 0]
+        if target_feat.shape[0] == 0:
+            raise ValueError(f"The reference mask of '{name}' covers no cell of the image embedding.")
+        target_feat_mean = target_feat.mean(0)
+        target_feat_max = torch.max(target_feat, dim=0)[0]
+        target_embedding = target_feat_mean.reshape(1, 1, -1)
+        target_feat = (max_weight * target_feat_max + (1 - max_weight) * target_feat_mean).unsqueeze(0)
+        target_feat = target_feat / target_feat.norm(dim=-1, keepdim=True)
+
+        transform = ResizeLongestSide(thumbnail_size)
+        thumbnail = np.concatenate(
+            [
+                transform.apply_image(ref_image[..., :3]),
+                255 * (transform.apply_image(ref_mask)[..., :1] > 0).astype(np.uint8),
+            ],
+            axis=-1,
+        )
+        return cls(name, target_feat, target_embedding, max_weight, None, model_id, thumbnail)
+
+    def to(self, device: Any) -> "Concept":
+        """Returns a copy of the concept with its tensors on 'device'."""
+        mask_weights = self.mask_weights.to(device) if self.mask_weights is not None else None
+        return Concept(
+            self.name,
+            self.target_feat.to(device),
+            self.target_embedding.to(device),
+            self.max_weight,
+            mask_weights,
+            self.model_id,
+            self.thumbnail,
+        )
+
+    def save(self, path: str) -> None:
+        """Writes the concept to a .npz file, atomically."""
+        arrays: Dict[str, np.ndarray] = {
+            "target_feat": self.target_feat.detach().float().cpu().numpy(),
+            "target_embedding": self.target_embedding.detach().float().cpu().numpy(),
+        }
+        if self.mask_weights is not None:
+            arrays["mask_weights"] = self.mask_weights.detach().float().cpu().numpy()
+        if self.thumbnail is not None:
+            arrays["thumbnail"] = self.thumbnail
+        meta = {
+            "version": CONCEPT_FORMAT_VERSION,
+            "name": self.name,
+            "max_weight": self.max_weight,
+            "model_id": self.model_id,
+        }
+        arrays["meta"] = np.array(json.dumps(meta))
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, device: Any = None) -> "Concept":
+        """Reads a concept written by 'save', with its tensors on 'device'."""
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["version"] > CONCEPT_FORMAT_VERSION:
+                raise ValueError(f"{path} has concept format {meta['version']}, newer than this version.")
+            mask_weights = None
+            if "mask_weights" in data:
+                mask_weights = torch.from_numpy(data["mask_weights"]).to(device)
+            return cls(
+                meta["name"],
+                torch.from_numpy(data["target_feat"]).to(device),
+                torch.from_numpy(data["target_embedding"]).to(device),
+                meta["max_weight"],
+                mask_weights,
+                meta["model_id"],
+                data["thumbnail"] if "thumbnail" in data else None,
+            )
+
+
+class ConceptLibrary:
+    """
+    A directory of concept files with an 'index.json', which maps each
+    concept name to its file and summary, so that a library can be listed
+    without loading every concept.
+    """
+
+    def __init__(self, root: str) -> None:
+        """
+        Arguments:
+          root (str): The directory of the library. It is created if it does
+            not exist.
+        """
+        self.root = root
+        self.index_path = os.path.join(root, "index.json")
+        os.makedirs(root, exist_ok=True)
+
+    def names(self) -> List[str]:
+        return sorted(self._read_index())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._read_index()
+
+    def summary(self, name: str) -> Dict[str, Any]:
+        """Returns the index entry of a concept, without loading it."""
+        return self._read_index()[name]
+
+    def load(self, name: str, device: Any = None, model_id: Optional[str] = None) -> Concept:
+        """
+        Loads a concept by name. If 'model_id' is given, raises a ValueError
+        if the concept was computed with a different model.
+        """
+        entry = self._read_index()[name]
+        if model_id is not None and entry["model_id"] not in [None, model_id]:
+            raise ValueError(f"Concept '{name}' was computed with {entry['model_id']}, not {model_id}.")
+        return Concept.load(os.path.join(self.root, entry["file"]), device=device)
+
+    def add(self, concept: Concept) -> str:
+        """Saves a concept into the library, replacing one of the same name."""
+        index = self._read_index()
+        file_name = index.get(concept.name, {}).get("file") or self._file_name(concept.name, index)
+        path = os.path.join(self.root, file_name)
+        concept.save(path)
+
+        index = self._read_index()
+        index[concept.name] = {
+            "file": file_name,
+            "model_id": concept.model_id,
+            "max_weight": concept.max_weight,
+            "mask_weights": concept.mask_weights is not None,
+        }
+        self._write_index(index)
+        return path
+
+    def remove(self, name: str) -> None:
+        index = self._read_index()
+        entry = index.pop(name)
+        self._write_index(index)
+        try:
+            os.remove(os.path.join(self.root, entry["file"]))
+        except FileNotFoundError:
+            pass
+
+    def _file_name(self, name: str, index: Dict[str, Any]) -> str:
+        base = re.sub(r"[^\w.-]", "_", name) or "concept"
+        used = {entry["file"] for entry in index.values()}
+        file_name, i = f"{base}.npz", 1
+        while file_name in used:
+            file_name, i = f"{base}-{i}.npz", i + 1
+        return file_name
+
+    def _read_index(self) -> Dict[str, Any]:
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_index(self, index: Dict[str, Any]) -> None:
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
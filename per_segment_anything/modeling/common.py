@@ -36,8 +36,11 @@ class LayerNorm2d(nn.Module):
         self.eps = eps
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # Normalize in fp32, also for reduced precision models
+        dtype = x.dtype
+        x = x.float()
         u = x.mean(1, keepdim=True)
         s = (x - u).pow(2).mean(1, keepdim=True)
         x = (x - u) / torch.sqrt(s + self.eps)
-        x = self.weight[:, None, None] * x + self.bias[:, None, None]
-        return x
+        x = self.weight.float()[:, None, None] * x + self.bias.float()[:, None, None]
+        return x.to(dtype)
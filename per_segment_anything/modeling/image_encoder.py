@@ -33,6 +33,8 @@ class ImageEncoderViT(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         global_attn_indexes: Tuple[int, ...] = (),
+        attn_backend: str = "math",
+        attn_chunk_size: int = 1024,
     ) -> None:
         """
         Args:
@@ -51,6 +53,8 @@ class ImageEncoderViT(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             window_size (int): Window size for window attention blocks.
             global_attn_indexes (list): Indexes for blocks using global attention.
+            attn_backend (str): How attention is computed, see Attention.
+            attn_chunk_size (int): Query rows per step of the 'chunked' backend, see Attention.
         """
         super().__init__()
         self.img_size = img_size
@@ -82,6 +86,8 @@ class ImageEncoderViT(nn.Module):
                 rel_pos_zero_init=rel_pos_zero_init,
                 window_size=window_size if i not in global_attn_indexes else 0,
                 input_size=(img_size // patch_size, img_size // patch_size),
+                attn_backend=attn_backend,
+                attn_chunk_size=attn_chunk_size,
             )
             self.blocks.append(block)
 
@@ -131,6 +137,8 @@ class Block(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         input_size: Optional[Tuple[int, int]] = None,
+        attn_backend: str = "math",
+        attn_chunk_size: int = 1024,
     ) -> None:
         """
         Args:
@@ -146,6 +154,8 @@ class Block(nn.Module):
                 use global attention.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            attn_backend (str): How attention is computed, see Attention.
+            attn_chunk_size (int): Query rows per step of the 'chunked' backend, see Attention.
         """
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -156,6 +166,8 @@ class Block(nn.Module):
             use_rel_pos=use_rel_pos,
             rel_pos_zero_init=rel_pos_zero_init,
             input_size=input_size if window_size == 0 else (window_size, window_size),
+            attn_backend=attn_backend,
+            attn_chunk_size=attn_chunk_size,
         )
 
         self.norm2 = norm_layer(dim)
@@ -193,6 +205,8 @@ class Attention(nn.Module):
         use_rel_pos: bool = False,
         rel_pos_zero_init: bool = True,
         input_size: Optional[Tuple[int, int]] = None,
+        attn_backend: str = "math",
+        attn_chunk_size: int = 1024,
     ) -> None:
         """
         Args:
@@ -203,8 +217,24 @@ class Attention(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            attn_backend (str): 'math' materializes the full attention matrix. 'sdpa' uses
+                F.scaled_dot_product_attention, with the relative positional terms folded into
+                the query-key product, so that fused kernels never build the matrix. 'chunked'
+                materializes it for attn_chunk_size query rows at a time.
+            attn_chunk_size (int): The number of query rows, over all windows and heads, whose
+                attention is computed at once by the 'chunked' backend. The fp32 attention
+                scores then never exceed attn_chunk_size x K elements, K being the number of
+                keys (H * W for global blocks, window_size**2 for window blocks), e.g. 16 MB
+                per buffer with the default 1024 rows for the global blocks of a 1024 px image.
         """
         super().__init__()
+        assert attn_backend in [
+            "math",
+            "sdpa",
+            "chunked",
+        ], f"attn_backend must be in ['math', 'sdpa', 'chunked'], is {attn_backend}."
+        self.attn_backend = attn_backend
+        self.attn_chunk_size = attn_chunk_size
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = head_dim**-0.5
@@ -228,17 +258,76 @@ class Attention(nn.Module):
         # q, k, v with shape (B * nHead, H * W, C)
         q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
 
-        attn = (q * self.scale) @ k.transpose(-2, -1)
-
-        if self.use_rel_pos:
-            attn = add_decomposed_rel_pos(attn, q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
-
-        attn = attn.softmax(dim=-1)
-        x = (attn @ v).view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+        if self.attn_backend == "sdpa":
+            x = self._sdpa_attention(q, k, v, (H, W))
+        elif self.attn_backend == "chunked":
+            x = self._chunked_attention(q, k, v, (H, W))
+        else:
+            attn = (q * self.scale) @ k.transpose(-2, -1)
+
+            # Relative positions and softmax are computed in fp32
+            with torch.autocast(x.device.type, enabled=False):
+                attn = attn.float()
+                if self.use_rel_pos:
+                    attn = add_decomposed_rel_pos(
+                        attn, q.float(), self.rel_pos_h.float(), self.rel_pos_w.float(), (H, W), (H, W)
+                    )
+                attn = attn.softmax(dim=-1)
+            attn = attn.to(v.dtype)
+            x = attn @ v
+
+        x = x.view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
         x = self.proj(x)
 
         return x
 
+    def _sdpa_attention(
+        self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, size: Tuple[int, int]
+    ) -> torch.Tensor:
+        if not self.use_rel_pos:
+            return F.scaled_dot_product_attention(q, k, v, scale=self.scale)
+        q, k = fold_decomposed_rel_pos(q, k, self.scale, self.rel_pos_h, self.rel_pos_w, size, size)
+        # Fused kernels need the same head dim for the query, key and value
+        dim = v.shape[-1]
+        v = F.pad(v, (0, q.shape[-1] - dim))
+        return F.scaled_dot_product_attention(q, k, v, scale=1.0)[..., :dim]
+
+    def _chunked_attention(
+        self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, size: Tuple[int, int]
+    ) -> torch.Tensor:
+        # Whole windows or heads are grouped while they fit in attn_chunk_size rows,
+        # longer sequences are split along the queries.
+        BH, L, _ = q.shape
+        batch_chunk = max(1, self.attn_chunk_size // L)
+        query_chunk = min(L, self.attn_chunk_size)
+
+        out = torch.empty_like(v)
+        for b_start in range(0, BH, batch_chunk):
+            b_end = b_start + batch_chunk
+            if self.use_rel_pos:
+                with torch.autocast(q.device.type, enabled=False):
+                    rel_h, rel_w = get_decomposed_rel_pos(
+                        q[b_start:b_end].float(), self.rel_pos_h.float(), self.rel_pos_w.float(), size, size
+                    )
+
+            for start in range(0, L, query_chunk):
+                end = start + query_chunk
+                attn = (q[b_start:b_end, start:end] * self.scale) @ k[b_start:b_end].transpose(-2, -1)
+
+                # Relative positions and softmax are computed in fp32
+                with torch.autocast(q.device.type, enabled=False):
+                    attn = attn.float()
+                    if self.use_rel_pos:
+                        B, Lq, _ = attn.shape
+                        attn = (
+                            attn.view(B, Lq, size[0], size[1])
+                            + rel_h[:, start:end, :, None]
+                            + rel_w[:, start:end, None, :]
+                        ).view(B, Lq, -1)
+                    attn = attn.softmax(dim=-1)
+                out[b_start:b_end, start:end] = attn.to(v.dtype) @ v[b_start:b_end]
+        return out
+
 
 def window_partition(x: torch.Tensor, window_size: int) -> Tuple[torch.Tensor, Tuple[int, int]]:
     """
@@ -361,6 +450,81 @@ def add_decomposed_rel_pos(
     return attn
 
 
+def get_decomposed_rel_pos(
+    q: torch.Tensor,
+    rel_pos_h: torch.Tensor,
+    rel_pos_w: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Calculate the height and width terms of decomposed Relative Positional Embeddings,
+    without adding them to an attention map.
+    Args:
+        q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
+        rel_pos_h (Tensor): relative position embeddings (Lh, C) for height axis.
+        rel_pos_w (Tensor): relative position embeddings (Lw, C) for width axis.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+
+    Returns:
+        rel_h (Tensor): height terms with shape (B, q_h * q_w, k_h).
+        rel_w (Tensor): width terms with shape (B, q_h * q_w, k_w).
+    """
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+    Rh = get_rel_pos(q_h, k_h, rel_pos_h)
+    Rw = get_rel_pos(q_w, k_w, rel_pos_w)
+
+    B, _, dim = q.shape
+    r_q = q.reshape(B, q_h, q_w, dim)
+    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh).reshape(B, q_h * q_w, k_h)
+    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw).reshape(B, q_h * q_w, k_w)
+    return rel_h, rel_w
+
+
+def fold_decomposed_rel_pos(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    scale: float,
+    rel_pos_h: torch.Tensor,
+    rel_pos_w: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Fold decomposed Relative Positional Embeddings into the query and key, such that
+    q_out @ k_out^T equals the scaled attention map with the relative positional terms
+    added. The query is extended with the (k_h + k_w) height and width terms, and the key
+    with one-hot encodings of its row and column, so attention kernels can apply the
+    bias without it ever being materialized at (q_h * q_w, k_h * k_w).
+    Args:
+        q (Tensor): query q with shape (B, q_h * q_w, C).
+        k (Tensor): key k with shape (B, k_h * k_w, C).
+        scale (float): attention scale applied to q @ k^T.
+        rel_pos_h (Tensor): relative position embeddings (Lh, C) for height axis.
+        rel_pos_w (Tensor): relative position embeddings (Lw, C) for width axis.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+
+    Returns:
+        q_out (Tensor): extended query with shape (B, q_h * q_w, C + k_h + k_w).
+        k_out (Tensor): extended key with shape (B, k_h * k_w, C + k_h + k_w).
+    """
+    k_h, k_w = k_size
+    with torch.autocast(q.device.type, enabled=False):
+        rel_h, rel_w = get_decomposed_rel_pos(
+            q.float(), rel_pos_h.float(), rel_pos_w.float(), q_size, k_size
+        )
+    eye_h = torch.eye(k_h, dtype=k.dtype, device=k.device).repeat_interleave(k_w, dim=0)
+    eye_w = torch.eye(k_w, dtype=k.dtype, device=k.device).repeat(k_h, 1)
+
+    B = q.shape[0]
+    q_out = torch.cat([q * scale, rel_h.to(q.dtype), rel_w.to(q.dtype)], dim=-1)
+    k_out = torch.cat([k, eye_h.expand(B, -1, -1), eye_w.expand(B, -1, -1)], dim=-1)
+    return q_out, k_out
+
+
 class PatchEmbed(nn.Module):
     """
     Image to Patch Embedding.
@@ -59,16 +59,57 @@ class PromptEncoder(nn.Module):
         )
         self.no_mask_embed = nn.Embedding(1, embed_dim)
 
+        # Prompt-independent inputs of the mask decoder, computed on first use
+        # and cleared when the weights are loaded, moved or cast
+        self._dense_pe: Optional[torch.Tensor] = None
+        self._no_mask_dense_embedding: Optional[torch.Tensor] = None
+
     def get_dense_pe(self) -> torch.Tensor:
         """
         Returns the positional encoding used to encode point prompts,
         applied to a dense set of points the shape of the image encoding.
+        It is computed once and cached.
 
         Returns:
           torch.Tensor: Positional encoding with shape
             1x(embed_dim)x(embedding_h)x(embedding_w)
         """
-        return self.pe_layer(self.image_embedding_size).unsqueeze(0)
+        if self._dense_pe is None:
+            with torch.no_grad(), torch.autocast(self._get_device().type, enabled=False):
+                self._dense_pe = self.pe_layer(self.image_embedding_size).unsqueeze(0)
+        return self._dense_pe
+
+    def get_no_mask_dense_embedding(self) -> torch.Tensor:
+        """
+        Returns the dense embedding used when no mask is given. It is cached,
+        unless the no-mask embedding is being trained.
+
+        Returns:
+          torch.Tensor: Dense embedding with shape
+            1x(embed_dim)x(embedding_h)x(embedding_w)
+        """
+        if torch.is_grad_enabled() and self.no_mask_embed.weight.requires_grad:
+            return self.no_mask_embed.weight.reshape(1, -1, 1, 1).expand(
+                1, -1, self.image_embedding_size[0], self.image_embedding_size[1]
+            )
+        if self._no_mask_dense_embedding is None:
+            self._no_mask_dense_embedding = self.no_mask_embed.weight.detach().reshape(1, -1, 1, 1).expand(
+                1, -1, self.image_embedding_size[0], self.image_embedding_size[1]
+            )
+        return self._no_mask_dense_embedding
+
+    def _clear_cache(self) -> None:
+        self._dense_pe = None
+        self._no_mask_dense_embedding = None
+
+    def _apply(self, *args, **kwargs):
+        # .to(), .cuda(), .half() etc. change the device or dtype of the constants
+        self._clear_cache()
+        return super()._apply(*args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._clear_cache()
+        super()._load_from_state_dict(*args, **kwargs)
 
     def _embed_points(
         self,
@@ -161,9 +202,7 @@ class PromptEncoder(nn.Module):
         if masks is not None:
             dense_embeddings = self._embed_masks(masks)
         else:
-            dense_embeddings = self.no_mask_embed.weight.reshape(1, -1, 1, 1).expand(
-                bs, -1, self.image_embedding_size[0], self.image_embedding_size[1]
-            )
+            dense_embeddings = self.get_no_mask_dense_embedding().expand(bs, -1, -1, -1)
 
         return sparse_embeddings, dense_embeddings
 
@@ -186,7 +225,8 @@ class PositionEmbeddingRandom(nn.Module):
         """Positionally encode points that are normalized to [0,1]."""
         # assuming coords are in [0, 1]^2 square and have d_1 x ... x d_n x 2 shape
         coords = 2 * coords - 1
-        coords = coords @ self.positional_encoding_gaussian_matrix
+        matrix = self.positional_encoding_gaussian_matrix
+        coords = coords.to(matrix.dtype) @ matrix
         coords = 2 * np.pi * coords
         # outputs d_1 x ... x d_n x C shape
         return torch.cat([torch.sin(coords), torch.cos(coords)], dim=-1)
@@ -8,7 +8,7 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, ContextManager, Dict, List, Tuple, Union
 from .tiny_vit_sam import TinyViT
 from .image_encoder import ImageEncoderViT
 from .mask_decoder import MaskDecoder
@@ -50,6 +50,20 @@ class Sam(nn.Module):
     def device(self) -> Any:
         return self.pixel_mean.device
 
+    @property
+    def dtype(self) -> torch.dtype:
+        """The dtype of the model weights, set by the precision it was built with."""
+        return self.mask_decoder.iou_token.weight.dtype
+
+    def autocast(self) -> ContextManager:
+        """
+        Returns a context in which the encoders and the decoder run at the
+        precision of the model weights. It is disabled for fp32 models.
+        """
+        return torch.autocast(
+            self.device.type, dtype=self.dtype, enabled=self.dtype != torch.float32
+        )
+
     @torch.no_grad()
     def forward(
         self,
@@ -95,7 +109,8 @@ class Sam(nn.Module):
                 to subsequent iterations of prediction.
         """
         input_images = torch.stack([self.preprocess(x["image"]) for x in batched_input], dim=0)
-        image_embeddings = self.image_encoder(input_images)
+        with self.autocast():
+            image_embeddings = self.image_encoder(input_images).float()
 
         outputs = []
         for image_record, curr_embedding in zip(batched_input, image_embeddings):
@@ -103,18 +118,20 @@ class Sam(nn.Module):
                 points = (image_record["point_coords"], image_record["point_labels"])
             else:
                 points = None
-            sparse_embeddings, dense_embeddings = self.prompt_encoder(
-                points=points,
-                boxes=image_record.get("boxes", None),
-                masks=image_record.get("mask_inputs", None),
-            )
-            low_res_masks, iou_predictions = self.mask_decoder(
-                image_embeddings=curr_embedding.unsqueeze(0),
-                image_pe=self.prompt_encoder.get_dense_pe(),
-                sparse_prompt_embeddings=sparse_embeddings,
-                dense_prompt_embeddings=dense_embeddings,
-                multimask_output=multimask_output,
-            )
+            with self.autocast():
+                sparse_embeddings, dense_embeddings = self.prompt_encoder(
+                    points=points,
+                    boxes=image_record.get("boxes", None),
+                    masks=image_record.get("mask_inputs", None),
+                )
+                low_res_masks, iou_predictions = self.mask_decoder(
+                    image_embeddings=curr_embedding.unsqueeze(0),
+                    image_pe=self.prompt_encoder.get_dense_pe(),
+                    sparse_prompt_embeddings=sparse_embeddings,
+                    dense_prompt_embeddings=dense_embeddings,
+                    multimask_output=multimask_output,
+                )
+            low_res_masks, iou_predictions = low_res_masks.float(), iou_predictions.float()
             masks = self.postprocess_masks(
                 low_res_masks,
                 input_size=image_record["image"].shape[-2:],
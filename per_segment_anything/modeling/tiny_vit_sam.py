@@ -255,6 +255,15 @@ class Attention(torch.nn.Module):
         else:
             self.ab = self.attention_biases[:, self.attention_bias_idxs]
 
+    @torch.no_grad()
+    def freeze_biases(self):
+        # Keep the bias table of eval mode as a buffer, so that it follows
+        # the module across devices and dtypes
+        ab = self.attention_biases[:, self.attention_bias_idxs]
+        if hasattr(self, 'ab'):
+            del self.ab
+        self.register_buffer('ab', ab, persistent=False)
+
     def forward(self, x):  # x (B,N,C)
         B, N, _ = x.shape
 
@@ -276,7 +285,7 @@ class Attention(torch.nn.Module):
             (self.attention_biases[:, self.attention_bias_idxs]
              if self.training else self.ab)
         )
-        attn = attn.softmax(dim=-1)
+        attn = attn.float().softmax(dim=-1).to(v.dtype)
         x = (attn @ v).transpose(1, 2).reshape(B, N, self.dh)
         x = self.proj(x)
         return x
@@ -452,11 +461,14 @@ class LayerNorm2d(nn.Module):
         self.eps = eps
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # Normalize in fp32, also for reduced precision models
+        dtype = x.dtype
+        x = x.float()
         u = x.mean(1, keepdim=True)
         s = (x - u).pow(2).mean(1, keepdim=True)
         x = (x - u) / torch.sqrt(s + self.eps)
-        x = self.weight[:, None, None] * x + self.bias[:, None, None]
-        return x
+        x = self.weight.float()[:, None, None] * x + self.bias.float()[:, None, None]
+        return x.to(dtype)
 class TinyViT(nn.Module):
     def __init__(self, img_size=224, in_chans=3, num_classes=1000,
                  embed_dims=[96, 192, 384, 768], depths=[2, 2, 6, 2],
@@ -476,6 +488,8 @@ class TinyViT(nn.Module):
         self.depths = depths
         self.num_layers = len(depths)
         self.mlp_ratio = mlp_ratio
+        # Set by optimize_for_inference
+        self.inference_optimized = False
 
         activation = nn.GELU
 
@@ -595,6 +609,27 @@ class TinyViT(nn.Module):
     def no_weight_decay_keywords(self):
         return {'attention_biases'}
 
+    @torch.no_grad()
+    def optimize_for_inference(self):
+        # Folds every BatchNorm into its conv, caches the attention bias
+        # tables as buffers and replaces DropPath, Dropout and the unused
+        # classification head with identities. The model can no longer be
+        # trained or load checkpoints afterwards.
+        self.eval()
+        for name, module in list(self.named_modules()):
+            parent_name, _, child_name = name.rpartition('.')
+            parent = self.get_submodule(parent_name)
+            if isinstance(module, Conv2d_BN):
+                setattr(parent, child_name, module.fuse().to(module.c.weight.device))
+            elif isinstance(module, (DropPath, nn.Dropout)):
+                setattr(parent, child_name, nn.Identity())
+            elif isinstance(module, Attention):
+                module.freeze_biases()
+        self.norm_head = nn.Identity()
+        self.head = nn.Identity()
+        self.inference_optimized = True
+        return self
+
     def forward_features(self, x):
         # x: (N, C, H, W)
         x = self.patch_embed(x)
@@ -606,7 +641,8 @@ class TinyViT(nn.Module):
             layer = self.layers[i]
             x = layer(x)
         B,_,C=x.size()
-        x = x.view(B, 64, 64, C)
+        H, W = self.layers[-1].input_resolution  # img_size // 16
+        x = x.view(B, H, W, C)
         x=x.permute(0, 3, 1, 2)
         x=self.neck(x)
         return x
@@ -70,9 +70,10 @@ class TwoWayTransformer(nn.Module):
         """
         Args:
           image_embedding (torch.Tensor): image to attend to. Should be shape
-            B x embedding_dim x h x w for any h and w.
+            B x embedding_dim x h x w for any h and w, or 1 x embedding_dim x h x w
+            to share it across the batch without copying it.
           image_pe (torch.Tensor): the positional encoding to add to the image. Must
-            have the same shape as image_embedding.
+            have the shape of image_embedding, or a batch size of 1.
           point_embedding (torch.Tensor): the embedding to add to the query points.
             Must have shape B x N_points x embedding_dim for any N_points.
 
@@ -235,18 +236,51 @@ class Attention(nn.Module):
         v = self._separate_heads(v, self.num_heads)
 
         # Attention
-        _, _, _, c_per_head = q.shape
-        attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
-        attn = attn / math.sqrt(c_per_head)
-        attn = torch.softmax(attn, dim=-1)
+        if k.shape[0] == 1 and q.shape[0] > 1:
+            out = self._attend_shared_keys(q, k, v, attn_sim)
+        elif q.shape[0] == 1 and k.shape[0] > 1:
+            out = self._attend_shared_queries(q, k, v)
+        else:
+            _, _, _, c_per_head = q.shape
+            attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
+            attn = attn / math.sqrt(c_per_head)
+            attn = torch.softmax(attn.float(), dim=-1)
 
-        if attn_sim is not None:
-            attn = attn + attn_sim
-            attn = torch.softmax(attn, dim=-1)
+            if attn_sim is not None:
+                attn = attn + attn_sim
+                attn = torch.softmax(attn, dim=-1)
 
-        # Get output
-        out = attn @ v
+            # Get output
+            out = attn.to(v.dtype) @ v
         out = self._recombine_heads(out)
         out = self.out_proj(out)
 
         return out
+
+    def _attend_shared_keys(self, q: Tensor, k: Tensor, v: Tensor, attn_sim: Tensor = None) -> Tensor:
+        # B queries attend to the same keys and values: the queries of the batch
+        # are folded into one sequence instead of copying the keys B times.
+        b, n_heads, n_q, c_per_head = q.shape
+        q = q.transpose(0, 1).reshape(n_heads, b * n_q, c_per_head)
+        attn = q @ k[0].transpose(1, 2)  # N_heads x B*N_q_tokens x N_k_tokens
+        attn = attn / math.sqrt(c_per_head)
+        attn = torch.softmax(attn.float(), dim=-1)
+
+        if attn_sim is not None:
+            attn = attn.view(n_heads, b, n_q, -1) + attn_sim.transpose(0, 1)
+            attn = torch.softmax(attn, dim=-1).view(n_heads, b * n_q, -1)
+
+        out = attn.to(v.dtype) @ v[0]  # N_heads x B*N_q_tokens x C_per_head
+        return out.view(n_heads, b, n_q, c_per_head).transpose(0, 1)
+
+    def _attend_shared_queries(self, q: Tensor, k: Tensor, v: Tensor) -> Tensor:
+        # The same queries attend to B sets of keys: the keys are folded into one
+        # sequence, so that the queries are not copied B times.
+        b, n_heads, n_k, c_per_head = k.shape
+        k = k.transpose(0, 1).reshape(n_heads, b * n_k, c_per_head)
+        attn = k @ q[0].transpose(1, 2)  # N_heads x B*N_k_tokens x N_q_tokens
+        attn = attn / math.sqrt(c_per_head)
+        attn = torch.softmax(attn.float().view(n_heads, b, n_k, -1), dim=2)
+
+        out = attn.permute(1, 0, 3, 2).to(v.dtype) @ v  # B x N_heads x N_q_tokens x C_per_head
+        return out
@@ -0,0 +1,622 @@
+# --------------------------------------------------------
+# PersonalizeSAM -- Personalize Segment Anything Model with One Shot
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+from torchvision.ops.boxes import batched_nms  # type: ignore
+
+import math
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Union
+
+from .concept import Concept
+from .predictor import ImageState, SamPredictor
+from .utils.amg import batched_mask_to_box
+
+
+class PerSAMEngine:
+    def __init__(
+        self,
+        predictor: SamPredictor,
+        target_feat: torch.Tensor,
+        target_embedding: torch.Tensor,
+        topk: int = 1,
+        low_res_prior: bool = False,
+        subpixel: bool = False,
+    ) -> None:
+        """
+        Runs the training-free PerSAM cascade (location prior, target-guided
+        first step, cascaded post-refinement 1 and 2) on images encoded by a
+        SamPredictor. Every stage stays in torch on the model's device, and
+        only the final mask is copied to the host.
+
+        Arguments:
+          predictor (SamPredictor): The predictor the test images are
+            encoded with.
+          target_feat (torch.Tensor): The L2-normalized target feature, with
+            shape 1xC.
+          target_embedding (torch.Tensor): The mean target embedding used for
+            target-semantic prompting, with shape 1x1xC.
+          topk (int): The number of positive and negative points selected
+            from the location prior.
+          low_res_prior (bool): If true, the points are selected on the
+            embedding-resolution similarity map and mapped analytically to
+            original pixels, instead of on a map upsampled to the original
+            image size.
+          subpixel (bool): If true and low_res_prior is set, each point is
+            refined with a parabolic fit over its 3x3 neighbourhood.
+        """
+        self.predictor = predictor
+        self.target_feat = target_feat
+        self.target_embedding = target_embedding
+        self.topk = topk
+        self.low_res_prior = low_res_prior
+        self.subpixel = subpixel
+
+    @classmethod
+    def from_reference(
+        cls,
+        predictor: SamPredictor,
+        ref_image: np.ndarray,
+        ref_mask: np.ndarray,
+        **kwargs: Any,
+    ) -> "PerSAMEngine":
+        """
+        Builds the engine from a reference image and its mask, both in HWC
+        uint8 format. This encodes the reference image with the predictor.
+        Remaining keyword arguments are passed to the constructor.
+        """
+        return cls.from_concept(predictor, Concept.from_reference(predictor, ref_image, ref_mask), **kwargs)
+
+    @classmethod
+    def from_concept(
+        cls,
+        predictor: SamPredictor,
+        concept: Concept,
+        **kwargs: Any,
+    ) -> "PerSAMEngine":
+        """
+        Builds the engine from a concept, without encoding any reference
+        image. Remaining keyword arguments are passed to the constructor.
+        """
+        concept = concept.to(predictor.device)
+        return cls(predictor, concept.target_feat, concept.target_embedding, **kwargs)
+
+    @torch.no_grad()
+    def location_prior(
+        self, image_state: Optional[Union[ImageState, Hashable]] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Computes the positive-negative location prior and the target guidance
+        for the cross-attention layers.
+
+        Returns:
+          (torch.Tensor): The point prompts, with shape Nx2 in (X, Y) pixels of
+            the original image, positive points first.
+          (torch.Tensor): The point labels, with shape N.
+          (torch.Tensor): The target-guided attention map, with shape
+            1x1x1x(embedding_h * embedding_w).
+        """
+        state = self.predictor._get_state(image_state)
+        test_feat = state.features.squeeze()
+
+        # Cosine similarity
+        C, h, w = test_feat.shape
+        test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
+        test_feat = test_feat.reshape(C, h * w)
+        sim = self.target_feat @ test_feat
+
+        if self.low_res_prior:
+            # Positive-negative location prior on the embedding grid
+            sim = sim.reshape(h, w)
+            point_coords, point_labels = low_res_point_selection(
+                sim,
+                state.input_size,
+                state.original_size,
+                self.predictor.model.image_encoder.img_size,
+                topk=self.topk,
+                subpixel=self.subpixel,
+            )
+
+            # Obtain the target guidance from the unpadded part of the grid
+            valid_h, valid_w = _valid_grid_size(
+                (h, w), state.input_size, self.predictor.model.image_encoder.img_size
+            )
+            sim = sim[:valid_h, :valid_w]
+            sim = (sim - sim.mean()) / torch.std(sim)
+            sim = F.interpolate(sim.unsqueeze(0).unsqueeze(0), size=(h, w), mode="bilinear")
+            attn_sim = sim.sigmoid_().unsqueeze(0).flatten(3)
+            return point_coords, point_labels, attn_sim
+
+        sim = sim.reshape(1, 1, h, w)
+        sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
+        sim = self.predictor.model.postprocess_masks(
+            sim, input_size=state.input_size, original_size=state.original_size
+        ).squeeze()
+
+        # Positive-negative location prior
+        point_coords, point_labels = point_selection(sim, topk=self.topk)
+
+        # Obtain the target guidance for cross-attention layers
+        sim = (sim - sim.mean()) / torch.std(sim)
+        sim = F.interpolate(sim.unsqueeze(0).unsqueeze(0), size=(h, w), mode="bilinear")
+        attn_sim = sim.sigmoid_().unsqueeze(0).flatten(3)
+        return point_coords, point_labels, attn_sim
+
+    @torch.no_grad()
+    def segment(
+        self, image_state: Optional[Union[ImageState, Hashable]] = None
+    ) -> Dict[str, Any]:
+        """
+        Segments the target in an encoded image.
+
+        Arguments:
+          image_state (ImageState, hashable or None): The image to segment, as
+            a state or a key of the predictor's pool. Defaults to the image
+            currently set on the predictor.
+
+        Returns:
+          (dict): A dictionary with the following keys.
+            'mask': (np.ndarray) The binary mask in HxW format, where (H, W)
+              is the original image size.
+            'mask_index': (int) The index of the selected mask among the
+              three multimask outputs of the last stage.
+            'iou_prediction': (float) The model's predicted quality of the mask.
+            'point_coords': (np.ndarray) The Nx2 point prompts in (X, Y) pixels.
+            'point_labels': (np.ndarray) The length N point labels.
+        """
+        predictor = self.predictor
+        state = predictor._get_state(image_state)
+        point_coords, point_labels, attn_sim = self.location_prior(state)
+
+        coords_torch = predictor.transform.apply_coords_torch(point_coords, state.original_size)
+        coords_torch, labels_torch = coords_torch[None, :, :], point_labels[None, :]
+
+        # First-step prediction
+        masks, scores, logits, _ = predictor.predict_torch(
+            coords_torch,
+            labels_torch,
+            multimask_output=False,
+            attn_sim=attn_sim,  # Target-guided Attention
+            target_embedding=self.target_embedding,  # Target-semantic Prompting
+            image_state=state,
+        )
+        best_idx = 0
+
+        # Cascaded Post-refinement-1
+        masks, scores, logits, _ = predictor.predict_torch(
+            coords_torch,
+            labels_torch,
+            mask_input=logits[:, best_idx : best_idx + 1, :, :],
+            multimask_output=True,
+            image_state=state,
+        )
+        best_idx = int(scores[0].argmax())
+
+        # Cascaded Post-refinement-2
+        input_box = batched_mask_to_box(masks[0, best_idx])
+        box_torch = predictor.transform.apply_boxes_torch(input_box[None, :], state.original_size)
+        masks, scores, logits, _ = predictor.predict_torch(
+            coords_torch,
+            labels_torch,
+            boxes=box_torch,
+            mask_input=logits[:, best_idx : best_idx + 1, :, :],
+            multimask_output=True,
+            image_state=state,
+        )
+        best_idx = int(scores[0].argmax())
+
+        return {
+            "mask": masks[0, best_idx].cpu().numpy(),
+            "mask_index": best_idx,
+            "iou_prediction": float(scores[0, best_idx]),
+            "point_coords": point_coords.cpu().numpy(),
+            "point_labels": point_labels.cpu().numpy(),
+        }
+
+    @torch.no_grad()
+    def segment_batch(
+        self, image_states: List[Union[ImageState, Hashable]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Segments the target in several encoded images at once. Each stage of
+        the cascade runs a single mask decoder pass for all images, with
+        per-image prompts, target-guided attention and target embedding.
+
+        Arguments:
+          image_states (list(ImageState or hashable)): The images to segment,
+            as states or keys of the predictor's pool.
+
+        Returns:
+          (list(dict)): One result per image, in the format of 'segment'.
+        """
+        predictor = self.predictor
+        model = predictor.model
+        states = [predictor._get_state(image_state) for image_state in image_states]
+        priors = [self.location_prior(state) for state in states]
+
+        coords_torch = torch.stack(
+            [
+                predictor.transform.apply_coords_torch(point_coords, state.original_size)
+                for (point_coords, _, _), state in zip(priors, states)
+            ]
+        )
+        labels_torch = torch.stack([point_labels for _, point_labels, _ in priors])
+        attn_sim = torch.cat([attn_sim for _, _, attn_sim in priors], dim=0)
+        target_embedding = self.target_embedding.expand(len(states), -1, -1)
+        features = torch.cat([state.features for state in states], dim=0)
+        batch_idxs = torch.arange(len(states), device=features.device)
+
+        # First-step prediction
+        logits, scores = self._decode(
+            features,
+            coords_torch,
+            labels_torch,
+            multimask_output=False,
+            attn_sim=attn_sim,  # Target-guided Attention
+            target_embedding=target_embedding,  # Target-semantic Prompting
+        )
+        best_idx = torch.zeros_like(batch_idxs)
+
+        # Cascaded Post-refinement-1
+        logits, scores = self._decode(
+            features,
+            coords_torch,
+            labels_torch,
+            mask_input=logits[batch_idxs, best_idx][:, None],
+            multimask_output=True,
+        )
+        best_idx = scores.argmax(dim=1)
+        best_logits = logits[batch_idxs, best_idx][:, None]
+
+        # Cascaded Post-refinement-2
+        boxes = []
+        for i, state in enumerate(states):
+            mask = model.postprocess_masks(
+                best_logits[i : i + 1], state.input_size, state.original_size
+            )[0, 0] > model.mask_threshold
+            boxes.append(
+                predictor.transform.apply_boxes_torch(
+                    batched_mask_to_box(mask)[None, :], state.original_size
+                )
+            )
+        logits, scores = self._decode(
+            features,
+            coords_torch,
+            labels_torch,
+            boxes=torch.cat(boxes, dim=0),
+            mask_input=best_logits,
+            multimask_output=True,
+        )
+        best_idx = scores.argmax(dim=1)
+
+        results = []
+        for i, state in enumerate(states):
+            idx = int(best_idx[i])
+            mask = model.postprocess_masks(
+                logits[i : i + 1, idx : idx + 1], state.input_size, state.original_size
+            )[0, 0] > model.mask_threshold
+            point_coords, point_labels, _ = priors[i]
+            results.append(
+                {
+                    "mask": mask.cpu().numpy(),
+                    "mask_index": idx,
+                    "iou_prediction": float(scores[i, idx]),
+                    "point_coords": point_coords.cpu().numpy(),
+                    "point_labels": point_labels.cpu().numpy(),
+                }
+            )
+        return results
+
+    @torch.no_grad()
+    def propose_instances(
+        self,
+        image_state: Optional[Union[ImageState, Hashable]] = None,
+        num_peaks: int = 16,
+        peak_kernel: int = 3,
+        min_similarity: Optional[float] = None,
+        mask_weights: Optional[torch.Tensor] = None,
+        pred_iou_thresh: float = 0.0,
+        box_nms_thresh: float = 0.7,
+    ) -> List[Dict[str, Any]]:
+        """
+        Segments every instance of the target in an encoded image at once.
+        The local maxima of the similarity map on the embedding grid are
+        found with max-pool non-maximum suppression, the strongest ones are
+        decoded as single-point prompts in one batched pass per stage of the
+        cascade, and duplicate masks are removed with box NMS on their
+        predicted quality, as in SamAutomaticMaskGenerator.
+
+        Arguments:
+          image_state (ImageState, hashable or None): The image to segment, as
+            a state or a key of the predictor's pool. Defaults to the image
+            currently set on the predictor.
+          num_peaks (int): The maximum number of peaks, and so of instances.
+          peak_kernel (int): The side of the max-pool window, in grid cells,
+            within which a peak must be the maximum.
+          min_similarity (float or None): If given, peaks with a lower cosine
+            similarity to the target are discarded.
+          mask_weights (torch.Tensor or None): The learned PerSAM-F weights of
+            the three-scale masks, with shape 3x1. If given, the first step
+            takes their weighted sum and refinement-1 is also prompted with
+            the box of the weighted mask, as in persam_f.py. Else the first
+            step uses target-guided attention and target-semantic prompting
+            like 'segment'.
+          pred_iou_thresh (float): Instances whose predicted mask quality is
+            lower are discarded.
+          box_nms_thresh (float): The box IoU cutoff used by non-maximal
+            suppression to filter duplicate instances.
+
+        Returns:
+          (list(dict)): One result per instance, in the format of 'segment',
+            in decreasing order of 'iou_prediction'.
+        """
+        predictor = self.predictor
+        model = predictor.model
+        state = predictor._get_state(image_state)
+        img_size = model.image_encoder.img_size
+
+        # Cosine similarity on the unpadded part of the embedding grid
+        test_feat = state.features.squeeze()
+        C, h, w = test_feat.shape
+        test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
+        sim = (self.target_feat @ test_feat.reshape(C, h * w)).reshape(h, w)
+        valid_h, valid_w = _valid_grid_size((h, w), state.input_size, img_size)
+        valid_sim = sim[:valid_h, :valid_w].float()
+
+        # Local maxima are the cells equal to the maximum of their window
+        pooled = F.max_pool2d(valid_sim[None, None], peak_kernel, stride=1, padding=peak_kernel // 2)[0, 0]
+        peak_sim = valid_sim.masked_fill(valid_sim < pooled, float("-inf"))
+        if min_similarity is not None:
+            peak_sim = peak_sim.masked_fill(valid_sim < min_similarity, float("-inf"))
+        peak_sim, idxs = peak_sim.flatten().topk(min(num_peaks, peak_sim.numel()))
+        idxs = idxs[peak_sim > float("-inf")]
+        if len(idxs) == 0:
+            return []
+        point_coords = torch.stack([idxs % valid_w, idxs // valid_w], dim=-1).float()
+        point_coords = _grid_to_original(point_coords, w, state.input_size, state.original_size, img_size)
+
+        # One single-point prompt per peak, decoded for all peaks at once
+        num_instances = len(point_coords)
+        coords_torch = predictor.transform.apply_coords_torch(point_coords, state.original_size)[:, None, :]
+        labels_torch = torch.ones(num_instances, 1, dtype=torch.int, device=coords_torch.device)
+        features = state.features
+        instance_idxs = torch.arange(num_instances, device=features.device)
+
+        # First-step prediction
+        if mask_weights is not None:
+            logits, scores = self._decode(features, coords_torch, labels_torch, multimask_output=True)
+            mask_weights = mask_weights.reshape(1, 3).to(logits)
+            logits = (logits * mask_weights[..., None, None]).sum(1, keepdim=True)
+        else:
+            _, _, attn_sim = self.location_prior(state)
+            logits, scores = self._decode(
+                features,
+                coords_torch,
+                labels_torch,
+                multimask_output=False,
+                attn_sim=attn_sim,  # Target-guided Attention
+                target_embedding=self.target_embedding,  # Target-semantic Prompting
+            )
+
+        # Cascaded Post-refinement-1, also prompted with the box of the weighted mask for PerSAM-F
+        boxes = None
+        if mask_weights is not None:
+            masks = model.postprocess_masks(logits, state.input_size, state.original_size)[:, 0] > model.mask_threshold
+            boxes = predictor.transform.apply_boxes_torch(batched_mask_to_box(masks), state.original_size)
+        logits, scores = self._decode(
+            features, coords_torch, labels_torch, boxes=boxes, mask_input=logits, multimask_output=True
+        )
+        best_idx = scores.argmax(dim=1)
+        best_logits = logits[instance_idxs, best_idx][:, None]
+
+        # Cascaded Post-refinement-2
+        masks = model.postprocess_masks(best_logits, state.input_size, state.original_size)[:, 0] > model.mask_threshold
+        boxes = predictor.transform.apply_boxes_torch(batched_mask_to_box(masks), state.original_size)
+        logits, scores = self._decode(
+            features,
+            coords_torch,
+            labels_torch,
+            boxes=boxes,
+            mask_input=best_logits,
+            multimask_output=True,
+        )
+        best_idx = scores.argmax(dim=1)
+        scores = scores[instance_idxs, best_idx]
+        masks = model.postprocess_masks(
+            logits[instance_idxs, best_idx][:, None], state.input_size, state.original_size
+        )[:, 0] > model.mask_threshold
+
+        # Remove empty and low quality masks, then duplicates
+        keep = (masks.flatten(1).any(dim=1) & (scores >= pred_iou_thresh)).nonzero()[:, 0]
+        boxes = batched_mask_to_box(masks[keep]).float()
+        keep = keep[batched_nms(boxes, scores[keep], torch.zeros_like(keep), iou_threshold=box_nms_thresh)]
+
+        results = []
+        for i in keep.tolist():
+            results.append(
+                {
+                    "mask": masks[i].cpu().numpy(),
+                    "mask_index": int(best_idx[i]),
+                    "iou_prediction": float(scores[i]),
+                    "point_coords": point_coords[i : i + 1].cpu().numpy(),
+                    "point_labels": np.ones(1, dtype=np.int32),
+                }
+            )
+        return results
+
+    def _decode(
+        self,
+        features: torch.Tensor,
+        point_coords: torch.Tensor,
+        point_labels: torch.Tensor,
+        boxes: Optional[torch.Tensor] = None,
+        mask_input: Optional[torch.Tensor] = None,
+        multimask_output: bool = True,
+        attn_sim: Optional[torch.Tensor] = None,
+        target_embedding: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Runs the prompt encoder and mask decoder on B images with one set of
+        prompts each, returning low resolution mask logits and their
+        predicted quality.
+        """
+        model = self.predictor.model
+        with model.autocast():
+            sparse_embeddings, dense_embeddings = model.prompt_encoder(
+                points=(point_coords, point_labels),
+                boxes=boxes,
+                masks=mask_input,
+            )
+            low_res_masks, iou_predictions = model.mask_decoder(
+                image_embeddings=features,
+                image_pe=model.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse_embeddings,
+                dense_prompt_embeddings=dense_embeddings,
+                multimask_output=multimask_output,
+                attn_sim=attn_sim,
+                target_embedding=target_embedding,
+            )
+        return low_res_masks.float(), iou_predictions.float()
+
+
+def point_selection(mask_sim: torch.Tensor, topk: int = 1) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Selects the top-k most and least similar locations of a similarity map
+    with shape HxW, as positive and negative point prompts in (X, Y) pixels.
+    """
+    h, w = mask_sim.shape
+    flat_sim = mask_sim.flatten(0)
+    idxs = torch.cat([flat_sim.topk(topk)[1], flat_sim.topk(topk, largest=False)[1]])
+    point_coords = torch.stack([idxs % w, idxs // w], dim=-1)
+    point_labels = torch.cat(
+        [
+            torch.ones(topk, dtype=torch.int, device=mask_sim.device),
+            torch.zeros(topk, dtype=torch.int, device=mask_sim.device),
+        ]
+    )
+    return point_coords, point_labels
+
+
+def low_res_point_selection(
+    sim: torch.Tensor,
+    input_size: Tuple[int, ...],
+    original_size: Tuple[int, ...],
+    img_size: int,
+    topk: int = 1,
+    negative: bool = True,
+    subpixel: bool = False,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Selects point prompts on a low resolution similarity map, such as the
+    64x64 embedding grid or its 4x upsampling, without upsampling it to the
+    original image size. Only the part of the grid covering the unpadded
+    input image is searched, and grid cells are mapped to original pixels
+    with the same pixel-center convention as bilinear upsampling in
+    postprocess_masks.
+
+    Arguments:
+      sim (torch.Tensor): The similarity map, with shape HxW or BxHxW, that
+        spans the img_size x img_size padded model input.
+      input_size (tuple(int, int)): The size of the image input to the
+        model, in (H, W) format, before padding.
+      original_size (tuple(int, int)): The original size of the image, in
+        (H, W) format.
+      img_size (int): The side of the padded model input.
+      topk (int): The number of positive (and negative) points.
+      negative (bool): If true, the topk least similar locations are added as
+        negative points after the positive ones.
+      subpixel (bool): If true, each point is refined with a parabolic fit
+        over its 3x3 neighbourhood.
+
+    Returns:
+      (torch.Tensor): The point prompts in (X, Y) original pixels, with shape
+        Nx2, or BxNx2 for a batched map.
+      (torch.Tensor): The point labels, with shape N.
+    """
+    batched = sim.dim() == 3
+    if not batched:
+        sim = sim.unsqueeze(0)
+    valid_h, valid_w = _valid_grid_size(sim.shape[-2:], input_size, img_size)
+    valid_sim = sim[:, :valid_h, :valid_w].float()
+
+    point_coords = [_grid_peaks(valid_sim, topk, subpixel)]
+    if negative:
+        point_coords.append(_grid_peaks(-valid_sim, topk, subpixel))
+    point_coords = torch.cat(point_coords, dim=1)
+
+    point_coords = _grid_to_original(point_coords, sim.shape[-1], input_size, original_size, img_size)
+
+    labels = [torch.ones(topk, dtype=torch.int, device=sim.device)]
+    if negative:
+        labels.append(torch.zeros(topk, dtype=torch.int, device=sim.device))
+    point_labels = torch.cat(labels)
+    if not batched:
+        point_coords = point_coords[0]
+    return point_coords, point_labels
+
+
+def _valid_grid_size(
+    grid_size: Tuple[int, ...], input_size: Tuple[int, ...], img_size: int
+) -> Tuple[int, int]:
+    """Returns the number of grid rows and columns that cover the unpadded input."""
+    return (
+        min(grid_size[0], math.ceil(input_size[0] * grid_size[0] / img_size)),
+        min(grid_size[1], math.ceil(input_size[1] * grid_size[1] / img_size)),
+    )
+
+
+def _grid_to_original(
+    point_coords: torch.Tensor,
+    grid_w: int,
+    input_size: Tuple[int, ...],
+    original_size: Tuple[int, ...],
+    img_size: int,
+) -> torch.Tensor:
+    """
+    Maps (X, Y) coordinates on a grid of width grid_w spanning the padded
+    model input to original pixels, both with half-pixel centers.
+    """
+    patch_size = img_size / grid_w
+    scale = point_coords.new_tensor(
+        [original_size[1] / input_size[1], original_size[0] / input_size[0]]
+    )
+    point_coords = (point_coords + 0.5) * patch_size * scale - 0.5
+    return torch.minimum(
+        point_coords.clamp(min=0), point_coords.new_tensor([original_size[1] - 1, original_size[0] - 1])
+    )
+
+
+def _grid_peaks(sim: torch.Tensor, topk: int, subpixel: bool) -> torch.Tensor:
+    """
+    Finds the topk maxima of each BxHxW map, returning Bxtopkx2 (X, Y) grid
+    coordinates, optionally refined to sub-cell precision.
+    """
+    B, h, w = sim.shape
+    flat_sim = sim.flatten(1)
+    idxs = flat_sim.topk(topk, dim=1)[1]
+    ys, xs = idxs // w, idxs % w
+    point_coords = torch.stack([xs, ys], dim=-1).to(sim.dtype)
+    if not subpixel:
+        return point_coords
+
+    def value_at(y: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+        return flat_sim.gather(1, y.clamp(0, h - 1) * w + x.clamp(0, w - 1))
+
+    center = flat_sim.gather(1, idxs)
+    dx = _parabolic_offset(value_at(ys, xs - 1), center, value_at(ys, xs + 1))
+    dy = _parabolic_offset(value_at(ys - 1, xs), center, value_at(ys + 1, xs))
+    dx = torch.where((xs > 0) & (xs < w - 1), dx, torch.zeros_like(dx))
+    dy = torch.where((ys > 0) & (ys < h - 1), dy, torch.zeros_like(dy))
+    return point_coords + torch.stack([dx, dy], dim=-1)
+
+
+def _parabolic_offset(
+    left: torch.Tensor, center: torch.Tensor, right: torch.Tensor
+) -> torch.Tensor:
+    """Offset of the vertex of the parabola through three samples, in [-0.5, 0.5]."""
+    curvature = left - 2 * center + right
+    offset = 0.5 * (left - right) / curvature
+    return torch.where(curvature < 0, offset.clamp(-0.5, 0.5), torch.zeros_like(offset))
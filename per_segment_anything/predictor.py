@@ -7,15 +7,76 @@
 import numpy as np
 import torch
 
-from typing import Optional, Tuple
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple, Union
 
+from .utils.embedding_cache import EmbeddingCache
 from .utils.transforms import ResizeLongestSide
 
 
+class ImageState:
+    """
+    The image embedding of a single image, together with the sizes needed to
+    map prompts and masks between the original image and the model input.
+    """
+
+    def __init__(
+        self,
+        features: torch.Tensor,
+        input_size: Tuple[int, ...],
+        original_size: Tuple[int, ...],
+    ) -> None:
+        """
+        Arguments:
+          features (torch.Tensor): The image embedding, with shape 1xCxHxW.
+          input_size (tuple(int, int)): The size of the image after
+            ResizeLongestSide, in (H, W) format.
+          original_size (tuple(int, int)): The size of the image before
+            transformation, in (H, W) format.
+        """
+        self.features = features
+        self.input_size = input_size
+        self.original_size = original_size
+
+
+class ImageStatePool:
+    """
+    A bounded, in-memory pool of image states. When full, adding a state
+    drops the least recently used one.
+    """
+
+    def __init__(self, max_states: int = 8) -> None:
+        assert max_states > 0, "max_states must be positive."
+        self.max_states = max_states
+        self._states: "OrderedDict[Hashable, ImageState]" = OrderedDict()
+
+    def put(self, key: Hashable, state: ImageState) -> None:
+        self._states[key] = state
+        self._states.move_to_end(key)
+        while len(self._states) > self.max_states:
+            self._states.popitem(last=False)
+
+    def get(self, key: Hashable) -> ImageState:
+        state = self._states[key]
+        self._states.move_to_end(key)
+        return state
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._states
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def clear(self) -> None:
+        self._states.clear()
+
+
 class SamPredictor:
     def __init__(
         self,
         sam_model,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        max_image_states: int = 8,
     ) -> None:
         """
         Uses SAM to calculate the image embedding for an image, and then
@@ -23,10 +84,17 @@ class SamPredictor:
 
         Arguments:
           sam_model (Sam): The model to use for mask prediction.
+          embedding_cache (EmbeddingCache or None): If given, image embeddings
+            are looked up in and saved to this on-disk cache, so that images
+            seen in a previous run skip the image encoder.
+          max_image_states (int): The number of image states kept in the
+            'image_states' pool, for states set with a 'state_key'.
         """
         super().__init__()
         self.model = sam_model
         self.transform = ResizeLongestSide(sam_model.image_encoder.img_size)
+        self.embedding_cache = embedding_cache
+        self.image_states = ImageStatePool(max_image_states)
         self.reset_image()
 
     def set_image(
@@ -34,8 +102,9 @@ class SamPredictor:
         image: np.ndarray,
         mask: np.ndarray = None,
         image_format: str = "RGB",
-        cal_image=True
-    ) -> None:
+        cal_image=True,
+        state_key: Optional[Hashable] = None,
+    ) -> Union[ImageState, torch.Tensor]:
         """
         Calculates the image embeddings for the provided image, allowing
         masks to be predicted with the 'predict' method.
@@ -43,7 +112,18 @@ class SamPredictor:
         Arguments:
           image (np.ndarray): The image for calculating masks. Expects an
             image in HWC uint8 format, with pixel values in [0, 255].
+          mask (np.ndarray or None): A mask in the same format as the image,
+            to be transformed and padded like the image.
           image_format (str): The color format of the image, in ['RGB', 'BGR'].
+          cal_image (bool): If false, only the mask is transformed and the
+            currently set image is kept.
+          state_key (hashable or None): If given, the resulting image state is
+            also stored under this key in the 'image_states' pool.
+
+        Returns:
+          (ImageState or torch.Tensor): The state of the image, which can be
+            passed to 'predict' later on. If a mask is given, the transformed
+            mask is returned instead, with shape 1x3xHxW.
         """
         assert image_format in [
             "RGB",
@@ -64,9 +144,13 @@ class SamPredictor:
           input_mask_torch = torch.as_tensor(input_mask, device=self.device)
           input_mask_torch = input_mask_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
 
-        input_mask = self.set_torch_image(input_image_torch, image.shape[:2], transformed_mask=input_mask_torch)
-        return input_mask
-          
+        return self.set_torch_image(
+            input_image_torch,
+            image.shape[:2],
+            transformed_mask=input_mask_torch,
+            cal_image=cal_image,
+            state_key=state_key,
+        )
 
     @torch.no_grad()
     def set_torch_image(
@@ -74,8 +158,9 @@ class SamPredictor:
         transformed_image: torch.Tensor,
         original_image_size: Tuple[int, ...],
         transformed_mask: torch.Tensor = None,
-        cal_image=True
-    ) -> None:
+        cal_image=True,
+        state_key: Optional[Hashable] = None,
+    ) -> Union[ImageState, torch.Tensor]:
         """
         Calculates the image embeddings for the provided image, allowing
         masks to be predicted with the 'predict' method. Expects the input
@@ -86,24 +171,181 @@ class SamPredictor:
             1x3xHxW, which has been transformed with ResizeLongestSide.
           original_image_size (tuple(int, int)): The size of the image
             before transformation, in (H, W) format.
+          transformed_mask (torch.Tensor or None): A mask transformed like
+            the image, to be padded to the model input.
+          cal_image (bool): If false, only the mask is padded and the
+            currently set image is kept.
+          state_key (hashable or None): If given, the resulting image state is
+            also stored under this key in the 'image_states' pool.
+
+        Returns:
+          (ImageState or torch.Tensor): The state of the image, or the padded
+            mask if a mask is given.
         """
         assert (
             len(transformed_image.shape) == 4
             and transformed_image.shape[1] == 3
             and max(*transformed_image.shape[2:]) == self.model.image_encoder.img_size
         ), f"set_torch_image input must be BCHW with long side {self.model.image_encoder.img_size}."
+        assert (
+            transformed_image.shape[0] == 1
+        ), f"set_torch_image takes a single image, got a batch of {transformed_image.shape[0]}. Use set_images."
         
         if cal_image:
           self.reset_image()
-          self.original_size = original_image_size
-          self.input_size = tuple(transformed_image.shape[-2:])
-          input_image = self.model.preprocess(transformed_image)
-          self.features = self.model.image_encoder(input_image)
-          self.is_image_set = True
+          state = ImageState(
+              self._encode([transformed_image])[0],
+              tuple(transformed_image.shape[-2:]),
+              tuple(original_image_size),
+          )
+          self.set_state(state)
+          if state_key is not None:
+              self.image_states.put(state_key, state)
 
         if transformed_mask is not None:
           input_mask = self.model.preprocess(transformed_mask)  # pad to 1024
           return input_mask
+        return self.image_state
+
+    def set_images(
+        self,
+        images: List[np.ndarray],
+        image_format: str = "RGB",
+        batch_size: int = 4,
+        state_keys: Optional[List[Hashable]] = None,
+    ) -> List[ImageState]:
+        """
+        Calculates the image embeddings for several images, running the
+        image encoder on up to 'batch_size' images per forward pass. The
+        returned states can be activated with 'set_state' for prediction.
+
+        Arguments:
+          images (list(np.ndarray)): The images for calculating masks, each
+            in HWC uint8 format, with pixel values in [0, 255]. The images
+            may have different sizes.
+          image_format (str): The color format of the images, in ['RGB', 'BGR'].
+          batch_size (int): The number of images encoded per forward pass.
+          state_keys (list(hashable) or None): If given, each image state is
+            also stored under its key in the 'image_states' pool.
+
+        Returns:
+          (list(ImageState)): The embedding and sizes of each image.
+        """
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        transformed_images = []
+        for image in images:
+            if image_format != self.model.image_format:
+                image = image[..., ::-1]
+            input_image = self.transform.apply_image(image)
+            input_image_torch = torch.as_tensor(input_image, device=self.device)
+            transformed_images.append(input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :])
+        return self.encode_batch(
+            transformed_images,
+            [image.shape[:2] for image in images],
+            batch_size=batch_size,
+            state_keys=state_keys,
+        )
+
+    @torch.no_grad()
+    def encode_batch(
+        self,
+        transformed_images: List[torch.Tensor],
+        original_image_sizes: List[Tuple[int, ...]],
+        batch_size: int = 4,
+        state_keys: Optional[List[Hashable]] = None,
+    ) -> List[ImageState]:
+        """
+        Calculates the image embeddings for several images, which have
+        already been transformed to the format expected by the model.
+        The currently set image is left unchanged.
+
+        Arguments:
+          transformed_images (list(torch.Tensor)): The input images, each with
+            shape 1x3xHxW, which have been transformed with ResizeLongestSide.
+          original_image_sizes (list(tuple(int, int))): The size of each image
+            before transformation, in (H, W) format.
+          batch_size (int): The number of images encoded per forward pass.
+          state_keys (list(hashable) or None): If given, each image state is
+            also stored under its key in the 'image_states' pool.
+
+        Returns:
+          (list(ImageState)): The embedding and sizes of each image.
+        """
+        for transformed_image in transformed_images:
+            assert (
+                len(transformed_image.shape) == 4
+                and transformed_image.shape[:2] == (1, 3)
+                and max(*transformed_image.shape[2:]) == self.model.image_encoder.img_size
+            ), f"encode_batch inputs must be 1x3xHxW with long side {self.model.image_encoder.img_size}."
+        features = self._encode(transformed_images, batch_size=batch_size)
+        states = [
+            ImageState(f, tuple(transformed_image.shape[-2:]), tuple(original_size))
+            for f, transformed_image, original_size in zip(
+                features, transformed_images, original_image_sizes
+            )
+        ]
+        if state_keys is not None:
+            for key, state in zip(state_keys, states):
+                self.image_states.put(key, state)
+        return states
+
+    def set_state(self, state: Union[ImageState, Hashable]) -> None:
+        """
+        Makes a previously encoded image the current image, without running
+        the image encoder.
+
+        Arguments:
+          state (ImageState or hashable): The image state, or the key it is
+            stored under in the 'image_states' pool.
+        """
+        state = self._get_state(state)
+        self.reset_image()
+        self.image_state = state
+        self.features = state.features
+        self.input_size = state.input_size
+        self.original_size = state.original_size
+        self.is_image_set = True
+
+    def _get_state(self, state: Optional[Union[ImageState, Hashable]]) -> ImageState:
+        """Resolves an image state, a pool key, or None for the current image."""
+        if state is None:
+            if not self.is_image_set:
+                raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+            return self.image_state
+        if isinstance(state, ImageState):
+            return state
+        if state not in self.image_states:
+            raise KeyError(f"No image state is stored under the key {state!r}.")
+        return self.image_states.get(state)
+
+    def _encode(self, transformed_images: List[torch.Tensor], batch_size: int = 1) -> List[torch.Tensor]:
+        """
+        Runs the image encoder on 1x3xHxW transformed images, batch_size at a
+        time, going through the embedding cache if one is set.
+        """
+        features: List[Optional[torch.Tensor]] = [None] * len(transformed_images)
+        keys: List[Optional[str]] = [None] * len(transformed_images)
+        if self.embedding_cache is not None:
+            for i, transformed_image in enumerate(transformed_images):
+                keys[i] = self.embedding_cache.key(transformed_image, self.model.image_encoder.img_size)
+                features[i] = self.embedding_cache.get(keys[i], device=self.device)
+
+        to_encode = [i for i, f in enumerate(features) if f is None]
+        for start in range(0, len(to_encode), batch_size):
+            batch_idxs = to_encode[start : start + batch_size]
+            input_images = torch.cat(
+                [self.model.preprocess(transformed_images[i]) for i in batch_idxs], dim=0
+            )
+            with self.model.autocast():
+                batch_features = self.model.image_encoder(input_images).float()
+            for j, i in enumerate(batch_idxs):
+                features[i] = batch_features[j : j + 1]
+                if keys[i] is not None:
+                    self.embedding_cache.put(keys[i], features[i])
+        return features
 
     def predict(
         self,
@@ -114,7 +356,8 @@ class SamPredictor:
         multimask_output: bool = True,
         return_logits: bool = False,
         attn_sim = None,
-        target_embedding = None
+        target_embedding = None,
+        image_state: Optional[Union[ImageState, Hashable]] = None,
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """
         Predict masks for the given input prompts, using the currently set image.
@@ -138,6 +381,9 @@ class SamPredictor:
             input prompts, multimask_output=False can give better results.
           return_logits (bool): If true, returns un-thresholded masks logits
             instead of a binary mask.
+          image_state (ImageState, hashable or None): The image to predict
+            masks for, as a state or a key of the 'image_states' pool.
+            Defaults to the currently set image.
 
         Returns:
           (np.ndarray): The output masks in CxHxW format, where C is the
@@ -148,8 +394,7 @@ class SamPredictor:
             of masks and H=W=256. These low resolution logits can be passed to
             a subsequent iteration as mask input.
         """
-        if not self.is_image_set:
-            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+        state = self._get_state(image_state)
 
         # Transform input prompts
         coords_torch, labels_torch, box_torch, mask_input_torch = None, None, None, None
@@ -157,12 +402,12 @@ class SamPredictor:
             assert (
                 point_labels is not None
             ), "point_labels must be supplied if point_coords is supplied."
-            point_coords = self.transform.apply_coords(point_coords, self.original_size)
+            point_coords = self.transform.apply_coords(point_coords, state.original_size)
             coords_torch = torch.as_tensor(point_coords, dtype=torch.float, device=self.device)
             labels_torch = torch.as_tensor(point_labels, dtype=torch.int, device=self.device)
             coords_torch, labels_torch = coords_torch[None, :, :], labels_torch[None, :]
         if box is not None:
-            box = self.transform.apply_boxes(box, self.original_size)
+            box = self.transform.apply_boxes(box, state.original_size)
             box_torch = torch.as_tensor(box, dtype=torch.float, device=self.device)
             box_torch = box_torch[None, :]
         if mask_input is not None:
@@ -177,6 +422,7 @@ class SamPredictor:
             return_logits=return_logits,
             attn_sim=attn_sim,
             target_embedding=target_embedding,
+            image_state=state,
         )
 
         masks = masks[0].detach().cpu().numpy()
@@ -196,7 +442,8 @@ class SamPredictor:
         multimask_output: bool = True,
         return_logits: bool = False,
         attn_sim = None,
-        target_embedding = None
+        target_embedding = None,
+        image_state: Optional[Union[ImageState, Hashable]] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         Predict masks for the given input prompts, using the currently set image.
@@ -223,6 +470,9 @@ class SamPredictor:
             input prompts, multimask_output=False can give better results.
           return_logits (bool): If true, returns un-thresholded masks logits
             instead of a binary mask.
+          image_state (ImageState, hashable or None): The image to predict
+            masks for, as a state or a key of the 'image_states' pool.
+            Defaults to the currently set image.
 
         Returns:
           (torch.Tensor): The output masks in BxCxHxW format, where C is the
@@ -233,34 +483,35 @@ class SamPredictor:
             of masks and H=W=256. These low res logits can be passed to
             a subsequent iteration as mask input.
         """
-        if not self.is_image_set:
-            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+        state = self._get_state(image_state)
 
         if point_coords is not None:
             points = (point_coords, point_labels)
         else:
             points = None
 
-        # Embed prompts
-        sparse_embeddings, dense_embeddings = self.model.prompt_encoder(
-            points=points,
-            boxes=boxes,
-            masks=mask_input,
-        )
+        with self.model.autocast():
+            # Embed prompts
+            sparse_embeddings, dense_embeddings = self.model.prompt_encoder(
+                points=points,
+                boxes=boxes,
+                masks=mask_input,
+            )
 
-        # Predict masks
-        low_res_masks, iou_predictions = self.model.mask_decoder(
-            image_embeddings=self.features,
-            image_pe=self.model.prompt_encoder.get_dense_pe(),
-            sparse_prompt_embeddings=sparse_embeddings,
-            dense_prompt_embeddings=dense_embeddings,
-            multimask_output=multimask_output,
-            attn_sim=attn_sim,
-            target_embedding=target_embedding
-        )
+            # Predict masks
+            low_res_masks, iou_predictions = self.model.mask_decoder(
+                image_embeddings=state.features,
+                image_pe=self.model.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse_embeddings,
+                dense_prompt_embeddings=dense_embeddings,
+                multimask_output=multimask_output,
+                attn_sim=attn_sim,
+                target_embedding=target_embedding
+            )
+        low_res_masks, iou_predictions = low_res_masks.float(), iou_predictions.float()
 
         # Upscale the masks to the original image resolution
-        high_res_masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+        high_res_masks = self.model.postprocess_masks(low_res_masks, state.input_size, state.original_size)
 
         if not return_logits:
             masks = high_res_masks > self.model.mask_threshold  # 0.0
@@ -289,6 +540,7 @@ class SamPredictor:
     def reset_image(self) -> None:
         """Resets the currently set image."""
         self.is_image_set = False
+        self.image_state = None
         self.features = None
         self.orig_h = None
         self.orig_w = None
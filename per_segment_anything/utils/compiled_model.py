@@ -0,0 +1,191 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+import torch.nn as nn
+
+import copy
+import hashlib
+import os
+from typing import Dict, Optional, Sequence, Tuple
+
+from ..modeling import Sam
+from .embedding_cache import sam_model_id
+
+
+class TracedImageEncoder(nn.Module):
+    """
+    Wraps an image encoder (ImageEncoderViT or TinyViT) with TorchScript
+    traces of it, one per input shape. Traces are saved to and loaded from
+    an on-disk cache keyed by the model identity, the input shape, the dtype,
+    the device type and the torch version, so they are only built once per
+    deployment.
+    """
+
+    def __init__(
+        self,
+        image_encoder: nn.Module,
+        cache_dir: Optional[str] = None,
+        model_id: Optional[str] = None,
+    ) -> None:
+        """
+        Arguments:
+          image_encoder (nn.Module): The eager image encoder.
+          cache_dir (str or None): The directory traces are stored in. If
+            None, traces are only kept in memory.
+          model_id (str or None): Identifies the model in the cache keys,
+            see sam_model_id. Required to use the on-disk cache.
+        """
+        super().__init__()
+        self.image_encoder = image_encoder
+        self.img_size = image_encoder.img_size
+        self.cache_dir = cache_dir if model_id is not None else None
+        self.model_id = model_id
+        self.traced: Dict[Tuple[int, ...], torch.jit.ScriptModule] = {}
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        shape = tuple(x.shape)
+        if shape not in self.traced:
+            self.traced[shape] = self._load_or_trace(x)
+        return self.traced[shape](x)
+
+    def _load_or_trace(self, x: torch.Tensor) -> torch.jit.ScriptModule:
+        path = self._path(x)
+        if path is not None and os.path.exists(path):
+            try:
+                return torch.jit.load(path, map_location=x.device)
+            except RuntimeError:
+                pass
+        with torch.no_grad():
+            traced = torch.jit.trace(self.image_encoder, x, check_trace=False)
+        if path is not None:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.jit.save(traced, tmp_path)
+            os.replace(tmp_path, path)
+        return traced
+
+    def _path(self, x: torch.Tensor) -> Optional[str]:
+        if self.cache_dir is None:
+            return None
+        dtype = next(self.image_encoder.parameters()).dtype
+        key = f"{self.model_id}-{tuple(x.shape)}-{dtype}-{x.device.type}-{torch.__version__}"
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".pt")
+
+
+def compile_sam(
+    sam: Sam,
+    sam_type: str,
+    checkpoint: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+    encoder_backend: Optional[str] = "trace",
+    decoder_backend: Optional[str] = "compile",
+) -> Sam:
+    """
+    Returns a copy of a model whose image encoder and mask decoder are
+    replaced with compiled versions. The copy shares its weights with 'sam',
+    which is left unchanged, so that other users of a model returned by
+    load_sam keep the eager modules. Compilation happens lazily on first
+    use, so call warmup_sam afterwards to pay its cost up front.
+
+    Arguments:
+      sam (Sam): The model, in eval mode and on its target device.
+      sam_type (str): The registry key of the model, e.g. 'vit_t'.
+      checkpoint (str or None): The checkpoint the model was loaded from.
+        Its content hash keys the on-disk artifacts, which are only written
+        if it is given.
+      cache_dir (str or None): The directory encoder traces are kept in,
+        under 'traced'. Where torch.compile keeps its kernels is a process
+        setting of inductor, which is left to the caller.
+      encoder_backend (str or None): 'trace' for TorchScript traces, one
+        per input shape, 'compile' for torch.compile, or None to keep the
+        eager encoder.
+      decoder_backend (str or None): 'compile' for torch.compile with
+        dynamic shapes, or None. The decoder takes a variable number of
+        prompts and optional inputs, which tracing cannot capture.
+
+    Returns:
+      (Sam): The compiled model.
+    """
+    assert encoder_backend in ["trace", "compile", None], f"Unknown encoder backend {encoder_backend}."
+    assert decoder_backend in ["compile", None], f"Unknown decoder backend {decoder_backend}."
+
+    # A shallow copy with its own module table, so that replacing its
+    # submodules does not change 'sam'
+    sam = copy.copy(sam)
+    sam._modules = sam._modules.copy()
+
+    if encoder_backend == "trace":
+        model_id = None
+        if cache_dir is not None and checkpoint is not None:
+            # The traces hold their own copy of the weights and graph, so
+            # they are keyed on every option that changes either
+            model_id = sam_model_id(sam, sam_type, checkpoint)
+        traced_dir = os.path.join(cache_dir, "traced") if cache_dir is not None else None
+        sam.image_encoder = TracedImageEncoder(sam.image_encoder, traced_dir, model_id)
+    elif encoder_backend == "compile":
+        sam.image_encoder = torch.compile(sam.image_encoder)
+
+    if decoder_backend == "compile":
+        sam.mask_decoder = torch.compile(sam.mask_decoder, dynamic=True)
+    return sam
+
+
+@torch.no_grad()
+def warmup_sam(
+    sam: Sam,
+    batch_sizes: Sequence[int] = (1,),
+    num_points: int = 2,
+) -> None:
+    """
+    Runs the encoders and the decoder on dummy inputs, so that tracing and
+    compilation happen here instead of on the first real request. The
+    decoder is run with the prompt combinations of the PerSAM cascade.
+
+    Arguments:
+      sam (Sam): The model, usually returned by compile_sam.
+      batch_sizes (list(int)): The image encoder batch sizes to prepare,
+        at least one.
+      num_points (int): The number of point prompts to prepare the decoder for.
+    """
+    assert len(batch_sizes) > 0, "batch_sizes must not be empty."
+    img_size = sam.image_encoder.img_size
+    for batch_size in batch_sizes:
+        images = torch.zeros(batch_size, 3, img_size, img_size, device=sam.device)
+        with sam.autocast():
+            features = sam.image_encoder(images).float()
+
+    features = features[:1]
+    points = (
+        torch.zeros(1, num_points, 2, device=sam.device),
+        torch.ones(1, num_points, dtype=torch.int, device=sam.device),
+    )
+    boxes = torch.zeros(1, 4, device=sam.device)
+    h, w = features.shape[-2:]
+    attn_sim = torch.zeros(1, 1, 1, h * w, device=sam.device)
+    target_embedding = torch.zeros(1, 1, features.shape[1], device=sam.device)
+    mask_input = torch.zeros(1, 1, 4 * h, 4 * w, device=sam.device)
+    with sam.autocast():
+        for prompts in [
+            dict(points=points, multimask_output=False, attn_sim=attn_sim, target_embedding=target_embedding),
+            dict(points=points, masks=mask_input, multimask_output=True),
+            dict(points=points, boxes=boxes, masks=mask_input, multimask_output=True),
+        ]:
+            sparse_embeddings, dense_embeddings = sam.prompt_encoder(
+                points=prompts["points"],
+                boxes=prompts.get("boxes"),
+                masks=prompts.get("masks"),
+            )
+            sam.mask_decoder(
+                image_embeddings=features,
+                image_pe=sam.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse_embeddings,
+                dense_prompt_embeddings=dense_embeddings,
+                multimask_output=prompts["multimask_output"],
+                attn_sim=prompts.get("attn_sim"),
+                target_embedding=prompts.get("target_embedding"),
+            )
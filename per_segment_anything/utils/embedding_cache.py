@@ -0,0 +1,194 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import hashlib
+import json
+import os
+from typing import Any, Optional
+
+from ..modeling import Sam
+
+# Where hash_checkpoint remembers the content hashes of checkpoint files
+CHECKPOINT_HASH_INDEX = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "per_segment_anything",
+    "checkpoints.json",
+)
+
+
+class EmbeddingCache:
+    """
+    A persistent, content-addressed cache of image embeddings. Each entry is
+    keyed by the content of the transformed input image together with the
+    identity of the model that encoded it, and is stored as a .npy file that
+    is memory-mapped on lookup. The total size on disk is bounded, with the
+    least recently used entries evicted first.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        model_id: str,
+        max_size_gb: float = 10.0,
+        dtype: str = "float16",
+    ) -> None:
+        """
+        Arguments:
+          cache_dir (str): The directory the embeddings are stored in. It is
+            created if it does not exist and may be shared between processes.
+          model_id (str): The identity of the model, usually from
+            sam_model_id. It is part of every key, so that embeddings
+            computed with different weights or encoder configurations never
+            collide.
+          max_size_gb (float): The maximum total size of the cache on disk.
+          dtype (str): The dtype the embeddings are stored in, in
+            ['float16', 'float32']. float16 halves the disk and page cache
+            footprint at a negligible cost in precision.
+        """
+        assert dtype in [
+            "float16",
+            "float32",
+        ], f"dtype must be in ['float16', 'float32'], is {dtype}."
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_size_gb * 1024**3)
+        self.dtype = np.dtype(dtype)
+        self.model_id = model_id
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, transformed_image: torch.Tensor, img_size: int) -> str:
+        """
+        Computes the cache key of an image that has been transformed with
+        ResizeLongestSide, for a model with the given encoder input size.
+        """
+        image = transformed_image.detach().cpu().contiguous()
+        h = hashlib.sha1()
+        h.update(self.model_id.encode())
+        h.update(f"{img_size}-{tuple(image.shape)}-{image.dtype}".encode())
+        h.update(image.numpy().tobytes())
+        return h.hexdigest()
+
+    def get(self, key: str, device: Any = None) -> Optional[torch.Tensor]:
+        """
+        Returns the cached embedding for 'key' in float32 on 'device', or
+        None if it is not cached. A hit marks the entry as recently used.
+        """
+        path = self._path(key)
+        try:
+            features = np.load(path, mmap_mode="c")
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # The tensor shares the memory-mapped pages. Only the stored dtype is
+        # read, it is moved to 'device' first and cast there. float32 entries
+        # on CPU are not copied at all.
+        return torch.from_numpy(features).to(device=device).float()
+
+    def put(self, key: str, features: torch.Tensor) -> None:
+        """Stores an embedding and evicts old entries if over the size cap."""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, features.detach().float().cpu().numpy().astype(self.dtype))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self) -> None:
+        """Removes least recently used entries until the cache fits in max_size_gb."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        """Removes every cached embedding."""
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npy"):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".npy")
+
+
+def sam_model_id(sam: Sam, sam_type: str, checkpoint: Optional[str] = None) -> str:
+    """
+    Returns the identity of a built model, which keys cached embeddings,
+    encoder traces and concepts: its type, the content hash of its
+    checkpoint, and every build option that changes the image embeddings.
+    These are the precision, the encoder input size, the ViT attention
+    backend, the TinyViT inference optimization and int8 quantization,
+    each read from the model and left out at its default.
+    """
+    checkpoint_hash = hash_checkpoint(checkpoint) if checkpoint is not None else "none"
+    model_id = f"{sam_type}-{checkpoint_hash}"
+    precision = {torch.bfloat16: "bf16", torch.float16: "fp16"}.get(sam.dtype)
+    if precision is not None:
+        model_id += f"-{precision}"
+    if sam.image_encoder.img_size != 1024:
+        model_id += f"-{sam.image_encoder.img_size}"
+    # modules() also reaches encoders wrapped by compile_sam
+    for module in sam.image_encoder.modules():
+        attn_backend = getattr(module, "attn_backend", "math")
+        if attn_backend != "math":
+            model_id += f"-{attn_backend}"
+            if attn_backend == "chunked":
+                model_id += str(module.attn_chunk_size)
+            break
+    if any(getattr(module, "inference_optimized", False) for module in sam.image_encoder.modules()):
+        model_id += "-optimized"
+    if getattr(sam, "quantization", None) is not None:
+        model_id += f"-{sam.quantization['dtype']}"
+    return model_id
+
+
+def hash_checkpoint(checkpoint: str) -> str:
+    """
+    Hashes a checkpoint file. Hashing a multi-GB checkpoint is slow, so the
+    result is remembered per (path, size, mtime) in CHECKPOINT_HASH_INDEX.
+    """
+    stat = os.stat(checkpoint)
+    file_id = f"{os.path.abspath(checkpoint)}:{stat.st_size}:{stat.st_mtime_ns}"
+    index = _read_json(CHECKPOINT_HASH_INDEX)
+    if file_id not in index:
+        h = hashlib.sha1()
+        with open(checkpoint, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 24), b""):
+                h.update(chunk)
+        index[file_id] = h.hexdigest()[:16]
+        try:
+            os.makedirs(os.path.dirname(CHECKPOINT_HASH_INDEX), exist_ok=True)
+            tmp_path = f"{CHECKPOINT_HASH_INDEX}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, CHECKPOINT_HASH_INDEX)
+        except OSError:
+            # A read-only home only costs hashing again in the next process
+            pass
+    return index[file_id]
+
+
+def _read_json(path: str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
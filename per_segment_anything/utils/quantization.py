@@ -0,0 +1,58 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+
+from typing import Any, Dict, Sequence
+
+from ..modeling import Sam
+
+# The submodules whose nn.Linear layers are quantized by default: the whole
+# image encoder (ViT or TinyViT) and the two-way transformer of the decoder.
+DEFAULT_QUANTIZED_MODULES = ("image_encoder", "mask_decoder.transformer")
+
+
+def quantize_sam(
+    sam: Sam,
+    modules: Sequence[str] = DEFAULT_QUANTIZED_MODULES,
+) -> Sam:
+    """
+    Applies post-training dynamic int8 quantization to the nn.Linear layers
+    of the given submodules, in place. Weights are stored as int8 and
+    activations are quantized on the fly, so no calibration data is needed.
+    Quantized models run on CPU only.
+
+    Arguments:
+      sam (Sam): An fp32 model in eval mode.
+      modules (list(str)): The dotted names of the submodules to quantize.
+
+    Returns:
+      (Sam): The quantized model.
+    """
+    assert sam.dtype == torch.float32, "Only fp32 models can be quantized."
+    sam.cpu()
+    for name in modules:
+        parent_name, _, child_name = name.rpartition(".")
+        parent = sam.get_submodule(parent_name) if parent_name else sam
+        child = getattr(parent, child_name)
+        setattr(parent, child_name, quantize_dynamic(child, {nn.Linear}, dtype=torch.qint8))
+    sam.quantization = {"dtype": "qint8", "modules": list(modules)}
+    return sam
+
+
+def save_quantized(sam: Sam, path: str) -> None:
+    """
+    Saves a model quantized with quantize_sam, in a format that the
+    sam_model_registry builders load directly.
+    """
+    assert getattr(sam, "quantization", None) is not None, "The model is not quantized."
+    torch.save({"quantization": sam.quantization, "model": sam.state_dict()}, path)
+
+
+def is_quantized_checkpoint(state_dict: Dict[str, Any]) -> bool:
+    return "quantization" in state_dict and "model" in state_dict
@@ -4,15 +4,17 @@ import warnings
 from tqdm import tqdm
 import torch
 import numpy as np
-from torch.nn import functional as F
 import matplotlib.pyplot as plt
 import cv2
 from show import *
-from per_segment_anything import sam_model_registry, SamPredictor
+from per_segment_anything import load_sam, SamPredictor, PerSAMEngine, Concept, ConceptLibrary
+from per_segment_anything.utils.compiled_model import compile_sam, warmup_sam
+from per_segment_anything.utils.embedding_cache import EmbeddingCache, sam_model_id
 
 warnings.filterwarnings('ignore')
 
 
+sam_checkpoints = {'vit_h': 'sam_vit_h_4b8939.pth', 'vit_t': 'weights/mobile_sam.pt'}
 
 
 def get_arguments():
@@ -24,6 +26,20 @@ def get_arguments():
     parser.add_argument('--ckpt', type=str, default='sam_vit_h_4b8939.pth')
     parser.add_argument('--ref_idx', type=str, default='04')
     parser.add_argument('--sam_type', type=str, default='vit_t')
+    parser.add_argument('--optimize', action='store_true', help='fuse Conv-BN and freeze attention biases of vit_t')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--cache_dir', type=str, default=None, help='reuse image embeddings across runs')
+    parser.add_argument('--cache_size_gb', type=float, default=10.0)
+    parser.add_argument('--batch_size', type=int, default=1, help='test images per encoder and decoder pass')
+    parser.add_argument('--attn_backend', type=str, default='math', choices=['math', 'sdpa', 'chunked'],
+                        help='attention of the vit_h image encoder')
+    parser.add_argument('--attn_chunk_size', type=int, default=1024, help='query rows per step of chunked attention')
+    parser.add_argument('--compile', type=str, default=None, choices=['trace', 'compile'], help='compile the image encoder')
+    parser.add_argument('--compile_cache', type=str, default='./cache/compiled')
+    parser.add_argument('--low_res_prior', action='store_true', help='select points on the embedding grid')
+    parser.add_argument('--subpixel', action='store_true', help='refine low-res points to sub-pixel precision')
+    parser.add_argument('--image_size', type=int, default=1024, help='encoder input size, e.g. 512 for fast previews')
+    parser.add_argument('--concept_dir', type=str, default=None, help='load and save the concepts of a concept library')
     
     args = parser.parse_args()
     return args
@@ -40,13 +56,53 @@ def main():
 
     if not os.path.exists('./outputs/'):
         os.mkdir('./outputs/')
+
+    # The model is loaded once and shared by all the objects
+    predictor = load_predictor(args)
+
+    # Concepts already in the library are used without their reference image
+    library, model_id = None, None
+    if args.concept_dir is not None:
+        library = ConceptLibrary(args.concept_dir)
+        model_id = sam_model_id(predictor.model, args.sam_type, sam_checkpoints[args.sam_type])
     
     for obj_name in os.listdir(images_path):
         if ".DS" not in obj_name:
-            persam(args, obj_name, images_path, masks_path, output_path)
+            persam(args, predictor, obj_name, images_path, masks_path, output_path, library, model_id)
+
+
+def load_predictor(args):
+
+    print("======> Load SAM" )
+    if args.sam_type == 'vit_h':
+        sam_type, sam_ckpt = 'vit_h', sam_checkpoints['vit_h']
+        sam = load_sam(
+            sam_type, sam_ckpt, device='cuda', precision=args.precision, attn_backend=args.attn_backend,
+            attn_chunk_size=args.attn_chunk_size, image_size=args.image_size)
+    elif args.sam_type == 'vit_t':
+        sam_type, sam_ckpt = 'vit_t', sam_checkpoints['vit_t']
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        sam = load_sam(
+            sam_type, sam_ckpt, device=device, precision=args.precision, optimize_for_inference=args.optimize,
+            image_size=args.image_size)
 
+    if args.compile is not None:
+        # Persist the torch.compile kernels next to the traces, so that later runs reuse them
+        import torch._inductor.config
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.join(args.compile_cache, "inductor")
+        torch._inductor.config.fx_graph_cache = True
+        sam = compile_sam(sam, sam_type, sam_ckpt, args.compile_cache, encoder_backend=args.compile)
+        # The reference is encoded alone, the test images in batches
+        warmup_sam(sam, batch_sizes=sorted({1, args.batch_size}))
 
-def persam(args, obj_name, images_path, masks_path, output_path):
+    embedding_cache = None
+    if args.cache_dir is not None:
+        embedding_cache = EmbeddingCache(
+            args.cache_dir, sam_model_id(sam, sam_type, sam_ckpt), max_size_gb=args.cache_size_gb)
+    return SamPredictor(sam, embedding_cache=embedding_cache)
+
+
+def persam(args, predictor, obj_name, images_path, masks_path, output_path, library=None, model_id=None):
 
     print("\n------------> Segment " + obj_name)
     
@@ -60,118 +116,58 @@ def persam(args, obj_name, images_path, masks_path, output_path):
     output_path = os.path.join(output_path, obj_name)
     os.makedirs(output_path, exist_ok=True)
 
-    # Load images and masks
-    ref_image = cv2.imread(ref_image_path)
-    ref_image = cv2.cvtColor(ref_image, cv2.COLOR_BGR2RGB)
-
-    ref_mask = cv2.imread(ref_mask_path)
-    ref_mask = cv2.cvtColor(ref_mask, cv2.COLOR_BGR2RGB)
-    
-
-    print("======> Load SAM" )
-    if args.sam_type == 'vit_h':
-        sam_type, sam_ckpt = 'vit_h', 'sam_vit_h_4b8939.pth'
-        sam = sam_model_registry[sam_type](checkpoint=sam_ckpt).cuda()
-    elif args.sam_type == 'vit_t':
-        sam_type, sam_ckpt = 'vit_t', 'weights/mobile_sam.pt'
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        sam = sam_model_registry[sam_type](checkpoint=sam_ckpt).to(device=device)
-        sam.eval()
+    if library is not None and obj_name in library:
+        print("======> Load Concept" )
+        concept = library.load(obj_name, device=predictor.device, model_id=model_id)
+        # Concepts saved without a thumbnail have no reference to show
+        ref_image = concept.thumbnail[..., :3] if concept.thumbnail is not None else None
+    else:
+        # Load images and masks
+        ref_image = cv2.imread(ref_image_path)
+        ref_image = cv2.cvtColor(ref_image, cv2.COLOR_BGR2RGB)
 
-    predictor = SamPredictor(sam)
+        ref_mask = cv2.imread(ref_mask_path)
+        ref_mask = cv2.cvtColor(ref_mask, cv2.COLOR_BGR2RGB)
 
-    print("======> Obtain Location Prior" )
-    # Image features encoding
-    ref_mask = predictor.set_image(ref_image, ref_mask)
-    ref_feat = predictor.features.squeeze().permute(1, 2, 0)
+        print("======> Obtain Location Prior" )
+        # Image features encoding and target feature extraction
+        concept = Concept.from_reference(predictor, ref_image, ref_mask, obj_name, model_id=model_id)
+        if library is not None:
+            library.add(concept)
 
-    ref_mask = F.interpolate(ref_mask, size=ref_feat.shape[0: 2], mode="bilinear")
-    ref_mask = ref_mask.squeeze()[0]
-
-    # Target feature extraction
-    target_feat = ref_feat[ref_mask > 0]
-    target_embedding = target_feat.mean(0).unsqueeze(0)
-    target_feat = target_embedding / target_embedding.norm(dim=-1, keepdim=True)
-    target_embedding = target_embedding.unsqueeze(0)
+    engine = PerSAMEngine.from_concept(
+        predictor, concept, low_res_prior=args.low_res_prior, subpixel=args.subpixel)
 
 
     print('======> Start Testing')
-    for test_idx in tqdm(range(len(os.listdir(test_images_path)))):
-    
-        # Load test image
+    test_num = len(os.listdir(test_images_path))
+    for test_idx in tqdm(range(test_num)):
+
+        # Load and encode the next batch of test images
+        if test_idx % args.batch_size == 0:
+            batch_images = []
+            for batch_idx in range(test_idx, min(test_idx + args.batch_size, test_num)):
+                test_image = cv2.imread(test_images_path + '/' + '%02d' % batch_idx + '.jpg')
+                batch_images.append(cv2.cvtColor(test_image, cv2.COLOR_BGR2RGB))
+            batch_states = predictor.set_images(batch_images, batch_size=args.batch_size)
+
+            # Location prior, target-guided prediction and cascaded post-refinement
+            batch_results = engine.segment_batch(batch_states)
+
+        test_image = batch_images[test_idx % args.batch_size]
+        result = batch_results[test_idx % args.batch_size]
         test_idx = '%02d' % test_idx
-        test_image_path = test_images_path + '/' + test_idx + '.jpg'
-        test_image = cv2.imread(test_image_path)
-        test_image = cv2.cvtColor(test_image, cv2.COLOR_BGR2RGB)
-
-        # Image feature encoding
-        predictor.set_image(test_image)
-        test_feat = predictor.features.squeeze()
-
-        # Cosine similarity
-        C, h, w = test_feat.shape
-        test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
-        test_feat = test_feat.reshape(C, h * w)
-        sim = target_feat @ test_feat
-
-        sim = sim.reshape(1, 1, h, w)
-        sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
-        sim = predictor.model.postprocess_masks(
-                        sim,
-                        input_size=predictor.input_size,
-                        original_size=predictor.original_size).squeeze()
-
-        # Positive-negative location prior
-        topk_xy_i, topk_label_i, last_xy_i, last_label_i = point_selection(sim, topk=1)
-        topk_xy = np.concatenate([topk_xy_i, last_xy_i], axis=0)
-        topk_label = np.concatenate([topk_label_i, last_label_i], axis=0)
-
-        # Obtain the target guidance for cross-attention layers
-        sim = (sim - sim.mean()) / torch.std(sim)
-        sim = F.interpolate(sim.unsqueeze(0).unsqueeze(0), size=(64, 64), mode="bilinear")
-        attn_sim = sim.sigmoid_().unsqueeze(0).flatten(3)
-
-        # First-step prediction
-        masks, scores, logits, _ = predictor.predict(
-            point_coords=topk_xy, 
-            point_labels=topk_label, 
-            multimask_output=False,
-            attn_sim=attn_sim,  # Target-guided Attention
-            target_embedding=target_embedding  # Target-semantic Prompting
-        )
-        best_idx = 0
-
-        # Cascaded Post-refinement-1
-        masks, scores, logits, _ = predictor.predict(
-                    point_coords=topk_xy,
-                    point_labels=topk_label,
-                    mask_input=logits[best_idx: best_idx + 1, :, :], 
-                    multimask_output=True)
-        best_idx = np.argmax(scores)
-
-        # Cascaded Post-refinement-2
-        y, x = np.nonzero(masks[best_idx])
-        x_min = x.min()
-        x_max = x.max()
-        y_min = y.min()
-        y_max = y.max()
-        input_box = np.array([x_min, y_min, x_max, y_max])
-        masks, scores, logits, _ = predictor.predict(
-            point_coords=topk_xy,
-            point_labels=topk_label,
-            box=input_box[None, :],
-            mask_input=logits[best_idx: best_idx + 1, :, :], 
-            multimask_output=True)
-        best_idx = np.argmax(scores)
+        final_mask, best_idx = result['mask'], result['mask_index']
+        topk_xy, topk_label = result['point_coords'], result['point_labels']
 
         # Save masks
         plt.figure(figsize=(10, 10))
-        plt.subplot(1, 2, 1)
-        plt.imshow(ref_image)
-
-        plt.subplot(1, 2, 2)
+        if ref_image is not None:
+            plt.subplot(1, 2, 1)
+            plt.imshow(ref_image)
+            plt.subplot(1, 2, 2)
         plt.imshow(test_image)
-        show_mask(masks[best_idx], plt.gca())
+        show_mask(final_mask, plt.gca())
         show_points(topk_xy, topk_label, plt.gca())
         plt.title(f"Mask {best_idx}", fontsize=18)
         plt.axis('off')
@@ -179,33 +175,11 @@ def persam(args, obj_name, images_path, masks_path, output_path):
         with open(vis_mask_output_path, 'wb') as outfile:
             plt.savefig(outfile, format='jpg')
 
-        final_mask = masks[best_idx]
         mask_colors = np.zeros((final_mask.shape[0], final_mask.shape[1], 3), dtype=np.uint8)
         mask_colors[final_mask, :] = np.array([[0, 0, 128]])
         mask_output_path = os.path.join(output_path, test_idx + '.png')
         cv2.imwrite(mask_output_path, mask_colors)
 
 
-def point_selection(mask_sim, topk=1):
-    # Top-1 point selection
-    w, h = mask_sim.shape
-    topk_xy = mask_sim.flatten(0).topk(topk)[1]
-    topk_x = (topk_xy // h).unsqueeze(0)
-    topk_y = (topk_xy - topk_x * h)
-    topk_xy = torch.cat((topk_y, topk_x), dim=0).permute(1, 0)
-    topk_label = np.array([1] * topk)
-    topk_xy = topk_xy.cpu().numpy()
-        
-    # Top-last point selection
-    last_xy = mask_sim.flatten(0).topk(topk, largest=False)[1]
-    last_x = (last_xy // h).unsqueeze(0)
-    last_y = (last_xy - last_x * h)
-    last_xy = torch.cat((last_y, last_x), dim=0).permute(1, 0)
-    last_label = np.array([0] * topk)
-    last_xy = last_xy.cpu().numpy()
-    
-    return topk_xy, topk_label, last_xy, last_label
-    
-
 if __name__ == "__main__":
     main()
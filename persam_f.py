@@ -4,6 +4,7 @@ import torch.nn as nn
 from torch.nn import functional as F
 
 import os
+import time
 import cv2
 from tqdm import tqdm
 import argparse
@@ -12,9 +13,13 @@ import warnings
 warnings.filterwarnings('ignore')
 
 from show import *
-from per_segment_anything import sam_model_registry, SamPredictor
+from per_segment_anything import load_sam, SamPredictor, Concept, ConceptLibrary
+from per_segment_anything.persam_engine import low_res_point_selection
+from per_segment_anything.utils.embedding_cache import EmbeddingCache, sam_model_id
 
 
+sam_checkpoints = {'vit_h': 'sam_vit_h_4b8939.pth', 'vit_t': 'weights/mobile_sam.pt'}
+
 
 def get_arguments():
     
@@ -24,11 +29,24 @@ def get_arguments():
     parser.add_argument('--outdir', type=str, default='persam_f')
     parser.add_argument('--ckpt', type=str, default='./sam_vit_h_4b8939.pth')
     parser.add_argument('--sam_type', type=str, default='vit_h')
+    parser.add_argument('--optimize', action='store_true', help='fuse Conv-BN and freeze attention biases of vit_t')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--cache_dir', type=str, default=None, help='reuse image embeddings across runs')
+    parser.add_argument('--cache_size_gb', type=float, default=10.0)
+    parser.add_argument('--low_res_prior', action='store_true', help='select points on the embedding grid')
+    parser.add_argument('--subpixel', action='store_true', help='refine low-res points to sub-pixel precision')
+    parser.add_argument('--image_size', type=int, default=1024, help='encoder input size, e.g. 512 for fast previews')
 
     parser.add_argument('--lr', type=float, default=1e-3) 
     parser.add_argument('--train_epoch', type=int, default=1000)
     parser.add_argument('--log_epoch', type=int, default=200)
     parser.add_argument('--ref_idx', type=str, default='00')
+    parser.add_argument('--cached_logits', action='store_true', help='run the decoder once and train on its logits')
+    parser.add_argument('--train_size', type=int, default=None,
+                        help='long side of the grid the cached logits are trained on, full resolution by default')
+    parser.add_argument('--batch_concepts', type=int, default=None,
+                        help='train the mask weights of this many objects at once, on cached logits')
+    parser.add_argument('--concept_dir', type=str, default=None, help='load and save the concepts of a concept library')
     
     args = parser.parse_args()
     return args
@@ -45,107 +63,125 @@ def main():
 
     if not os.path.exists('./outputs/'):
         os.mkdir('./outputs/')
-    
-    for obj_name in os.listdir(images_path):
-        if ".DS" not in obj_name:
-            persam_f(args, obj_name, images_path, masks_path, output_path)
-
 
-def persam_f(args, obj_name, images_path, masks_path, output_path):
-    
-    print("\n------------> Segment " + obj_name)
-    
-    # Path preparation
-    ref_image_path = os.path.join(images_path, obj_name, args.ref_idx + '.jpg')
-    ref_mask_path = os.path.join(masks_path, obj_name, args.ref_idx + '.png')
-    test_images_path = os.path.join(images_path, obj_name)
-
-    output_path = os.path.join(output_path, obj_name)
-    os.makedirs(output_path, exist_ok=True)
-
-    # Load images and masks
-    ref_image = cv2.imread(ref_image_path)
-    ref_image = cv2.cvtColor(ref_image, cv2.COLOR_BGR2RGB)
+    # The model is loaded once and shared by all the objects
+    predictor = load_predictor(args)
+
+    # Trained concepts already in the library are used without their reference image
+    library, model_id = None, None
+    if args.concept_dir is not None:
+        library = ConceptLibrary(args.concept_dir)
+        model_id = sam_model_id(predictor.model, args.sam_type, sam_checkpoints[args.sam_type])
+
+    obj_names = [obj_name for obj_name in os.listdir(images_path) if ".DS" not in obj_name]
+    if args.batch_concepts is None:
+        for obj_name in obj_names:
+            persam_f(args, predictor, obj_name, images_path, masks_path, output_path, library, model_id)
+        return
+
+    untrained_names = []
+    for obj_name in obj_names:
+        concept = load_trained_concept(library, obj_name, predictor, model_id)
+        if concept is None:
+            untrained_names.append(obj_name)
+            continue
+        print("\n------------> Segment " + obj_name)
+        test(args, predictor, obj_name, concept.target_feat, concept.mask_weights, images_path, output_path)
+
+    # The mask weights of a batch of objects are trained together, with one optimizer
+    for start in range(0, len(untrained_names), args.batch_concepts):
+        batch_names = untrained_names[start: start + args.batch_concepts]
+        concepts, cached_logits, train_gts = [], [], []
+        for obj_name in batch_names:
+            print("\n------------> Prepare " + obj_name)
+            concept, topk_xy, topk_label, gt_mask = prepare_reference(
+                args, predictor, obj_name, images_path, masks_path, model_id)
+            logits_high, train_gt = three_scale_logits(predictor, topk_xy, topk_label, gt_mask, args.train_size)
+            concepts.append(concept)
+            cached_logits.append(logits_high)
+            train_gts.append(train_gt)
+
+        print('\n======> Start Training {} objects'.format(len(batch_names)))
+        batch_weights = train_mask_weights_batched(args, cached_logits, train_gts)
+        del cached_logits, train_gts
+
+        for obj_name, concept, weights in zip(batch_names, concepts, batch_weights):
+            concept.mask_weights = weights
+            if library is not None:
+                library.add(concept)
+            print("\n------------> Segment " + obj_name)
+            print('======> Mask weights:\n', weights.cpu().numpy())
+            test(args, predictor, obj_name, concept.target_feat, weights, images_path, output_path)
+
+
+def load_predictor(args):
 
-    ref_mask = cv2.imread(ref_mask_path)
-    ref_mask = cv2.cvtColor(ref_mask, cv2.COLOR_BGR2RGB)
-
-    gt_mask = torch.tensor(ref_mask)[:, :, 0] > 0 
-    gt_mask = gt_mask.float().unsqueeze(0).flatten(1).cuda()
-
-    
     print("======> Load SAM" )
     if args.sam_type == 'vit_h':
-        sam_type, sam_ckpt = 'vit_h', 'sam_vit_h_4b8939.pth'
-        sam = sam_model_registry[sam_type](checkpoint=sam_ckpt).cuda()
+        sam_type, sam_ckpt = 'vit_h', sam_checkpoints['vit_h']
+        sam = load_sam(sam_type, sam_ckpt, device='cuda', precision=args.precision, image_size=args.image_size)
     elif args.sam_type == 'vit_t':
-        sam_type, sam_ckpt = 'vit_t', 'weights/mobile_sam.pt'
+        sam_type, sam_ckpt = 'vit_t', sam_checkpoints['vit_t']
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        sam = sam_model_registry[sam_type](checkpoint=sam_ckpt).to(device=device)
-        sam.eval()
-    
-    
-    for name, param in sam.named_parameters():
-        param.requires_grad = False
-    predictor = SamPredictor(sam)
+        sam = load_sam(
+            sam_type, sam_ckpt, device=device, precision=args.precision, optimize_for_inference=args.optimize,
+            image_size=args.image_size)
+
+    embedding_cache = None
+    if args.cache_dir is not None:
+        embedding_cache = EmbeddingCache(
+            args.cache_dir, sam_model_id(sam, sam_type, sam_ckpt), max_size_gb=args.cache_size_gb)
+    return SamPredictor(sam, embedding_cache=embedding_cache)
+
+
+def persam_f(args, predictor, obj_name, images_path, masks_path, output_path, library=None, model_id=None):
     
+    print("\n------------> Segment " + obj_name)
 
-    print("======> Obtain Self Location Prior" )
-    # Image features encoding
-    ref_mask = predictor.set_image(ref_image, ref_mask)
-    ref_feat = predictor.features.squeeze().permute(1, 2, 0)
-
-    ref_mask = F.interpolate(ref_mask, size=ref_feat.shape[0: 2], mode="bilinear")
-    ref_mask = ref_mask.squeeze()[0]
-
-    # Target feature extraction
-    target_feat = ref_feat[ref_mask > 0]
-    target_feat_mean = target_feat.mean(0)
-    target_feat_max = torch.max(target_feat, dim=0)[0]
-    target_feat = (target_feat_max / 2 + target_feat_mean / 2).unsqueeze(0)
-
-    # Cosine similarity
-    h, w, C = ref_feat.shape
-    target_feat = target_feat / target_feat.norm(dim=-1, keepdim=True)
-    ref_feat = ref_feat / ref_feat.norm(dim=-1, keepdim=True)
-    ref_feat = ref_feat.permute(2, 0, 1).reshape(C, h * w)
-    sim = target_feat @ ref_feat
-
-    sim = sim.reshape(1, 1, h, w)
-    sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
-    sim = predictor.model.postprocess_masks(
-                    sim,
-                    input_size=predictor.input_size,
-                    original_size=predictor.original_size).squeeze()
+    concept = load_trained_concept(library, obj_name, predictor, model_id)
+    if concept is not None:
+        print("======> Load Concept" )
+        test(args, predictor, obj_name, concept.target_feat, concept.mask_weights, images_path, output_path)
+        return
 
-    # Positive location prior
-    topk_xy, topk_label = point_selection(sim, topk=1)
+    concept, topk_xy, topk_label, gt_mask = prepare_reference(
+        args, predictor, obj_name, images_path, masks_path, model_id)
 
 
     print('======> Start Training')
     # Learnable mask weights
-    mask_weights = Mask_Weights().cuda()
+    mask_weights = Mask_Weights().to(predictor.device)
     mask_weights.train()
     
     optimizer = torch.optim.AdamW(mask_weights.parameters(), lr=args.lr, eps=1e-4)
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, args.train_epoch)
 
+    train_gt = gt_mask
+    if args.cached_logits:
+        # SAM and the prompts are frozen, so the three-scale logits are the same
+        # at every epoch: run the decoder once and only re-weight them
+        cached_logits, train_gt = three_scale_logits(predictor, topk_xy, topk_label, gt_mask, args.train_size)
+
+    start_time = time.perf_counter()
     for train_idx in range(args.train_epoch):
 
         # Run the decoder
-        masks, scores, logits, logits_high = predictor.predict(
-            point_coords=topk_xy,
-            point_labels=topk_label,
-            multimask_output=True)
-        logits_high = logits_high.flatten(1)
+        if args.cached_logits:
+            logits_high = cached_logits
+        else:
+            masks, scores, logits, logits_high = predictor.predict(
+                point_coords=topk_xy,
+                point_labels=topk_label,
+                multimask_output=True)
+            logits_high = logits_high.flatten(1)
 
         # Weighted sum three-scale masks
         weights = torch.cat((1 - mask_weights.weights.sum(0).unsqueeze(0), mask_weights.weights), dim=0)
         logits_high = logits_high * weights
         logits_high = logits_high.sum(0).unsqueeze(0)
 
-        dice_loss = calculate_dice_loss(logits_high, gt_mask)
-        focal_loss = calculate_sigmoid_focal_loss(logits_high, gt_mask)
+        dice_loss = calculate_dice_loss(logits_high, train_gt)
+        focal_loss = calculate_sigmoid_focal_loss(logits_high, train_gt)
         loss = dice_loss + focal_loss
 
         optimizer.zero_grad()
@@ -159,11 +195,65 @@ def persam_f(args, obj_name, images_path, masks_path, output_path):
             print('LR: {:.6f}, Dice_Loss: {:.4f}, Focal_Loss: {:.4f}'.format(current_lr, dice_loss.item(), focal_loss.item()))
 
 
+    if predictor.device.type == 'cuda':
+        torch.cuda.synchronize(predictor.device)
+    print('Training time: {:.1f} ms'.format(1000 * (time.perf_counter() - start_time)))
+
     mask_weights.eval()
     weights = torch.cat((1 - mask_weights.weights.sum(0).unsqueeze(0), mask_weights.weights), dim=0)
     weights_np = weights.detach().cpu().numpy()
     print('======> Mask weights:\n', weights_np)
 
+    concept.mask_weights = weights.detach()
+    if library is not None:
+        library.add(concept)
+
+    test(args, predictor, obj_name, concept.target_feat, concept.mask_weights, images_path, output_path)
+
+
+def load_trained_concept(library, obj_name, predictor, model_id):
+    # The concept of an object from the library if it has learned mask weights, else None
+    if library is None or obj_name not in library or not library.summary(obj_name)['mask_weights']:
+        return None
+    return library.load(obj_name, device=predictor.device, model_id=model_id)
+
+
+def prepare_reference(args, predictor, obj_name, images_path, masks_path, model_id=None):
+    # Encodes the reference image, leaving it set in the predictor, and returns its concept,
+    # the location prior on the reference and the flattened 1 x H*W reference mask
+
+    # Path preparation
+    ref_image_path = os.path.join(images_path, obj_name, args.ref_idx + '.jpg')
+    ref_mask_path = os.path.join(masks_path, obj_name, args.ref_idx + '.png')
+
+    # Load images and masks
+    ref_image = cv2.imread(ref_image_path)
+    ref_image = cv2.cvtColor(ref_image, cv2.COLOR_BGR2RGB)
+
+    ref_mask = cv2.imread(ref_mask_path)
+    ref_mask = cv2.cvtColor(ref_mask, cv2.COLOR_BGR2RGB)
+
+    gt_mask = torch.tensor(ref_mask)[:, :, 0] > 0 
+    gt_mask = gt_mask.float().unsqueeze(0).flatten(1).to(predictor.device)
+
+
+    print("======> Obtain Self Location Prior" )
+    # Image features encoding and target feature extraction, mixing max and mean
+    concept = Concept.from_reference(predictor, ref_image, ref_mask, obj_name, max_weight=0.5, model_id=model_id)
+
+    # Positive location prior
+    sim = embedding_similarity(predictor, concept.target_feat)
+    topk_xy, topk_label = location_prior(sim, predictor, args.low_res_prior, args.subpixel)
+    return concept, topk_xy, topk_label, gt_mask
+
+
+def test(args, predictor, obj_name, target_feat, weights, images_path, output_path):
+    # Segments the test images of an object with its 3 x 1 mask weights
+
+    test_images_path = os.path.join(images_path, obj_name)
+    output_path = os.path.join(output_path, obj_name)
+    os.makedirs(output_path, exist_ok=True)
+
     print('======> Start Testing')
     for test_idx in tqdm(range(len(os.listdir(test_images_path)))):
 
@@ -175,72 +265,15 @@ def persam_f(args, obj_name, images_path, masks_path, output_path):
 
         # Image feature encoding
         predictor.set_image(test_image)
-        test_feat = predictor.features.squeeze()
-
-        # Cosine similarity
-        C, h, w = test_feat.shape
-        test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
-        test_feat = test_feat.reshape(C, h * w)
-        sim = target_feat @ test_feat
-
-        sim = sim.reshape(1, 1, h, w)
-        sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
-        sim = predictor.model.postprocess_masks(
-                        sim,
-                        input_size=predictor.input_size,
-                        original_size=predictor.original_size).squeeze()
-
-        # Positive location prior
-        topk_xy, topk_label = point_selection(sim, topk=1)
-
-        # First-step prediction
-        masks, scores, logits, logits_high = predictor.predict(
-                    point_coords=topk_xy,
-                    point_labels=topk_label,
-                    multimask_output=True)
 
-        # Weighted sum three-scale masks
-        logits_high = logits_high * weights.unsqueeze(-1)
-        logit_high = logits_high.sum(0)
-        mask = (logit_high > 0).detach().cpu().numpy()
-
-        logits = logits * weights_np[..., None]
-        logit = logits.sum(0)
+        # Location prior, weighted three-scale masks and cascaded post-refinement
+        final_mask, best_idx, topk_xy, topk_label = segment(
+            predictor, target_feat, weights, args.low_res_prior, args.subpixel)
 
-        # Cascaded Post-refinement-1
-        y, x = np.nonzero(mask)
-        x_min = x.min()
-        x_max = x.max()
-        y_min = y.min()
-        y_max = y.max()
-        input_box = np.array([x_min, y_min, x_max, y_max])
-        masks, scores, logits, _ = predictor.predict(
-            point_coords=topk_xy,
-            point_labels=topk_label,
-            box=input_box[None, :],
-            mask_input=logit[None, :, :],
-            multimask_output=True)
-        best_idx = np.argmax(scores)
-
-        # Cascaded Post-refinement-2
-        y, x = np.nonzero(masks[best_idx])
-        x_min = x.min()
-        x_max = x.max()
-        y_min = y.min()
-        y_max = y.max()
-        input_box = np.array([x_min, y_min, x_max, y_max])
-        masks, scores, logits, _ = predictor.predict(
-            point_coords=topk_xy,
-            point_labels=topk_label,
-            box=input_box[None, :],
-            mask_input=logits[best_idx: best_idx + 1, :, :],
-            multimask_output=True)
-        best_idx = np.argmax(scores)
-        
         # Save masks
         plt.figure(figsize=(10, 10))
         plt.imshow(test_image)
-        show_mask(masks[best_idx], plt.gca())
+        show_mask(final_mask, plt.gca())
         show_points(topk_xy, topk_label, plt.gca())
         plt.title(f"Mask {best_idx}", fontsize=18)
         plt.axis('off')
@@ -248,19 +281,167 @@ def persam_f(args, obj_name, images_path, masks_path, output_path):
         with open(vis_mask_output_path, 'wb') as outfile:
             plt.savefig(outfile, format='jpg')
 
-        final_mask = masks[best_idx]
         mask_colors = np.zeros((final_mask.shape[0], final_mask.shape[1], 3), dtype=np.uint8)
         mask_colors[final_mask, :] = np.array([[0, 0, 128]])
         mask_output_path = os.path.join(output_path, test_idx + '.png')
         cv2.imwrite(mask_output_path, mask_colors)
 
 
+def three_scale_logits(predictor, topk_xy, topk_label, gt_mask, train_size=None):
+    # The 3 x H*W high-res logits of the reference and the matching 1 x H*W target,
+    # optionally resized so that their long side is train_size. Resizing is linear,
+    # so it commutes with the weighted sum of the logits.
+    _, _, _, logits_high = predictor.predict(
+        point_coords=topk_xy,
+        point_labels=topk_label,
+        multimask_output=True)
+    if train_size is None:
+        return logits_high.flatten(1), gt_mask
+
+    h, w = logits_high.shape[-2:]
+    scale = train_size / max(h, w)
+    size = (max(1, int(h * scale + 0.5)), max(1, int(w * scale + 0.5)))
+    logits_high = F.interpolate(logits_high.unsqueeze(0), size=size, mode="bilinear", align_corners=False)[0]
+    gt_mask = F.interpolate(gt_mask.view(1, 1, h, w), size=size, mode="area")
+    return logits_high.flatten(1), gt_mask.flatten(1)
+
+
+def train_mask_weights_batched(args, cached_logits, train_gts):
+    # Trains the mask weights of N objects at once, from their 3 x P_i cached logits and
+    # 1 x P_i targets, and returns N x 3 x 1 weights. Objects are padded to the largest
+    # P_i and the padding is left out of the losses. The losses are summed over the
+    # objects and AdamW is element-wise, so each object gets the same updates as when
+    # trained alone with --cached_logits.
+    num_concepts = len(cached_logits)
+    num_pixels = max(logits_high.shape[-1] for logits_high in cached_logits)
+    device = cached_logits[0].device
+
+    batch_logits = torch.zeros(num_concepts, 3, num_pixels, device=device)
+    batch_gt = torch.zeros(num_concepts, num_pixels, device=device)
+    valid = torch.zeros(num_concepts, num_pixels, dtype=torch.bool, device=device)
+    for i, (logits_high, train_gt) in enumerate(zip(cached_logits, train_gts)):
+        batch_logits[i, :, :logits_high.shape[-1]] = logits_high
+        batch_gt[i, :train_gt.shape[-1]] = train_gt[0]
+        valid[i, :train_gt.shape[-1]] = True
+
+    # Learnable mask weights
+    mask_weights = Batched_Mask_Weights(num_concepts).to(device)
+    mask_weights.train()
+
+    optimizer = torch.optim.AdamW(mask_weights.parameters(), lr=args.lr, eps=1e-4)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, args.train_epoch)
+
+    start_time = time.perf_counter()
+    for train_idx in range(args.train_epoch):
+
+        # Weighted sum three-scale masks
+        weights = torch.cat((1 - mask_weights.weights.sum(1, keepdim=True), mask_weights.weights), dim=1)
+        logits_high = (batch_logits * weights).sum(1)
+
+        dice_loss = calculate_dice_loss(logits_high, batch_gt, valid=valid)
+        focal_loss = calculate_sigmoid_focal_loss(logits_high, batch_gt, valid=valid)
+        loss = dice_loss + focal_loss
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        scheduler.step()
+
+        if train_idx % args.log_epoch == 0:
+            print('Train Epoch: {:} / {:}'.format(train_idx, args.train_epoch))
+            current_lr = scheduler.get_last_lr()[0]
+            print('LR: {:.6f}, Mean Dice_Loss: {:.4f}, Mean Focal_Loss: {:.4f}'.format(
+                current_lr, dice_loss.item() / num_concepts, focal_loss.item() / num_concepts))
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    print('Training time: {:.1f} ms'.format(1000 * (time.perf_counter() - start_time)))
+
+    mask_weights.eval()
+    weights = torch.cat((1 - mask_weights.weights.sum(1, keepdim=True), mask_weights.weights), dim=1)
+    return weights.detach()
+
+
 class Mask_Weights(nn.Module):
     def __init__(self):
         super().__init__()
         self.weights = nn.Parameter(torch.ones(2, 1, requires_grad=True) / 3)
 
 
+class Batched_Mask_Weights(nn.Module):
+    def __init__(self, num_concepts):
+        super().__init__()
+        self.weights = nn.Parameter(torch.ones(num_concepts, 2, 1, requires_grad=True) / 3)
+
+
+@torch.no_grad()
+def segment(predictor, target_feat, weights, low_res=False, subpixel=False, topk=1, refinement=2):
+    # The PerSAM-F test cascade on the set image: location prior, weighted sum of the
+    # three-scale masks with the 3 x 1 weights and 0 to 2 cascaded post-refinement steps.
+    # Returns the mask, the index of the last selected mask (None without refinement)
+    # and the point prompts.
+    sim = embedding_similarity(predictor, target_feat)
+    topk_xy, topk_label = location_prior(sim, predictor, low_res, subpixel, topk)
+
+    # First-step prediction
+    masks, scores, logits, logits_high = predictor.predict(
+                point_coords=topk_xy,
+                point_labels=topk_label,
+                multimask_output=True)
+
+    # Weighted sum three-scale masks
+    logit_high = (logits_high * weights.unsqueeze(-1)).sum(0)
+    mask = (logit_high > 0).cpu().numpy()
+    logit = (logits * weights.cpu().numpy()[..., None]).sum(0)
+
+    # Cascaded post-refinement, each step prompted with the box and logits of the last mask
+    best_idx = None
+    for _ in range(refinement):
+        y, x = np.nonzero(mask)
+        if len(x) == 0:
+            break
+        input_box = np.array([x.min(), y.min(), x.max(), y.max()])
+        masks, scores, logits, _ = predictor.predict(
+            point_coords=topk_xy,
+            point_labels=topk_label,
+            box=input_box[None, :],
+            mask_input=logit[None, :, :],
+            multimask_output=True)
+        best_idx = np.argmax(scores)
+        mask, logit = masks[best_idx], logits[best_idx]
+    return mask, best_idx, topk_xy, topk_label
+
+
+def embedding_similarity(predictor, target_feat):
+    # Cosine similarity of the target feature to the embedding of the set image, 1x1xhxw
+    feat = predictor.features.squeeze()
+    C, h, w = feat.shape
+    feat = feat / feat.norm(dim=0, keepdim=True)
+    sim = target_feat @ feat.reshape(C, h * w)
+    return sim.reshape(1, 1, h, w)
+
+
+def location_prior(sim, predictor, low_res=False, subpixel=False, topk=1):
+    # Top-k points of a 1x1xhxw similarity map, optionally without upsampling it
+    if low_res:
+        topk_xy, topk_label = low_res_point_selection(
+            sim.squeeze(),
+            predictor.input_size,
+            predictor.original_size,
+            predictor.model.image_encoder.img_size,
+            topk=topk,
+            negative=False,
+            subpixel=subpixel)
+        return topk_xy.cpu().numpy(), topk_label.cpu().numpy()
+
+    sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
+    sim = predictor.model.postprocess_masks(
+                    sim,
+                    input_size=predictor.input_size,
+                    original_size=predictor.original_size).squeeze()
+    return point_selection(sim, topk=topk)
+
+
 def point_selection(mask_sim, topk=1):
     # Top-1 point selection
     w, h = mask_sim.shape
@@ -274,7 +455,7 @@ def point_selection(mask_sim, topk=1):
     return topk_xy, topk_label
 
 
-def calculate_dice_loss(inputs, targets, num_masks = 1):
+def calculate_dice_loss(inputs, targets, num_masks = 1, valid = None):
     """
     Compute the DICE loss, similar to generalized IOU for masks
     Args:
@@ -283,8 +464,12 @@ def calculate_dice_loss(inputs, targets, num_masks = 1):
         targets: A float tensor with the same shape as inputs. Stores the binary
                  classification label for each element in inputs
                 (0 for the negative class and 1 for the positive class).
+        valid: (optional) A bool tensor with the same shape as inputs, False on
+               padding, which is left out of the loss. Targets must be 0 there.
     """
     inputs = inputs.sigmoid()
+    if valid is not None:
+        inputs = inputs * valid
     inputs = inputs.flatten(1)
     numerator = 2 * (inputs * targets).sum(-1)
     denominator = inputs.sum(-1) + targets.sum(-1)
@@ -292,7 +477,7 @@ def calculate_dice_loss(inputs, targets, num_masks = 1):
     return loss.sum() / num_masks
 
 
-def calculate_sigmoid_focal_loss(inputs, targets, num_masks = 1, alpha: float = 0.25, gamma: float = 2):
+def calculate_sigmoid_focal_loss(inputs, targets, num_masks = 1, alpha: float = 0.25, gamma: float = 2, valid = None):
     """
     Loss used in RetinaNet for dense detection: https://arxiv.org/abs/1708.02002.
     Args:
@@ -305,6 +490,8 @@ def calculate_sigmoid_focal_loss(inputs, targets, num_masks = 1, alpha: float =
                 positive vs negative examples. Default = -1 (no weighting).
         gamma: Exponent of the modulating factor (1 - p_t) to
                balance easy vs hard examples.
+        valid: (optional) A bool tensor with the same shape as inputs, False on
+               padding, which is left out of the loss.
     Returns:
         Loss tensor
     """
@@ -317,6 +504,8 @@ def calculate_sigmoid_focal_loss(inputs, targets, num_masks = 1, alpha: float =
         alpha_t = alpha * targets + (1 - alpha) * (1 - targets)
         loss = alpha_t * loss
 
+    if valid is not None:
+        return ((loss * valid).sum(1) / valid.sum(1)).sum() / num_masks
     return loss.mean(1).sum() / num_masks
 
 
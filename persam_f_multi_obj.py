@@ -12,7 +12,7 @@ import warnings
 warnings.filterwarnings('ignore')
 
 from show import *
-from per_segment_anything import sam_model_registry, SamPredictor
+from per_segment_anything import load_sam, SamPredictor, Concept, PerSAMEngine
 
 
 
@@ -33,6 +33,10 @@ def get_arguments():
     
     parser.add_argument('--max_objects', type=int, default=10)
     parser.add_argument('--iou_threshold', type=float, default=0.8)
+    parser.add_argument('--single_encode', action='store_true',
+                        help='encode each test image once and suppress found objects on the similarity map')
+    parser.add_argument('--proposals', action='store_true',
+                        help='decode the similarity peaks of each test image at once and remove duplicates with NMS')
     
     args = parser.parse_args()
     return args
@@ -60,74 +64,35 @@ def persam_f(args, obj_name, images_path, masks_path, output_path):
     print("======> Load SAM" )
     if args.sam_type == 'vit_h':
         sam_type, sam_ckpt = 'vit_h', 'sam_vit_h_4b8939.pth'
-        sam = sam_model_registry[sam_type](checkpoint=sam_ckpt).cuda()
+        sam = load_sam(sam_type, sam_ckpt, device='cuda')
     elif args.sam_type == 'vit_t':
         sam_type, sam_ckpt = 'vit_t', 'weights/mobile_sam.pt'
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        sam = sam_model_registry[sam_type](checkpoint=sam_ckpt).to(device=device)
-        sam.eval()
-    
-    
-    for name, param in sam.named_parameters():
-        param.requires_grad = False
+        sam = load_sam(sam_type, sam_ckpt, device=device)
+
+    # load_sam only loads the model for the first object
     predictor = SamPredictor(sam)
 
     print("\n------------> Segment " + obj_name)
+    output_path = os.path.join(output_path, obj_name)
+    os.makedirs(output_path, exist_ok=True)
+    test_images_path = os.path.join(images_path, obj_name)
+
+    # Every training reference is decoded and encoded once, not once per outer epoch
+    references = prepare_references(args, predictor, obj_name, images_path, masks_path)
+
     for i in tqdm(range(args.train_epoch_outside)):
-        output_path = os.path.join(output_path, obj_name)
-        os.makedirs(output_path, exist_ok=True)
-        training_size = int(len(os.listdir(os.path.join(images_path, obj_name)))  * args.training_percentage)
-        for ref_idx in range(training_size):
-            # Path preparation
-            ref_image_path = os.path.join(images_path, obj_name, '{:02}.jpg'.format(ref_idx))
-            ref_mask_path = os.path.join(masks_path, obj_name, '{:02}.png'.format(ref_idx))
-            test_images_path = os.path.join(images_path, obj_name)
-
-            # Load images and masks
-            ref_image = cv2.imread(ref_image_path)
-            ref_image = cv2.cvtColor(ref_image, cv2.COLOR_BGR2RGB)
-
-            ref_mask = cv2.imread(ref_mask_path)
-            ref_mask = cv2.cvtColor(ref_mask, cv2.COLOR_BGR2RGB)
-
-            gt_mask = torch.tensor(ref_mask)[:, :, 0] > 0 
-            gt_mask = gt_mask.float().unsqueeze(0).flatten(1).cuda()
-            
-            # print("======> Obtain Self Location Prior" )
-            # Image features encoding
-            ref_mask = predictor.set_image(ref_image, ref_mask)
-            ref_feat = predictor.features.squeeze().permute(1, 2, 0)
-
-            ref_mask = F.interpolate(ref_mask, size=ref_feat.shape[0: 2], mode="bilinear")
-            ref_mask = ref_mask.squeeze()[0]
-
-            # Target feature extraction
-            target_feat = ref_feat[ref_mask > 0]
-            target_feat_mean = target_feat.mean(0)
-            target_feat_max = torch.max(target_feat, dim=0)[0]
-            target_feat = (target_feat_max / 2 + target_feat_mean / 2).unsqueeze(0)
-
-            # Cosine similarity
-            h, w, C = ref_feat.shape
-            target_feat = target_feat / target_feat.norm(dim=-1, keepdim=True)
-            ref_feat = ref_feat / ref_feat.norm(dim=-1, keepdim=True)
-            ref_feat = ref_feat.permute(2, 0, 1).reshape(C, h * w)
-            sim = target_feat @ ref_feat
-
-            sim = sim.reshape(1, 1, h, w)
-            sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
-            sim = predictor.model.postprocess_masks(
-                            sim,
-                            input_size=predictor.input_size,
-                            original_size=predictor.original_size).squeeze()
-
-            # Positive location prior
-            topk_xy, topk_label = point_selection(sim, topk=1)
+        for reference in references:
+            predictor.set_state(reference['state'])
+            gt_mask = reference['gt_mask']
+            target_feat = reference['target_feat']
+            target_embedding = reference['target_embedding']
+            topk_xy, topk_label = reference['topk_xy'], reference['topk_label']
 
 
             # print('======> Start Training')
             # Learnable mask weights
-            mask_weights = Mask_Weights().cuda()
+            mask_weights = Mask_Weights().to(predictor.device)
             mask_weights.train()
             
             optimizer = torch.optim.AdamW(mask_weights.parameters(), lr=args.lr, eps=1e-4)
@@ -165,6 +130,10 @@ def persam_f(args, obj_name, images_path, masks_path, output_path):
             # print('======> Mask weights:\n', weights_np)
         print('LR: {:.6f}, Dice_Loss: {:.4f}, Focal_Loss: {:.4f}'.format(current_lr, dice_loss.item(), focal_loss.item()))
 
+    if args.proposals:
+        # The reference features are fixed, one engine serves every test image
+        engine = PerSAMEngine(predictor, target_feat, target_embedding)
+
     print('======> Start Testing')
     for test_idx in tqdm(range(len(os.listdir(test_images_path)))):
 
@@ -175,34 +144,39 @@ def persam_f(args, obj_name, images_path, masks_path, output_path):
         test_image = cv2.cvtColor(test_image, cv2.COLOR_BGR2RGB)
         test_image_original = cv2.imread(test_image_path)
         test_image_original = cv2.cvtColor(test_image_original, cv2.COLOR_BGR2RGB)
+
+        if args.proposals:
+            segment_proposals(args, engine, weights.detach(), test_image, test_idx, output_path)
+            continue
         
         history_masks = []
         plt.figure(figsize=(10, 10))
-        for i in tqdm(range(args.max_objects)):
-            # Image feature encoding
+        if args.single_encode:
+            # One encoder pass per test image, found objects are excluded from the
+            # similarity map and their points are given as negative prompts
             predictor.set_image(test_image)
-            test_feat = predictor.features.squeeze()
-
-            # Cosine similarity
-            C, h, w = test_feat.shape
-            test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
-            test_feat = test_feat.reshape(C, h * w)
-            sim = target_feat @ test_feat
-
-            sim = sim.reshape(1, 1, h, w)
-            sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
-            sim = predictor.model.postprocess_masks(
-                            sim,
-                            input_size=predictor.input_size,
-                            original_size=predictor.original_size).squeeze()
-
-            # Positive location prior
-            topk_xy, topk_label = point_selection(sim, topk=1)
+            sim = similarity_map(predictor, target_feat)
+            found = torch.zeros_like(sim, dtype=torch.bool)
+            negative_xy = np.zeros((0, 2), dtype=np.int64)
+        for i in tqdm(range(args.max_objects)):
+            if args.single_encode:
+                # Positive location prior outside the found objects
+                topk_xy, topk_label = point_selection(sim.masked_fill(found, float('-inf')), topk=1)
+                point_xy = np.concatenate([topk_xy, negative_xy], axis=0)
+                point_label = np.concatenate([topk_label, np.zeros(len(negative_xy), dtype=topk_label.dtype)])
+            else:
+                # Image feature encoding
+                predictor.set_image(test_image)
+                sim = similarity_map(predictor, target_feat)
+
+                # Positive location prior
+                topk_xy, topk_label = point_selection(sim, topk=1)
+                point_xy, point_label = topk_xy, topk_label
 
             # First-step prediction
             masks, scores, logits, logits_high = predictor.predict(
-                        point_coords=topk_xy,
-                        point_labels=topk_label,
+                        point_coords=point_xy,
+                        point_labels=point_label,
                         multimask_output=True)
 
             # Weighted sum three-scale masks
@@ -221,8 +195,8 @@ def persam_f(args, obj_name, images_path, masks_path, output_path):
             y_max = y.max()
             input_box = np.array([x_min, y_min, x_max, y_max])
             masks, scores, logits, _ = predictor.predict(
-                point_coords=topk_xy,
-                point_labels=topk_label,
+                point_coords=point_xy,
+                point_labels=point_label,
                 box=input_box[None, :],
                 mask_input=logit[None, :, :],
                 multimask_output=True)
@@ -236,8 +210,8 @@ def persam_f(args, obj_name, images_path, masks_path, output_path):
             y_max = y.max()
             input_box = np.array([x_min, y_min, x_max, y_max])
             masks, scores, logits, _ = predictor.predict(
-                point_coords=topk_xy,
-                point_labels=topk_label,
+                point_coords=point_xy,
+                point_labels=point_label,
                 box=input_box[None, :],
                 mask_input=logits[best_idx: best_idx + 1, :, :],
                 multimask_output=True)
@@ -248,8 +222,12 @@ def persam_f(args, obj_name, images_path, masks_path, output_path):
             mask_colors = np.zeros((final_mask.shape[0], final_mask.shape[1], 3), dtype=np.uint8)
             mask_colors[final_mask, :] = np.array([[0, 0, 128]])
 
-            mask_bool = mask_colors.sum(axis=2) == 128
-            test_image[mask_bool] = 0
+            if args.single_encode:
+                found |= torch.from_numpy(final_mask).to(found.device)
+                negative_xy = np.concatenate([negative_xy, topk_xy], axis=0)
+            else:
+                mask_bool = mask_colors.sum(axis=2) == 128
+                test_image[mask_bool] = 0
             iou_over_threshold = False
             for h_mask in history_masks:
                 if calculate_iou(h_mask, mask_colors) >= args.iou_threshold:
@@ -272,6 +250,102 @@ def persam_f(args, obj_name, images_path, masks_path, output_path):
 
 
 
+def segment_proposals(args, engine, weights, test_image, test_idx, output_path):
+    # All objects in one shot: the peaks of the similarity map are decoded as a batch of
+    # point prompts and duplicate masks are removed with box NMS
+    engine.predictor.set_image(test_image)
+    instances = engine.propose_instances(
+        num_peaks=args.max_objects, mask_weights=weights, box_nms_thresh=args.iou_threshold)
+
+    plt.figure(figsize=(10, 10))
+    mask_colors = np.zeros((test_image.shape[0], test_image.shape[1], 3), dtype=np.uint8)
+    for instance in instances:
+        show_mask(instance['mask'], plt.gca())
+        show_points(instance['point_coords'], instance['point_labels'], plt.gca())
+        mask_colors[instance['mask'], :] = np.array([[0, 0, 128]])
+
+    # Save masks
+    plt.imshow(test_image)
+    vis_mask_output_path = os.path.join(output_path, f'vis_mask_{test_idx}_objects:{len(instances)}.jpg')
+    with open(vis_mask_output_path, 'wb') as outfile:
+        plt.savefig(outfile, format='jpg')
+
+    mask_output_path = os.path.join(output_path, test_idx + '.png')
+    cv2.imwrite(mask_output_path, mask_colors)
+
+
+def similarity_map(predictor, target_feat):
+    # Cosine similarity of the target feature to the set image, at the original image size
+    test_feat = predictor.features.squeeze()
+
+    # Cosine similarity
+    C, h, w = test_feat.shape
+    test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
+    test_feat = test_feat.reshape(C, h * w)
+    sim = target_feat @ test_feat
+
+    sim = sim.reshape(1, 1, h, w)
+    sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
+    sim = predictor.model.postprocess_masks(
+                    sim,
+                    input_size=predictor.input_size,
+                    original_size=predictor.original_size).squeeze()
+    return sim
+
+
+def prepare_references(args, predictor, obj_name, images_path, masks_path):
+    # Encodes the training references of an object, returning for each one its image state,
+    # its flattened 1 x H*W mask, its target feature and its location prior
+    references = []
+    training_size = int(len(os.listdir(os.path.join(images_path, obj_name)))  * args.training_percentage)
+    for ref_idx in range(training_size):
+        # Path preparation
+        ref_image_path = os.path.join(images_path, obj_name, '{:02}.jpg'.format(ref_idx))
+        ref_mask_path = os.path.join(masks_path, obj_name, '{:02}.png'.format(ref_idx))
+
+        # Load images and masks
+        ref_image = cv2.imread(ref_image_path)
+        ref_image = cv2.cvtColor(ref_image, cv2.COLOR_BGR2RGB)
+
+        ref_mask = cv2.imread(ref_mask_path)
+        ref_mask = cv2.cvtColor(ref_mask, cv2.COLOR_BGR2RGB)
+
+        gt_mask = torch.tensor(ref_mask)[:, :, 0] > 0 
+        gt_mask = gt_mask.float().unsqueeze(0).flatten(1).to(predictor.device)
+        
+        # print("======> Obtain Self Location Prior" )
+        # Image features encoding and target feature extraction, mixing max and mean
+        concept = Concept.from_reference(predictor, ref_image, ref_mask, max_weight=0.5)
+        target_feat = concept.target_feat
+        ref_feat = predictor.features.squeeze()
+
+        # Cosine similarity
+        C, h, w = ref_feat.shape
+        ref_feat = ref_feat / ref_feat.norm(dim=0, keepdim=True)
+        ref_feat = ref_feat.reshape(C, h * w)
+        sim = target_feat @ ref_feat
+
+        sim = sim.reshape(1, 1, h, w)
+        sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
+        sim = predictor.model.postprocess_masks(
+                        sim,
+                        input_size=predictor.input_size,
+                        original_size=predictor.original_size).squeeze()
+
+        # Positive location prior
+        topk_xy, topk_label = point_selection(sim, topk=1)
+
+        references.append({
+            'state': predictor.image_state,
+            'gt_mask': gt_mask,
+            'target_feat': target_feat,
+            'target_embedding': concept.target_embedding,
+            'topk_xy': topk_xy,
+            'topk_label': topk_label,
+        })
+    return references
+
+
 class Mask_Weights(nn.Module):
     def __init__(self):
         super().__init__()
@@ -1,11 +1,14 @@
-import argparse, os
+import argparse, os, math, time
 from PIL import Image
 from os import path
 import numpy as np
+import cv2
 import torch
 from torch.nn import functional as F
 from torch.utils.data import DataLoader
-from per_segment_anything import SamPredictor, sam_model_registry
+from per_segment_anything import ImageState, SamPredictor, load_sam, Concept, ConceptLibrary
+from per_segment_anything.persam_engine import low_res_point_selection
+from per_segment_anything.utils.embedding_cache import sam_model_id
 from davis2017.davis import DAVISTestDataset, all_to_onehot
 from eval_video import eval_davis_result
 
@@ -22,10 +25,17 @@ def main(args):
 
     # Load SAM
     sam_type, sam_ckpt = 'vit_h', 'sam_vit_h_4b8939.pth'
-    sam = sam_model_registry[sam_type](checkpoint=sam_ckpt).cuda()
+    sam = load_sam(sam_type, sam_ckpt, device='cuda')
     predictor = SamPredictor(sam)
 
+    # The first-frame objects already in the library are not encoded again
+    library, model_id = None, None
+    if args.concept_dir is not None:
+        library = ConceptLibrary(args.concept_dir)
+        model_id = sam_model_id(sam, sam_type, sam_ckpt)
+
     # Start eval
+    total_time, total_frames, total_keyframes = 0., 0, 0
     for iter, data in enumerate(test_loader):
         rgb = data['rgb'].cpu().numpy()
         msk = data['gt'][0].cpu().numpy()
@@ -51,61 +61,65 @@ def main(args):
         input_boxes = []
         for k in range(msk[:, 0].shape[0]):
             input_boxes.append(msk[:, 0][k])
+        first_frame_encoded = False
         for obj in range(num_obj):
             print("Processing Object", obj)
             frame_image = first_frame_image
+            concept_name = '{}-{}'.format(name, obj)
+            if library is not None and concept_name in library:
+                concept = library.load(concept_name, device=predictor.device, model_id=model_id)
+                fore_feat_list.append(concept.target_feat)
+                continue
 
             obj_mask = first_frame_mask[obj].reshape(first_frame_mask.shape[1], first_frame_mask.shape[2], 1)
             obj_mask = np.concatenate((obj_mask, np.zeros((obj_mask.shape[0], obj_mask.shape[1], 2), dtype=obj_mask.dtype)), axis=2)
-            obj_mask = predictor.set_image(frame_image, obj_mask)
-            if obj == 0:
-                img_feat1 = predictor.features.squeeze().permute(1, 2, 0)
-            obj_mask = F.interpolate(obj_mask, size=img_feat1.shape[0:2], mode="bilinear")
-            obj_mask = obj_mask.squeeze()[0]
-
-            fore_feat = img_feat1[obj_mask > 0]
-
-            if fore_feat.shape[0] == 0:
-                fore_feat_list.append(fore_feat.mean(0))
+            try:
+                # The first frame is encoded once, later objects only transform their mask
+                concept = Concept.from_reference(predictor, frame_image, obj_mask, concept_name, max_weight=0.5,
+                                                 model_id=model_id, cal_image=not first_frame_encoded)
+            except ValueError:
+                fore_feat_list.append(torch.full_like(predictor.features[0, :, 0, 0], float('nan')))
                 print("Find a small object in", name, "Object", obj)
                 continue
+            finally:
+                first_frame_encoded = True
+
+            fore_feat_list.append(concept.target_feat)
+            if library is not None:
+                library.add(concept)
 
-            fore_feat_mean = fore_feat.mean(0)
-            fore_feat_max = torch.max(fore_feat, dim=0)[0]
-            fore_feat = (fore_feat_max / 2 + fore_feat_mean / 2).unsqueeze(0)
-            fore_feat = fore_feat / fore_feat.norm(dim=-1, keepdim=True)
-            fore_feat_list.append(fore_feat)
+        # Stack the object features once per video, KxC
+        fore_feats = torch.cat([fore_feat.reshape(1, -1) for fore_feat in fore_feat_list], dim=0)
 
+        # Only keyframes run the image encoder, the other frames reuse (or warp)
+        # the embedding of the last keyframe
+        synchronize()
+        start_time = time.perf_counter()
+        keyframes = select_keyframes(rgb[0], args.keyframe_interval, args.keyframe_threshold)
+        keyframe_states = {}
         for i in range (1, frame_num):
-            current_img = rgb[0, i] 
-            predictor.set_image(current_img)
+            if i in keyframes:
+                # Encode the next batch of keyframes
+                if i not in keyframe_states:
+                    batch_idx = keyframes[keyframes.index(i):keyframes.index(i) + args.batch_size]
+                    batch_states = predictor.set_images([rgb[0, k] for k in batch_idx], batch_size=args.batch_size)
+                    keyframe_states = dict(zip(batch_idx, batch_states))
+                key_idx, key_state = i, keyframe_states[i]
+                predictor.set_state(key_state)
+            elif args.warp:
+                predictor.set_state(warp_state(key_state, rgb[0, key_idx], rgb[0, i], predictor))
+            else:
+                predictor.set_state(key_state)
 
-            # pred masks
-            test_feat = predictor.features.squeeze()
-            C, htest, wtest = test_feat.shape
+            # Location prior of all objects at once
+            obj_num = min(len(fore_feat_list), len(input_boxes))
+            topk_xy_all = location_prior(fore_feats[:obj_num], predictor, topk=args.topk,
+                                         low_res=args.low_res_prior, subpixel=args.subpixel)
 
-            test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
-            test_feat = test_feat.reshape(C, htest * wtest)
-            
             concat_mask = np.zeros((1, first_frame_mask.shape[1], first_frame_mask.shape[2]), dtype=np.uint8)
-            for j in range(min(len(fore_feat_list), len(input_boxes))):
-                # Cosine similarity
-                fore_feat = fore_feat_list[j]
-                sim = fore_feat @ test_feat  # 1, h*w
-                sim = sim.reshape(1, 1, htest, wtest)
-                sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
-
-                mask_sim = predictor.model.postprocess_masks(
-                                sim,
-                                input_size=predictor.input_size,
-                                original_size=predictor.original_size).squeeze()
-
-                # Top-k point selection
-                w, h = mask_sim.shape
-
-                topk_xy_i, topk_label_i = point_selection(mask_sim, topk=args.topk)
-                topk_xy = topk_xy_i
-                topk_label = topk_label_i
+            for j in range(obj_num):
+                topk_xy = topk_xy_all[j]
+                topk_label = np.array([1] * args.topk)
 
                 if args.center:
                     topk_label = np.concatenate([topk_label, [1]], axis=0)
@@ -167,10 +181,71 @@ def main(args):
                 cur_labels = np.unique(current_mask_pred)
                 cur_labels = cur_labels[cur_labels!=0]
                 input_boxes = all_to_onehot(current_mask_pred, cur_labels)
-            
-        print(f"Finish predict video: {name}")
 
-    eval_davis_result(args.output_path, args.davis_path)
+        synchronize()
+        video_time = time.perf_counter() - start_time
+        total_time += video_time
+        total_frames += frame_num - 1
+        total_keyframes += len(keyframes)
+        print(f"Finish predict video: {name}, {len(keyframes)}/{frame_num - 1} keyframes, "
+              f"{(frame_num - 1) / video_time:.2f} fps")
+
+    fps = total_frames / total_time if total_frames > 0 else None
+    if fps is not None:
+        print(f"Encoded {total_keyframes}/{total_frames} frames, {fps:.2f} fps")
+    eval_davis_result(args.output_path, args.davis_path, fps=fps)
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def select_keyframes(frames, interval=1, threshold=None):
+    """
+    Selects the frames (after the reference frame 0) that run the image
+    encoder: every interval-th frame, and, with a threshold, every frame
+    whose mean absolute difference to the last keyframe, on 64x64 grayscale
+    thumbnails scaled to [0, 1], exceeds it.
+    """
+    keyframes = []
+    for i in range(1, len(frames)):
+        thumb = cv2.resize(cv2.cvtColor(frames[i], cv2.COLOR_RGB2GRAY), (64, 64), interpolation=cv2.INTER_AREA)
+        thumb = thumb.astype(np.float32) / 255
+        if not keyframes or i - keyframes[-1] >= interval or (
+                threshold is not None and np.abs(thumb - key_thumb).mean() > threshold):
+            keyframes.append(i)
+            key_thumb = thumb
+    return keyframes
+
+
+def warp_state(key_state, key_frame, frame, predictor):
+    """
+    Warps the embedding of a keyframe to another frame with dense optical
+    flow, computed on grayscale frames resized to 4x the valid embedding grid.
+    """
+    features = key_state.features
+    _, _, h, w = features.shape
+    img_size = predictor.model.image_encoder.img_size
+    valid_h = min(h, math.ceil(key_state.input_size[0] * h / img_size))
+    valid_w = min(w, math.ceil(key_state.input_size[1] * w / img_size))
+
+    # Flow from the frame to the keyframe, in embedding cells
+    size = (4 * valid_w, 4 * valid_h)
+    gray = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY), size, interpolation=cv2.INTER_AREA)
+    key_gray = cv2.resize(cv2.cvtColor(key_frame, cv2.COLOR_RGB2GRAY), size, interpolation=cv2.INTER_AREA)
+    flow = cv2.calcOpticalFlowFarneback(gray, key_gray, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+    flow = cv2.resize(flow, (valid_w, valid_h), interpolation=cv2.INTER_AREA) / 4
+
+    # Sample the keyframe embedding at the source of every cell
+    ys, xs = np.mgrid[0:valid_h, 0:valid_w].astype(np.float32)
+    src_x = np.clip(xs + flow[..., 0], 0, valid_w - 1)
+    src_y = np.clip(ys + flow[..., 1], 0, valid_h - 1)
+    grid = np.stack([(src_x + 0.5) / w * 2 - 1, (src_y + 0.5) / h * 2 - 1], axis=-1)
+    grid = torch.from_numpy(grid).to(device=features.device, dtype=features.dtype).unsqueeze(0)
+    warped = features.clone()
+    warped[:, :, :valid_h, :valid_w] = F.grid_sample(features, grid, mode="bilinear", align_corners=False)
+    return ImageState(warped, key_state.input_size, key_state.original_size)
 
 def get_box_prompt(img, threshold):
     rows = np.any(img, axis=1)
@@ -185,15 +260,44 @@ def get_box_prompt(img, threshold):
    
     return np.array([[(cmin + cmax) // 2, (rmin + rmax) // 2]]), np.array([cmin,rmin,cmax,rmax]) # x1,y1,x2,y2
 
-def point_selection(mask_sim, topk=1):
-    w, h = mask_sim.shape
-    topk_xy = mask_sim.flatten(0).topk(topk)[1]
-    topk_x = (topk_xy // h).unsqueeze(0)
-    topk_y = (topk_xy - topk_x * h)
-    topk_xy = torch.cat((topk_y, topk_x), dim=0).permute(1, 0)
-    topk_label = np.array([1] * topk)
-    topk_xy = topk_xy.cpu().numpy()
-    return topk_xy, topk_label
+def location_prior(fore_feats, predictor, topk=1, low_res=False, subpixel=False):
+    """
+    Selects the top-k positive points of K objects in the current frame with
+    one similarity matmul, one batched upsampling and one batched topk.
+    With low_res, the points are selected on the embedding grid instead.
+    Returns the points as a K x topk x 2 array of (X, Y) pixels.
+    """
+    test_feat = predictor.features.squeeze()
+    C, htest, wtest = test_feat.shape
+
+    # Cosine similarity
+    test_feat = test_feat / test_feat.norm(dim=0, keepdim=True)
+    test_feat = test_feat.reshape(C, htest * wtest)
+    sim = fore_feats @ test_feat  # K, h*w
+    sim = sim.reshape(-1, 1, htest, wtest)
+    if low_res:
+        topk_xy, _ = low_res_point_selection(
+            sim[:, 0],
+            predictor.input_size,
+            predictor.original_size,
+            predictor.model.image_encoder.img_size,
+            topk=topk,
+            negative=False,
+            subpixel=subpixel)
+        return topk_xy.cpu().numpy()
+
+    sim = F.interpolate(sim, scale_factor=4, mode="bilinear")
+
+    mask_sim = predictor.model.postprocess_masks(
+                    sim,
+                    input_size=predictor.input_size,
+                    original_size=predictor.original_size)[:, 0]  # K, H, W
+
+    # Top-k point selection
+    w = mask_sim.shape[2]
+    topk_idx = mask_sim.flatten(1).topk(topk, dim=1)[1]
+    topk_xy = torch.stack((topk_idx % w, topk_idx // w), dim=-1)
+    return topk_xy.cpu().numpy()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -203,6 +307,14 @@ if __name__ == '__main__':
     parser.add_argument("--topk", type=int, help="choose topk points", default=2)
     parser.add_argument("--exp", type=int, help="expand mask value to", default=215)
     parser.add_argument("--threshold", type=int, help="the threshold for bounding box expansion", default=10)
+    parser.add_argument("--batch_size", type=int, help="frames per encoder pass", default=1)
+    parser.add_argument("--keyframe_interval", type=int, help="encode every N-th frame", default=1)
+    parser.add_argument("--keyframe_threshold", type=float, default=None,
+                        help="also encode frames whose mean abs difference to the last keyframe exceeds it, in [0, 1]")
+    parser.add_argument("--warp", action="store_true", help="warp the keyframe embedding with optical flow")
+    parser.add_argument("--low_res_prior", action="store_true", help="select points on the embedding grid")
+    parser.add_argument("--subpixel", action="store_true", help="refine low-res points to sub-pixel precision")
+    parser.add_argument("--concept_dir", type=str, default=None, help="load and save first-frame object concepts")
     parser.add_argument("--eval", action="store_true", help="eval only")
     parser.add_argument("--box_prompt", action="store_true", help="whether use box prompt")
     parser.add_argument("--large", action="store_true", help="whether choose largest mask for prompting after stage 1")
@@ -6,7 +6,7 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 from torch.utils.data import DataLoader
-from per_segment_anything import SamPredictor, sam_model_registry
+from per_segment_anything import SamPredictor, load_sam
 from davis2017.davis import DAVISTestDataset, all_to_onehot
 from eval_video import eval_davis_result
 
@@ -28,9 +28,7 @@ def main(args):
 
     # Load SAM
     sam_type, sam_ckpt = 'vit_h', 'sam_vit_h_4b8939.pth'
-    sam = sam_model_registry[sam_type](checkpoint=sam_ckpt).cuda()
-    for name, param in sam.named_parameters():
-        param.requires_grad = False
+    sam = load_sam(sam_type, sam_ckpt, device='cuda')
     predictor = SamPredictor(sam)
 
     # Start eval
@@ -70,9 +68,10 @@ def main(args):
             obj_mask = np.concatenate((obj_mask, np.zeros((obj_mask.shape[0], obj_mask.shape[1], 2), dtype=obj_mask.dtype)), axis=2)  #(480, 910, 3)
             
             train_mask = torch.tensor(obj_mask)[:, :, 0] > 0
-            train_mask = train_mask.float().unsqueeze(0).repeat(1, 1, 1).flatten(1).cuda()
+            train_mask = train_mask.float().unsqueeze(0).repeat(1, 1, 1).flatten(1).to(predictor.device)
 
-            obj_mask = predictor.set_image(frame_image, obj_mask)
+            # The first frame is encoded once, later objects only transform their mask
+            obj_mask = predictor.set_image(frame_image, obj_mask, cal_image=(obj == 0))
             if obj == 0:
                 img_feat1 = predictor.features.squeeze().permute(1, 2, 0)
             obj_mask = F.interpolate(obj_mask, size=img_feat1.shape[0:2], mode="bilinear")
@@ -122,7 +121,7 @@ def main(args):
                 topk_xy = np.concatenate((topk_xy, center), axis=0)
 
             # Learnable mask weights
-            mask_weights = Mask_Weights().cuda()
+            mask_weights = Mask_Weights().to(predictor.device)
             mask_weights.train()
 
             num_params = 0
@@ -0,0 +1,72 @@
+# PerSeg evaluation helpers shared by quantize.py, resolution.py and sweep.py
+import os
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+from per_segment_anything import PerSAMEngine, SamPredictor
+
+
+def load_image(path: str) -> np.ndarray:
+    """Reads an image file in HWC uint8 RGB format."""
+    image = cv2.imread(path)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def list_categories(images_path: str) -> List[str]:
+    """Returns the sorted category names of a PerSeg 'Images' directory."""
+    return sorted([obj_name for obj_name in os.listdir(images_path) if ".DS" not in obj_name])
+
+
+def test_indices(images_path: str, obj_name: str, ref_idx: str = "00") -> List[str]:
+    """Returns the sorted image indices of a category, without the reference."""
+    names = sorted(os.listdir(os.path.join(images_path, obj_name)))
+    test_idxs = [os.path.splitext(name)[0] for name in names]
+    return [test_idx for test_idx in test_idxs if test_idx != ref_idx]
+
+
+def intersection_and_union(pred_mask: np.ndarray, gt_mask: np.ndarray) -> Tuple[int, int]:
+    """
+    Returns the foreground intersection and union of two binary masks of the
+    same shape, counted as in eval_miou.py. A class IoU is the sum of the
+    intersections over the sum of the unions of its test images.
+    """
+    assert pred_mask.shape == gt_mask.shape
+    intersection = int(np.logical_and(pred_mask, gt_mask).sum())
+    union = int(np.logical_or(pred_mask, gt_mask).sum())
+    return intersection, union
+
+
+def persam_iou(
+    predictor: SamPredictor,
+    obj_name: str,
+    images_path: str,
+    masks_path: str,
+    ref_idx: str = "00",
+) -> float:
+    """
+    Runs training-free PerSAM on one PerSeg category and returns its IoU.
+
+    Arguments:
+      predictor (SamPredictor): The predictor of the model to evaluate.
+      obj_name (str): The name of the category.
+      images_path (str): The PerSeg 'Images' directory.
+      masks_path (str): The PerSeg 'Annotations' directory.
+      ref_idx (str): The index of the reference image, which is not scored.
+
+    Returns:
+      (float): The IoU of the category, in [0, 1].
+    """
+    ref_image = load_image(os.path.join(images_path, obj_name, ref_idx + ".jpg"))
+    ref_mask = load_image(os.path.join(masks_path, obj_name, ref_idx + ".png"))
+    engine = PerSAMEngine.from_reference(predictor, ref_image, ref_mask)
+
+    intersection_sum, union_sum = 0, 0
+    for test_idx in test_indices(images_path, obj_name, ref_idx):
+        predictor.set_image(load_image(os.path.join(images_path, obj_name, test_idx + ".jpg")))
+        pred_mask = engine.segment()["mask"]
+        gt_mask = load_image(os.path.join(masks_path, obj_name, test_idx + ".png"))[:, :, 0] > 0
+        intersection, union = intersection_and_union(pred_mask, gt_mask)
+        intersection_sum += intersection
+        union_sum += union
+    return intersection_sum / (union_sum + 1e-10)
@@ -0,0 +1,90 @@
+import os
+import copy
+import time
+import argparse
+import warnings
+from tqdm import tqdm
+from per_segment_anything import sam_model_registry, SamPredictor
+from perseg import list_categories, load_image, persam_iou
+from per_segment_anything.utils.quantization import quantize_sam, save_quantized
+
+warnings.filterwarnings('ignore')
+
+
+def get_arguments():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--data', type=str, default='./data')
+    parser.add_argument('--sam_type', type=str, default='vit_t', choices=['vit_t', 'vit_b'])
+    parser.add_argument('--ckpt', type=str, default=None)
+    parser.add_argument('--out', type=str, default=None, help='path of the int8 checkpoint')
+    parser.add_argument('--ref_idx', type=str, default='00')
+    parser.add_argument('--bench_images', type=int, default=10, help='images timed per model')
+    parser.add_argument('--no_eval', action='store_true', help='skip the PerSeg mIoU comparison')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+
+    args = get_arguments()
+    print("Args:", args)
+
+    default_ckpts = {'vit_t': 'weights/mobile_sam.pt', 'vit_b': 'sam_vit_b_01ec64.pth'}
+    sam_ckpt = args.ckpt or default_ckpts[args.sam_type]
+    out_path = args.out or os.path.splitext(sam_ckpt)[0] + '_int8.pt'
+
+    print("======> Load SAM" )
+    sam = sam_model_registry[args.sam_type](checkpoint=sam_ckpt)
+    sam.eval()
+
+    print("======> Quantize" )
+    sam_int8 = quantize_sam(copy.deepcopy(sam))
+    save_quantized(sam_int8, out_path)
+    print("Saved", out_path, "(%.1f MB -> %.1f MB)" % (os.path.getsize(sam_ckpt) / 2**20, os.path.getsize(out_path) / 2**20))
+
+    # Reload to check that the saved checkpoint goes through sam_model_registry
+    sam_int8 = sam_model_registry[args.sam_type](checkpoint=out_path)
+    sam_int8.eval()
+
+    images_path = args.data + '/Images/'
+    masks_path = args.data + '/Annotations/'
+    obj_names = list_categories(images_path)
+
+    print("======> Benchmark Image Encoder" )
+    bench_paths = []
+    for obj_name in obj_names:
+        for name in sorted(os.listdir(os.path.join(images_path, obj_name))):
+            bench_paths.append(os.path.join(images_path, obj_name, name))
+    bench_paths = bench_paths[:args.bench_images]
+
+    latency = {}
+    for name, model in [('fp32', sam), ('int8', sam_int8)]:
+        predictor = SamPredictor(model)
+        predictor.set_image(load_image(bench_paths[0]))  # warm-up
+        start = time.perf_counter()
+        for path in bench_paths:
+            predictor.set_image(load_image(path))
+        latency[name] = (time.perf_counter() - start) / len(bench_paths)
+        print(f"{name}: {1000 * latency[name]:.1f} ms / image")
+    print(f"Speedup: {latency['fp32'] / latency['int8']:.2f}x")
+
+    if args.no_eval:
+        return
+
+    print("======> Evaluate on PerSeg" )
+    miou = {}
+    for name, model in [('fp32', sam), ('int8', sam_int8)]:
+        predictor = SamPredictor(model)
+        iou_sum = 0
+        for obj_name in tqdm(obj_names, desc=name):
+            iou_sum += persam_iou(predictor, obj_name, images_path, masks_path, args.ref_idx)
+        miou[name] = 100 * iou_sum / len(obj_names)
+        print(f"{name}: mIoU {miou[name]:.2f}")
+    print(f"mIoU delta (int8 - fp32): {miou['int8'] - miou['fp32']:+.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import os
+import time
+import argparse
+import warnings
+from tqdm import tqdm
+import torch
+from per_segment_anything import sam_model_registry, SamPredictor
+from perseg import list_categories, load_image, persam_iou
+
+warnings.filterwarnings('ignore')
+
+
+def get_arguments():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--data', type=str, default='./data')
+    parser.add_argument('--sam_type', type=str, default='vit_t', choices=['vit_t', 'vit_b', 'vit_l', 'vit_h'])
+    parser.add_argument('--ckpt', type=str, default=None)
+    parser.add_argument('--image_sizes', type=int, nargs='+', default=[1024, 768, 512],
+                        help='encoder input sizes, multiples of 16')
+    parser.add_argument('--ref_idx', type=str, default='00')
+    parser.add_argument('--bench_images', type=int, default=10, help='images timed per resolution')
+    parser.add_argument('--no_eval', action='store_true', help='skip the PerSeg mIoU comparison')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+
+    args = get_arguments()
+    print("Args:", args)
+
+    default_ckpts = {
+        'vit_t': 'weights/mobile_sam.pt',
+        'vit_b': 'sam_vit_b_01ec64.pth',
+        'vit_l': 'sam_vit_l_0b3195.pth',
+        'vit_h': 'sam_vit_h_4b8939.pth',
+    }
+    sam_ckpt = args.ckpt or default_ckpts[args.sam_type]
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    images_path = args.data + '/Images/'
+    masks_path = args.data + '/Annotations/'
+    obj_names = list_categories(images_path)
+
+    bench_paths = []
+    for obj_name in obj_names:
+        for name in sorted(os.listdir(os.path.join(images_path, obj_name))):
+            bench_paths.append(os.path.join(images_path, obj_name, name))
+    bench_paths = bench_paths[:args.bench_images]
+
+    latency, miou = {}, {}
+    for image_size in args.image_sizes:
+        print(f"======> Image size {image_size}" )
+        # Position embeddings of the 1024 px checkpoint are interpolated on load
+        sam = sam_model_registry[args.sam_type](checkpoint=sam_ckpt, image_size=image_size).to(device=device)
+        sam.eval()
+        predictor = SamPredictor(sam)
+
+        predictor.set_image(load_image(bench_paths[0]))  # warm-up
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for path in bench_paths:
+            predictor.set_image(load_image(path))
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        latency[image_size] = (time.perf_counter() - start) / len(bench_paths)
+
+        if not args.no_eval:
+            iou_sum = 0
+            for obj_name in tqdm(obj_names, desc=str(image_size)):
+                iou_sum += persam_iou(predictor, obj_name, images_path, masks_path, args.ref_idx)
+            miou[image_size] = 100 * iou_sum / len(obj_names)
+
+    reference = args.image_sizes[0]
+    print(f"\n{'image size':<12}{'encoder (ms)':>15}{'speedup':>10}{'mIoU':>10}{'delta':>10}")
+    for image_size in args.image_sizes:
+        row = f"{image_size:<12}{1000 * latency[image_size]:>15.1f}{latency[reference] / latency[image_size]:>9.2f}x"
+        if image_size in miou:
+            row += f"{miou[image_size]:>10.2f}{miou[image_size] - miou[reference]:>+10.2f}"
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
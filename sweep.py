@@ -0,0 +1,140 @@
+import os
+import time
+import argparse
+import itertools
+import warnings
+import multiprocessing as mp
+from tqdm import tqdm
+import torch
+from per_segment_anything import load_sam, SamPredictor, Concept
+from perseg import intersection_and_union, list_categories, load_image, test_indices
+from persam_f import (
+    sam_checkpoints, embedding_similarity, location_prior, segment, three_scale_logits, train_mask_weights_batched)
+
+warnings.filterwarnings('ignore')
+
+# Shared with the forked workers, copy-on-write
+predictor = None
+categories = None
+
+
+def get_arguments():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--data', type=str, default='./data')
+    parser.add_argument('--sam_type', type=str, default='vit_t', choices=list(sam_checkpoints))
+    parser.add_argument('--ckpt', type=str, default=None)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--ref_idx', type=str, default='00')
+    parser.add_argument('--batch_size', type=int, default=4, help='test images per encoder pass')
+    parser.add_argument('--low_res_prior', action='store_true', help='select points on the embedding grid')
+    parser.add_argument('--subpixel', action='store_true', help='refine low-res points to sub-pixel precision')
+    parser.add_argument('--train_size', type=int, default=None,
+                        help='long side of the grid the cached logits are trained on, full resolution by default')
+
+    parser.add_argument('--lr', type=float, nargs='+', default=[1e-3])
+    parser.add_argument('--train_epoch', type=int, nargs='+', default=[1000])
+    parser.add_argument('--topk', type=int, nargs='+', default=[1], help='positive points of the location prior')
+    parser.add_argument('--refinement', type=int, nargs='+', default=[2], choices=[0, 1, 2],
+                        help='cascaded post-refinement steps')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes evaluating configs, 0 runs them in the main process (required on GPU)')
+
+    args = parser.parse_args()
+    if args.workers is None:
+        args.workers = 0 if args.device == 'cuda' else min(os.cpu_count(), 4)
+    return args
+
+
+def main():
+    global predictor, categories
+
+    args = get_arguments()
+    print("Args:", args)
+
+    print("======> Load SAM" )
+    sam = load_sam(args.sam_type, args.ckpt or sam_checkpoints[args.sam_type], device=args.device)
+    predictor = SamPredictor(sam)
+
+    print("======> Encode PerSeg" )
+    start = time.perf_counter()
+    images_path = args.data + '/Images/'
+    masks_path = args.data + '/Annotations/'
+    obj_names = list_categories(images_path)
+    categories = [encode_category(args, obj_name, images_path, masks_path) for obj_name in tqdm(obj_names)]
+    print(f"Encoded {len(categories)} categories in {time.perf_counter() - start:.1f} s")
+
+    configs = list(itertools.product(args.lr, args.train_epoch, args.topk, args.refinement))
+    print(f"======> Evaluate {len(configs)} configs" )
+    start = time.perf_counter()
+    if args.workers == 0:
+        results = [evaluate(args, config) for config in configs]
+    else:
+        # Forked workers inherit the model and the embeddings without copying them
+        threads = max(1, torch.get_num_threads() // args.workers)
+        with mp.get_context('fork').Pool(args.workers, initializer=torch.set_num_threads, initargs=(threads,)) as pool:
+            results = pool.starmap(evaluate, [(args, config) for config in configs])
+    print(f"Evaluated {len(configs)} configs in {time.perf_counter() - start:.1f} s")
+
+    print(f"\n{'lr':>10}{'epochs':>8}{'topk':>6}{'refine':>8}{'mIoU':>8}{'time (s)':>10}")
+    for (lr, train_epoch, topk, refinement), miou, runtime in sorted(results, key=lambda result: -result[1]):
+        print(f"{lr:>10.0e}{train_epoch:>8}{topk:>6}{refinement:>8}{miou:>8.2f}{runtime:>10.1f}")
+
+
+def encode_category(args, obj_name, images_path, masks_path):
+    # Encodes the reference and the test images of a category once, for every config
+    ref_image = load_image(os.path.join(images_path, obj_name, args.ref_idx + '.jpg'))
+    ref_mask = load_image(os.path.join(masks_path, obj_name, args.ref_idx + '.png'))
+    concept = Concept.from_reference(predictor, ref_image, ref_mask, obj_name, max_weight=0.5)
+    ref_gt = torch.tensor(ref_mask[:, :, 0] > 0, device=predictor.device).float().flatten().unsqueeze(0)
+
+    test_idxs = test_indices(images_path, obj_name, args.ref_idx)
+    test_images = [load_image(os.path.join(images_path, obj_name, test_idx + '.jpg')) for test_idx in test_idxs]
+    test_gts = [load_image(os.path.join(masks_path, obj_name, test_idx + '.png'))[:, :, 0] > 0 for test_idx in test_idxs]
+
+    return {
+        'ref_state': predictor.image_state,
+        'ref_gt': ref_gt,
+        'target_feat': concept.target_feat,
+        'test_states': predictor.set_images(test_images, batch_size=args.batch_size),
+        'test_gts': test_gts,
+    }
+
+
+def evaluate(args, config):
+    # PerSAM-F on every category with one config, returning the config, the mIoU and the runtime
+    lr, train_epoch, topk, refinement = config
+    start = time.perf_counter()
+
+    # Mask weights of all the categories are trained together, on cached logits
+    cached_logits, train_gts = [], []
+    for category in categories:
+        predictor.set_state(category['ref_state'])
+        sim = embedding_similarity(predictor, category['target_feat'])
+        topk_xy, topk_label = location_prior(sim, predictor, args.low_res_prior, args.subpixel, topk)
+        logits_high, train_gt = three_scale_logits(predictor, topk_xy, topk_label, category['ref_gt'], args.train_size)
+        cached_logits.append(logits_high)
+        train_gts.append(train_gt)
+    train_args = argparse.Namespace(lr=lr, train_epoch=train_epoch, log_epoch=train_epoch)
+    batch_weights = train_mask_weights_batched(train_args, cached_logits, train_gts)
+
+    iou_sum = 0
+    for category, weights in zip(categories, batch_weights):
+        intersection_sum, union_sum = 0, 0
+        for test_state, test_gt in zip(category['test_states'], category['test_gts']):
+            predictor.set_state(test_state)
+            pred_mask, _, _, _ = segment(
+                predictor, category['target_feat'], weights, args.low_res_prior, args.subpixel, topk, refinement)
+            intersection, union = intersection_and_union(pred_mask, test_gt)
+            intersection_sum += intersection
+            union_sum += union
+        iou_sum += intersection_sum / (union_sum + 1e-10)
+
+    if predictor.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return config, 100 * iou_sum / len(categories), time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
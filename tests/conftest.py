@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import torch
+
+from per_segment_anything import SamPredictor
+from per_segment_anything.build_sam import _build_sam
+from per_segment_anything.utils import embedding_cache
+
+
+def build_tiny_sam(checkpoint=None, image_size=256, **kwargs):
+    # A two-block ViT at 256 px, small enough to run every test on CPU
+    torch.manual_seed(0)
+    sam = _build_sam(
+        encoder_embed_dim=64,
+        encoder_depth=2,
+        encoder_num_heads=2,
+        encoder_global_attn_indexes=[1],
+        image_size=image_size,
+        checkpoint=checkpoint,
+        **kwargs,
+    )
+    if checkpoint is None:
+        # Position embeddings are zero-initialized, randomize them so they matter
+        with torch.no_grad():
+            for name, param in sam.named_parameters():
+                if "rel_pos" in name or "pos_embed" in name:
+                    param.normal_(0, 0.02)
+    return sam.eval()
+
+
+@pytest.fixture(autouse=True)
+def checkpoint_hash_index(tmp_path, monkeypatch):
+    # Keep hash_checkpoint from writing to the user cache directory
+    monkeypatch.setattr(embedding_cache, "CHECKPOINT_HASH_INDEX", str(tmp_path / "checkpoints.json"))
+
+
+@pytest.fixture(scope="session")
+def tiny_sam():
+    return build_tiny_sam()
+
+
+@pytest.fixture
+def predictor(tiny_sam):
+    return SamPredictor(tiny_sam)
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(0)
+    return [
+        rng.integers(0, 256, (120, 160, 3), dtype=np.uint8),
+        rng.integers(0, 256, (200, 90, 3), dtype=np.uint8),
+        rng.integers(0, 256, (64, 64, 3), dtype=np.uint8),
+    ]
+
+
+@pytest.fixture
+def ref_mask(images):
+    mask = np.zeros_like(images[0])
+    mask[30:90, 40:120] = 255
+    return mask
@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from per_segment_anything.modeling.image_encoder import Attention
+
+
+@pytest.mark.parametrize("backend", ["sdpa", "chunked"])
+@pytest.mark.parametrize("use_rel_pos", [True, False])
+@pytest.mark.parametrize("batch,size", [(1, (16, 16)), (3, (7, 7))], ids=["global", "windowed"])
+def test_backends_match_math(backend, use_rel_pos, batch, size):
+    torch.manual_seed(0)
+    attn = Attention(64, num_heads=4, use_rel_pos=use_rel_pos, input_size=size, attn_chunk_size=37)
+    if use_rel_pos:
+        with torch.no_grad():
+            attn.rel_pos_h.normal_(0, 0.5)
+            attn.rel_pos_w.normal_(0, 0.5)
+    x = torch.randn(batch, *size, 64)
+
+    with torch.no_grad():
+        expected = attn(x)
+        attn.attn_backend = backend
+        output = attn(x)
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_unknown_backend():
+    with pytest.raises(AssertionError):
+        Attention(64, attn_backend="flash")
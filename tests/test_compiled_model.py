@@ -0,0 +1,44 @@
+import os
+
+import pytest
+import torch
+
+from per_segment_anything.utils.compiled_model import TracedImageEncoder, compile_sam, warmup_sam
+
+from conftest import build_tiny_sam
+
+
+def test_compile_sam_leaves_model_unchanged(tiny_sam, tmp_path):
+    image_encoder, mask_decoder = tiny_sam.image_encoder, tiny_sam.mask_decoder
+    compiled = compile_sam(tiny_sam, "tiny", cache_dir=str(tmp_path), decoder_backend=None)
+    assert tiny_sam.image_encoder is image_encoder
+    assert tiny_sam.mask_decoder is mask_decoder
+    assert isinstance(compiled.image_encoder, TracedImageEncoder)
+    assert compiled.image_encoder.image_encoder is image_encoder
+    assert compiled.prompt_encoder is tiny_sam.prompt_encoder
+
+    warmup_sam(compiled, batch_sizes=[1, 2])
+    assert set(compiled.image_encoder.traced) == {(1, 3, 256, 256), (2, 3, 256, 256)}
+    x = torch.randn(2, 3, 256, 256)
+    with torch.no_grad():
+        assert torch.allclose(compiled.image_encoder(x), tiny_sam.image_encoder(x), atol=1e-5)
+
+
+def test_warmup_sam_needs_batch_sizes(tiny_sam):
+    with pytest.raises(AssertionError):
+        warmup_sam(tiny_sam, batch_sizes=[])
+
+
+def test_traces_are_keyed_on_encoder_config(tmp_path):
+    checkpoint = str(tmp_path / "tiny.pt")
+    torch.save(build_tiny_sam().state_dict(), checkpoint)
+    cache_dir = str(tmp_path / "compiled")
+    x = torch.randn(1, 3, 256, 256)
+    outputs = []
+    for attn_backend in ["math", "chunked"]:
+        sam = build_tiny_sam(checkpoint, attn_backend=attn_backend, attn_chunk_size=64)
+        compiled = compile_sam(sam, "tiny", checkpoint, cache_dir, decoder_backend=None)
+        with torch.no_grad():
+            outputs.append(compiled.image_encoder(x))
+    assert len(os.listdir(os.path.join(cache_dir, "traced"))) == 2
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-5)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import torch
+
+from per_segment_anything import Concept, ConceptLibrary
+
+
+@pytest.fixture
+def concept(predictor, images, ref_mask):
+    concept = Concept.from_reference(predictor, images[0], ref_mask, "dog", max_weight=0.5, model_id="tiny")
+    concept.mask_weights = torch.tensor([[0.2], [0.3], [0.5]])
+    return concept
+
+
+def assert_same_concept(loaded, concept):
+    assert loaded.name == concept.name
+    assert loaded.max_weight == concept.max_weight
+    assert loaded.model_id == concept.model_id
+    assert torch.equal(loaded.target_feat, concept.target_feat)
+    assert torch.equal(loaded.target_embedding, concept.target_embedding)
+    assert torch.equal(loaded.mask_weights, concept.mask_weights)
+    assert np.array_equal(loaded.thumbnail, concept.thumbnail)
+
+
+def test_from_reference(concept, images):
+    assert concept.target_feat.shape == (1, 256)
+    assert concept.target_embedding.shape == (1, 1, 256)
+    assert torch.allclose(concept.target_feat.norm(), torch.tensor(1.0))
+    assert concept.thumbnail.shape[-1] == 4 and max(concept.thumbnail.shape[:2]) == 128
+
+
+def test_from_reference_empty_mask(predictor, images):
+    with pytest.raises(ValueError):
+        Concept.from_reference(predictor, images[0], np.zeros_like(images[0]))
+
+
+def test_save_load(concept, tmp_path):
+    path = str(tmp_path / "dog.npz")
+    concept.save(path)
+    assert_same_concept(Concept.load(path), concept)
+
+
+def test_save_load_without_thumbnail(concept, tmp_path):
+    concept.thumbnail = None
+    path = str(tmp_path / "dog.npz")
+    concept.save(path)
+    assert Concept.load(path).thumbnail is None
+
+
+def test_library(concept, tmp_path):
+    library = ConceptLibrary(str(tmp_path / "concepts"))
+    assert library.names() == []
+    library.add(concept)
+    assert "dog" in library
+    assert library.summary("dog")["mask_weights"]
+    assert_same_concept(library.load("dog", model_id="tiny"), concept)
+    with pytest.raises(ValueError):
+        library.load("dog", model_id="other")
+
+    # Names that are not valid file names still get distinct files
+    for name in ["a/b", "a?b"]:
+        concept.name = name
+        library.add(concept)
+    assert library.names() == ["a/b", "a?b", "dog"]
+    assert library.summary("a/b")["file"] != library.summary("a?b")["file"]
+
+    library.remove("dog")
+    assert "dog" not in ConceptLibrary(library.root)
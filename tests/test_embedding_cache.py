@@ -0,0 +1,101 @@
+import os
+
+import torch
+
+from per_segment_anything import SamPredictor, sam_model_registry
+from per_segment_anything.utils.embedding_cache import EmbeddingCache, sam_model_id
+from per_segment_anything.utils.quantization import quantize_sam
+
+from conftest import build_tiny_sam
+
+
+def count_encoder_calls(sam):
+    calls = []
+    handle = sam.image_encoder.register_forward_hook(lambda *_: calls.append(1))
+    return calls, handle
+
+
+def test_put_get(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "vit_t")
+    image = torch.randint(0, 256, (1, 3, 32, 48), dtype=torch.uint8)
+    key = cache.key(image, 1024)
+    assert cache.get(key) is None
+
+    features = torch.randn(1, 256, 64, 64)
+    cache.put(key, features)
+    cached = cache.get(key)
+    assert cached.dtype == torch.float32
+    assert torch.allclose(cached, features, atol=1e-2)
+
+    cache.clear()
+    assert cache.get(key) is None
+
+
+def test_key_depends_on_image_and_model(tmp_path):
+    image = torch.zeros(1, 3, 32, 48, dtype=torch.uint8)
+    cache = EmbeddingCache(str(tmp_path), "vit_t")
+    key = cache.key(image, 1024)
+    assert cache.key(image.clone(), 1024) == key
+    assert cache.key(image + 1, 1024) != key
+    assert cache.key(image, 512) != key
+    assert EmbeddingCache(str(tmp_path), "vit_h").key(image, 1024) != key
+
+
+def test_model_id_depends_on_encoder_config():
+    configs = [
+        {},
+        {"precision": "bf16"},
+        {"image_size": 128},
+        {"attn_backend": "sdpa"},
+        {"attn_backend": "chunked"},
+        {"attn_backend": "chunked", "attn_chunk_size": 64},
+    ]
+    model_ids = [sam_model_id(build_tiny_sam(**config), "tiny") for config in configs]
+    model_ids.append(sam_model_id(quantize_sam(build_tiny_sam()), "tiny"))
+    assert model_ids[0] == "tiny-none-256"
+    assert len(set(model_ids)) == len(model_ids)
+
+    vit_t = sam_model_registry["vit_t"](optimize_for_inference=True)
+    assert sam_model_id(vit_t, "vit_t") == "vit_t-none-optimized"
+
+
+def test_evicts_least_recently_used(tmp_path):
+    features = torch.randn(1, 256, 16, 16)
+    # Room for two float16 entries
+    cache = EmbeddingCache(str(tmp_path), "vit_t", max_size_gb=2.5 * features.numel() * 2 / 1024**3)
+    keys = [str(i) for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        cache.put(key, features)
+        # Distinct modification times, without sleeping
+        os.utime(cache._path(key), (i, i))
+    cache.put(keys[2], features)
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[1]) is not None
+    assert cache.get(keys[2]) is not None
+
+
+def test_predictor_skips_encoder_on_hit(tiny_sam, images, tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "tiny", dtype="float32")
+    calls, handle = count_encoder_calls(tiny_sam)
+    try:
+        first = SamPredictor(tiny_sam, embedding_cache=cache)
+        first.set_image(images[0])
+        second = SamPredictor(tiny_sam, embedding_cache=cache)
+        second.set_image(images[0])
+    finally:
+        handle.remove()
+    assert len(calls) == 1
+    assert torch.equal(first.features, second.features)
+    assert second.original_size == first.original_size
+    assert second.input_size == first.input_size
+
+
+def test_get_does_not_write_through(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "vit_t", dtype="float32")
+    features = torch.randn(1, 256, 16, 16)
+    cache.put("a", features)
+    first, second = cache.get("a"), cache.get("a")
+    assert torch.equal(first, features)
+    # The tensors share copy-on-write mappings, writes stay private to each
+    first.zero_()
+    assert torch.equal(second, features)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import torch
+
+from per_segment_anything import Concept, PerSAMEngine
+
+
+@pytest.mark.parametrize("low_res_prior", [False, True])
+def test_segment_batch_matches_segment(predictor, images, ref_mask, low_res_prior):
+    engine = PerSAMEngine.from_reference(predictor, images[0], ref_mask, low_res_prior=low_res_prior)
+    states = predictor.set_images(images[1:])
+
+    batch_results = engine.segment_batch(states)
+    assert len(batch_results) == len(states)
+    for state, batch_result in zip(states, batch_results):
+        result = engine.segment(state)
+        assert batch_result["mask"].shape == state.original_size
+        assert np.array_equal(batch_result["mask"], result["mask"])
+        assert batch_result["mask_index"] == result["mask_index"]
+        assert batch_result["iou_prediction"] == pytest.approx(result["iou_prediction"], abs=1e-5)
+        assert np.array_equal(batch_result["point_coords"], result["point_coords"])
+        assert np.array_equal(batch_result["point_labels"], result["point_labels"])
+
+
+def test_from_concept_matches_from_reference(predictor, images, ref_mask, tmp_path):
+    engine = PerSAMEngine.from_reference(predictor, images[0], ref_mask)
+    path = str(tmp_path / "concept.npz")
+    Concept.from_reference(predictor, images[0], ref_mask).save(path)
+    concept_engine = PerSAMEngine.from_concept(predictor, Concept.load(path))
+
+    state = predictor.set_image(images[1])
+    assert np.array_equal(engine.segment(state)["mask"], concept_engine.segment(state)["mask"])
+
+
+def test_weighted_proposals_follow_persam_f(predictor, images, ref_mask):
+    engine = PerSAMEngine.from_reference(predictor, images[0], ref_mask)
+    predictor.set_image(images[1])
+    weights = torch.tensor([[0.2], [0.3], [0.5]])
+    results = engine.propose_instances(num_peaks=4, mask_weights=weights, box_nms_thresh=1.0)
+    assert len(results) > 0
+
+    for result in results:
+        # The test cascade of persam_f.py, prompted with the peak of the proposal
+        point_coords, point_labels = result["point_coords"], result["point_labels"]
+        masks, scores, logits, logits_high = predictor.predict(point_coords, point_labels, multimask_output=True)
+        mask = ((logits_high * weights.unsqueeze(-1)).sum(0) > 0).numpy()
+        logit = (logits * weights.numpy()[..., None]).sum(0)
+        for _ in range(2):
+            y, x = np.nonzero(mask)
+            input_box = np.array([x.min(), y.min(), x.max(), y.max()])
+            masks, scores, logits, _ = predictor.predict(
+                point_coords, point_labels, box=input_box[None, :], mask_input=logit[None, :, :], multimask_output=True
+            )
+            best_idx = np.argmax(scores)
+            mask, logit = masks[best_idx], logits[best_idx]
+        assert (mask != result["mask"]).mean() < 1e-3
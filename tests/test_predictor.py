@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+import torch
+
+from per_segment_anything import ImageState, ImageStatePool
+
+
+def test_set_images_matches_set_image(predictor, images):
+    states = predictor.set_images(images, batch_size=2)
+    assert len(states) == len(images)
+    for image, state in zip(images, states):
+        predictor.set_image(image)
+        assert state.original_size == image.shape[:2]
+        assert state.input_size == predictor.input_size
+        assert torch.allclose(state.features, predictor.features, atol=1e-5)
+
+
+def test_set_torch_image_rejects_batches(predictor):
+    with pytest.raises(AssertionError):
+        predictor.set_torch_image(torch.zeros(2, 3, 256, 256), (256, 256))
+
+
+def test_set_state_matches_set_image(predictor, images):
+    point_coords, point_labels = np.array([[20, 30]]), np.array([1])
+    predictor.set_image(images[0])
+    expected = predictor.predict(point_coords, point_labels)
+
+    predictor.set_images(images, state_keys=["a", "b", "c"])
+    predictor.set_image(images[1])
+    predictor.set_state("a")
+    masks, scores, logits, _ = predictor.predict(point_coords, point_labels)
+    assert np.array_equal(masks, expected[0])
+    assert np.allclose(scores, expected[1], atol=1e-5)
+    assert np.allclose(logits, expected[2], atol=1e-4)
+
+
+def test_image_state_pool_drops_least_recently_used():
+    pool = ImageStatePool(max_states=2)
+    states = [ImageState(torch.zeros(1), (1, 1), (1, 1)) for _ in range(3)]
+    pool.put("a", states[0])
+    pool.put("b", states[1])
+    assert pool.get("a") is states[0]
+    pool.put("c", states[2])
+    assert len(pool) == 2
+    assert "a" in pool and "c" in pool and "b" not in pool
+    with pytest.raises(KeyError):
+        pool.get("b")
+    pool.clear()
+    assert len(pool) == 0
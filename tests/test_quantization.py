@@ -0,0 +1,36 @@
+import copy
+
+import pytest
+import torch
+
+from per_segment_anything import sam_model_registry
+from per_segment_anything.utils.quantization import is_quantized_checkpoint, quantize_sam, save_quantized
+
+from conftest import build_tiny_sam
+
+
+def build_vit_t(checkpoint=None):
+    torch.manual_seed(0)
+    return sam_model_registry["vit_t"](checkpoint=checkpoint).eval()
+
+
+@pytest.mark.parametrize("build", [build_tiny_sam, build_vit_t], ids=["vit", "vit_t"])
+def test_save_quantized_round_trip(build, tmp_path):
+    # The ViT encoder is built on the meta device when loaded from a checkpoint, TinyViT is not
+    checkpoint = str(tmp_path / "sam.pt")
+    torch.save(build().state_dict(), checkpoint)
+    sam = build(checkpoint)
+
+    sam_int8 = quantize_sam(copy.deepcopy(sam))
+    quantized_checkpoint = str(tmp_path / "sam_int8.pt")
+    save_quantized(sam_int8, quantized_checkpoint)
+    assert is_quantized_checkpoint(torch.load(quantized_checkpoint))
+    assert not is_quantized_checkpoint(torch.load(checkpoint))
+
+    reloaded = build(quantized_checkpoint)
+    x = torch.randn(1, 3, sam.image_encoder.img_size, sam.image_encoder.img_size)
+    with torch.no_grad():
+        output = reloaded.image_encoder(x)
+        expected = sam.image_encoder(x)
+        assert torch.equal(output, sam_int8.image_encoder(x))
+    assert (output - expected).abs().mean() < 0.1 * expected.abs().mean()